@@ -0,0 +1,53 @@
+"""
+Captures the eval trace of positions from a StockfishTraces build as golden files.
+
+    python benchmarks/capture_trace.py --stockfish stockfish/stockfish NAME FEN [NAME FEN ...]
+
+The raw output of the engine goes to traces/<name>.txt and the FEN with its
+reference analysis, the one parse_benchmark.py checks TraceParser against,
+to traces/<name>.json. Existing captures are only replaced with --force.
+"""
+import argparse
+import json
+import os
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'src'))
+
+import chess
+from engine_pool import StockfishEngine
+from parse_benchmark import TRACES_DIR, trace_of, reference_analysis
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--stockfish', required=True, help='StockfishTraces binary')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--force', action='store_true', help='replace captures that already exist')
+    parser.add_argument('positions', nargs='+', help='name and FEN of each position')
+    args = parser.parse_args()
+
+    if len(args.positions) % 2:
+        parser.error('every position needs a name and a FEN')
+    positions = list(zip(args.positions[::2], args.positions[1::2]))
+    for name, fen in positions:
+        if not chess.Board(fen).is_valid():
+            parser.error(f'{name}: {fen} is not a legal position')
+        if os.path.exists(os.path.join(TRACES_DIR, f'{name}.json')) and not args.force:
+            parser.error(f'{name} is already captured, use --force to replace it')
+
+    engine = StockfishEngine(args.stockfish, args.timeout)
+    engine.start()
+    try:
+        for name, fen in positions:
+            stdout = engine.evaluate(fen)
+            with open(os.path.join(TRACES_DIR, f'{name}.txt'), 'w') as f:
+                f.write(stdout)
+            with open(os.path.join(TRACES_DIR, f'{name}.json'), 'w') as f:
+                json.dump({'fen': fen, 'analysis': reference_analysis(trace_of(stdout), fen)}, f, indent=4)
+            print(f'{name}: {len(stdout.splitlines())} lines')
+    finally:
+        engine.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Sends concurrent /analyze requests to a running api-server and reports throughput.
+
+    python benchmarks/load_test.py [--url http://localhost:5000] [--concurrency 16] [--requests 128]
+
+The positions come from the captures in traces/. Run it once against each
+server setup to compare them, e.g. with the stub completions server:
+
+    python benchmarks/stub_openai_server.py --latency 0.8 &
+    LLM_BASE_URL=http://localhost:8020/v1 uvicorn --host 0.0.0.0 --port 5000 app:app
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+TRACES_DIR = os.path.join(BENCHMARKS_DIR, 'traces')
+
+def load_fens():
+    fens = []
+    for golden_path in sorted(glob.glob(os.path.join(TRACES_DIR, '*.json'))):
+        with open(golden_path) as f:
+            fens.append(json.load(f)['fen'])
+    return fens
+
+def send_request(url, aspect, fen, timeout):
+    query = urllib.parse.urlencode({'aspect': aspect, 'fen': fen})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(f'{url}/analyze?{query}', timeout=timeout) as response:
+            ok = 'answer' in json.loads(response.read())
+    except Exception:
+        ok = False
+    return ok, time.perf_counter() - start
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--aspect', default='General analysis')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=128)
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    fens = load_fens()
+    jobs = [fens[i % len(fens)] for i in range(args.requests)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(lambda fen: send_request(args.url, args.aspect, fen, args.timeout), jobs))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for ok, latency in results if ok]
+    errors = len(results) - len(latencies)
+    print(f'Requests:    {len(results)} ({errors} errors), concurrency {args.concurrency}')
+    print(f'Throughput:  {len(latencies) / elapsed:8.2f} req/s')
+    if latencies:
+        print(f'Latency p50: {statistics.median(latencies) * 1000:8.0f} ms')
+        print(f'Latency p95: {percentile(latencies, 0.95) * 1000:8.0f} ms')
+
+if __name__ == '__main__':
+    main()
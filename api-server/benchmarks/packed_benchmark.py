@@ -0,0 +1,106 @@
+"""
+Checks that packed analyses read back unchanged and measures their size and speed.
+
+    python benchmarks/packed_benchmark.py [--repeat 2000] [--copies 2000]
+
+Every capture of traces/ is parsed, packed with packed_analysis.py and
+unpacked again, the script exits with an error if the analysis dict differs
+from the one of the golden file. The packed form is then compared with the
+compact JSON the analysis cache stored before, in bytes, in memory held per
+cached analysis and in the time to serialize and read back.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import chess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'src'))
+
+from trace_parser import TraceParser
+from packed_analysis import pack_analysis, unpack_analysis
+from parse_benchmark import load_captures
+
+def parse_traces(captures):
+    return [(name, TraceParser().parse(raw_info, chess.Board(fen)), expected)
+            for name, fen, raw_info, expected in captures]
+
+def check_round_trip(traces):
+    failures = []
+    for name, trace, expected in traces:
+        # Compare the serialized form so key order, which reaches the prompt, is checked too
+        if json.dumps(unpack_analysis(pack_analysis(trace))) != json.dumps(expected):
+            failures.append(name)
+    return failures
+
+def memory_per_copy(make, copies):
+    """
+    Returns the bytes allocated per object by make(), averaged over the given number of copies.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [make() for _ in range(copies)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # The list holding the copies is not part of them
+    return (after - before - sys.getsizeof(kept)) / len(kept)
+
+def size_stats(traces, copies):
+    """
+    Returns the mean serialized size and memory per analysis of the dict, its JSON and the packed form.
+    """
+    stats = {'json_bytes': 0, 'packed_bytes': 0, 'dict_memory': 0, 'json_memory': 0, 'packed_memory': 0}
+    for _, trace, _ in traces:
+        serialized = json.dumps(trace.to_dict(), separators=(',', ':'))
+        packed = pack_analysis(trace)
+        stats['json_bytes'] += len(serialized)
+        stats['packed_bytes'] += len(packed)
+        stats['dict_memory'] += memory_per_copy(lambda: json.loads(serialized), copies)
+        # Copies of the serialized forms, a cache holds one object per entry
+        stats['json_memory'] += memory_per_copy(lambda: (serialized + '.')[:-1], copies)
+        stats['packed_memory'] += memory_per_copy(lambda: bytes(bytearray(packed)), copies)
+    return {name: round(total / len(traces), 1) for name, total in stats.items()}
+
+def time_per_call(function, arguments, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for argument in arguments:
+            function(argument)
+    return (time.perf_counter() - start) / (repeat * len(arguments)) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--copies', type=int, default=2000, help='copies of each analysis to measure memory on')
+    args = parser.parse_args()
+
+    traces = parse_traces(load_captures())
+    failures = check_round_trip(traces)
+    if failures:
+        print(f'Unpacked analyses differ from the golden files: {", ".join(failures)}')
+        sys.exit(1)
+    print(f'Golden files: {len(traces)} captures read back unchanged')
+
+    sizes = size_stats(traces, args.copies)
+    print(f'Serialized size:  {sizes["json_bytes"]:8.0f} B JSON, {sizes["packed_bytes"]:6.0f} B packed, '
+          f'{sizes["json_bytes"] / sizes["packed_bytes"]:5.1f}x smaller')
+    print(f'Memory per entry: {sizes["dict_memory"]:8.0f} B dict, {sizes["json_memory"]:6.0f} B JSON, '
+          f'{sizes["packed_memory"]:6.0f} B packed, {sizes["dict_memory"] / sizes["packed_memory"]:5.1f}x smaller than the dict')
+
+    analyses = [trace.to_dict() for _, trace, _ in traces]
+    serialized = [json.dumps(analysis, separators=(',', ':')) for analysis in analyses]
+    packed = [pack_analysis(trace) for _, trace, _ in traces]
+    timings = [
+        ('JSON dumps', time_per_call(lambda analysis: json.dumps(analysis, separators=(',', ':')), analyses, args.repeat)),
+        ('JSON loads', time_per_call(json.loads, serialized, args.repeat)),
+        ('Pack', time_per_call(pack_analysis, [trace for _, trace, _ in traces], args.repeat)),
+        ('Unpack to dict', time_per_call(unpack_analysis, packed, args.repeat))
+    ]
+    for name, microseconds in timings:
+        print(f'{name + ":":<18}{microseconds:8.1f} us/analysis')
+
+if __name__ == '__main__':
+    main()
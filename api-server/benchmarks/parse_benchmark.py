@@ -0,0 +1,121 @@
+"""
+Checks the trace parser against the golden files and measures parse time.
+
+    python benchmarks/parse_benchmark.py [--repeat 200] [--stockfish PATH]
+
+Every traces/<name>.txt is a StockfishTraces eval capture and traces/<name>.json
+holds the FEN and the analysis the original regex parser returned for it, with
+the backward pawns of BoardFeatures in place of the ones flagged in the trace.
+The first captures were written to the trace format by hand, capture_trace.py
+adds captures of a StockfishTraces build. With --stockfish, the positions of
+the golden files are also evaluated on that build and its output is checked
+the same way. The script exits with an error if TraceParser output differs.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import chess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'src'))
+
+from board_features import BoardFeatures, square_names
+from engine_pool import StockfishEngine
+from trace_parser import TraceParser
+from legacy_parser import LegacyTraceParser
+
+TRACES_DIR = os.path.join(BENCHMARKS_DIR, 'traces')
+
+def load_captures():
+    captures = []
+    for golden_path in sorted(glob.glob(os.path.join(TRACES_DIR, '*.json'))):
+        name = os.path.splitext(os.path.basename(golden_path))[0]
+        with open(golden_path) as f:
+            golden = json.load(f)
+        with open(os.path.join(TRACES_DIR, f'{name}.txt')) as f:
+            stdout = f.read()
+
+        captures.append((name, golden['fen'], trace_of(stdout), golden['analysis']))
+    return captures
+
+def trace_of(stdout):
+    return stdout.split('Begin position analysis.')[1].split('End position analysis.')[0]
+
+def reference_analysis(raw_info, fen):
+    """
+    The analysis a golden file holds for the trace.
+    """
+    analysis = LegacyTraceParser().parse_evaluation(raw_info, fen)
+    pawn_structure = analysis['Pawn Structure']
+    if isinstance(pawn_structure, dict):
+        features = BoardFeatures(chess.Board(fen))
+        for color, side in [(chess.WHITE, 'White'), (chess.BLACK, 'Black')]:
+            pawn_structure[f'{side} Backward Pawns'] = square_names(features.backward_pawns(color))
+    return analysis
+
+def differs(raw_info, fen, expected):
+    parsed = TraceParser().parse(raw_info, chess.Board(fen)).to_dict()
+    # Compare the serialized form so key order, which reaches the prompt, is checked too
+    return json.dumps(parsed) != json.dumps(expected)
+
+def check_golden(captures):
+    return [name for name, fen, raw_info, expected in captures if differs(raw_info, fen, expected)]
+
+def check_engine(stockfish_path, positions, timeout=10.0):
+    """
+    Evaluates the (name, fen) positions on the engine and returns the names
+    of the ones whose trace TraceParser reads differently from the reference.
+    """
+    engine = StockfishEngine(stockfish_path, timeout)
+    engine.start()
+    try:
+        failures = []
+        for name, fen in positions:
+            raw_info = trace_of(engine.evaluate(fen))
+            if differs(raw_info, fen, reference_analysis(raw_info, fen)):
+                failures.append(name)
+        return failures
+    finally:
+        engine.stop()
+
+def time_parser(parse, captures, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, fen, raw_info, _ in captures:
+            parse(raw_info, fen)
+    elapsed = time.perf_counter() - start
+    return elapsed / (repeat * len(captures)) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--stockfish', help='StockfishTraces binary to check the parser on')
+    args = parser.parse_args()
+
+    captures = load_captures()
+    failures = check_golden(captures)
+    if failures:
+        print(f'TraceParser output differs from the golden files: {", ".join(failures)}')
+        sys.exit(1)
+    print(f'Golden files: {len(captures)} captures match')
+
+    if args.stockfish:
+        failures = check_engine(args.stockfish, [(name, fen) for name, fen, _, _ in captures])
+        if failures:
+            print(f'TraceParser output differs on the traces of {args.stockfish}: {", ".join(failures)}')
+            sys.exit(1)
+        print(f'Engine traces: {len(captures)} positions match')
+
+    legacy_us = time_parser(LegacyTraceParser().parse_evaluation, captures, args.repeat)
+    single_pass_us = time_parser(lambda raw_info, fen: TraceParser().parse(raw_info, chess.Board(fen)).to_dict(),
+                                 captures, args.repeat)
+
+    print(f'Regex parser:       {legacy_us:8.1f} us/trace')
+    print(f'Single pass parser: {single_pass_us:8.1f} us/trace')
+    print(f'Speedup:            {legacy_us / single_pass_us:8.2f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+A UCI engine that answers eval with the saved StockfishTraces captures.
+
+    STOCKFISH_PATH=benchmarks/replay_engine.py uvicorn app:app
+
+Every position of corpus.json is answered with the capture in traces/ it
+names, other positions with the first capture. It makes the benchmarks
+repeatable on machines without a StockfishTraces build. REPLAY_EVAL_DELAY
+adds a fixed delay to every eval, in seconds, to stand in for the search.
+
+go is answered with made up principal variations of legal moves, one depth
+every REPLAY_SEARCH_DELAY seconds, so the search mode can be exercised too.
+It honours depth, movetime, MultiPV and stop, the scores mean nothing.
+"""
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+import chess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'src'))
+
+from position import normalize_fen
+
+CORPUS_PATH = os.path.join(BENCHMARKS_DIR, 'corpus.json')
+TRACES_DIR = os.path.join(BENCHMARKS_DIR, 'traces')
+
+def load_captures():
+    with open(CORPUS_PATH) as f:
+        corpus = json.load(f)
+
+    traces = {}
+    captures = {}
+    for position in corpus:
+        name = position['trace']
+        if name not in traces:
+            with open(os.path.join(TRACES_DIR, f'{name}.txt')) as f:
+                traces[name] = f.read()
+        captures[normalize_fen(position['fen'])] = traces[name]
+    return captures, traces[corpus[0]['trace']]
+
+def read_commands(commands):
+    for line in sys.stdin:
+        commands.put(line.strip())
+    commands.put('quit')
+
+def parse_position(command):
+    """
+    Returns the board of a position command.
+    """
+    fen, _, moves = command[len('position '):].partition(' moves ')
+    board = chess.Board() if fen.startswith('startpos') else chess.Board(fen[len('fen '):])
+    for move in moves.split():
+        board.push_uci(move)
+    return board
+
+def principal_variation(board, first_move, length):
+    board = board.copy(stack=False)
+    moves = []
+    move = first_move
+    while move is not None and len(moves) < length:
+        moves.append(move.uci())
+        board.push(move)
+        move = next(iter(board.legal_moves), None)
+    return moves
+
+def search(board, go, multipv, commands, deferred, delay):
+    """
+    Prints one depth of made up lines every delay seconds, until the depth or the movetime is reached or stop arrives.
+    Commands other than isready and stop wait in deferred until the search is over.
+    Returns whether quit arrived during the search.
+    """
+    tokens = go.split()
+    depth = int(tokens[tokens.index('depth') + 1]) if 'depth' in tokens else 64
+    movetime = int(tokens[tokens.index('movetime') + 1]) / 1000 if 'movetime' in tokens else None
+    moves = sorted(board.legal_moves, key=lambda move: move.uci())[:multipv]
+    if not moves:
+        print('info depth 0 score mate 0\nbestmove (none)', flush=True)
+        return False
+
+    start = time.monotonic()
+    lines = []
+    quit = False
+    for current_depth in range(1, depth + 1):
+        elapsed = int((time.monotonic() - start) * 1000)
+        lines = [principal_variation(board, move, current_depth) for move in moves]
+        for index, line in enumerate(lines, 1):
+            nodes = 1000 * current_depth * index
+            print(f'info depth {current_depth} seldepth {current_depth} multipv {index} score cp {40 - 15 * index} '
+                  f'nodes {nodes} nps {nodes * 1000 // max(1, elapsed)} time {elapsed} pv {" ".join(line)}', flush=True)
+
+        remaining = delay if movetime is None else min(delay, movetime - (time.monotonic() - start))
+        try:
+            command = commands.get(timeout=max(0, remaining))
+            if command == 'isready':
+                print('readyok', flush=True)
+            elif command in ['stop', 'quit']:
+                quit = command == 'quit'
+                break
+            else:
+                deferred.append(command)
+        except queue.Empty:
+            pass
+        if movetime is not None and time.monotonic() - start >= movetime:
+            break
+
+    ponder = f' ponder {lines[0][1]}' if len(lines[0]) > 1 else ''
+    print(f'bestmove {lines[0][0]}{ponder}', flush=True)
+    return quit
+
+def main():
+    captures, default_capture = load_captures()
+    delay = float(os.getenv('REPLAY_EVAL_DELAY', '0'))
+    search_delay = float(os.getenv('REPLAY_SEARCH_DELAY', '0.01'))
+    capture = default_capture
+    board = chess.Board()
+    multipv = 1
+
+    commands = queue.Queue()
+    deferred = deque()
+    threading.Thread(target=read_commands, args=(commands,), daemon=True).start()
+    while True:
+        command = deferred.popleft() if deferred else commands.get()
+        if command == 'uci':
+            print('id name ReplayEngine\nuciok', flush=True)
+        elif command == 'isready':
+            print('readyok', flush=True)
+        elif command.startswith('setoption name MultiPV value '):
+            multipv = int(command.split()[-1])
+        elif command.startswith('position'):
+            board = parse_position(command)
+            capture = captures.get(normalize_fen(board.fen()), default_capture)
+        elif command == 'eval':
+            if delay:
+                time.sleep(delay)
+            print(capture, flush=True)
+        elif command.startswith('go'):
+            if search(board, command, multipv, commands, deferred, search_delay):
+                return
+        elif command == 'quit':
+            return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+Measures recall@k and query latency of the concepts search as the concepts file grows.
+
+    python benchmarks/retrieval_eval.py [--sizes 39,1000,5000] [--queries 200] [--k 5] [--offline]
+
+Every size is data/ChessConcepts.md plus generated distractor concepts built
+from the same vocabulary with random labels. Each query targets one real
+concept: a few words of it, one of its phases and one of its labels, as
+ConceptsRepository.search receives them. A hit means that concept is in the
+top k. --offline embeds with a hashing bag of words instead of the Chroma
+default model, for machines that can't download it.
+"""
+import argparse
+import hashlib
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'src'))
+
+from bm25 import tokenize
+from concepts_index import ConceptsIndex, PHASES
+from concepts_repository import ConceptsRepository
+
+CONCEPTS_PATH = os.path.join(BENCHMARKS_DIR, '..', 'data', 'ChessConcepts.md')
+LABELS = ['Piece activity', 'Plans', 'Pawn structure', 'Threats', 'Material', 'King\'s safety', 'Space']
+
+class HashingEmbedding:
+    """
+    Bag of words hashed into a fixed number of dimensions, L2 normalized.
+    """
+    def __init__(self, dimensions=512):
+        self.dimensions = dimensions
+
+    def __call__(self, input):
+        embeddings = []
+        for text in input:
+            vector = [0.0] * self.dimensions
+            for token in re.findall(r'[a-z0-9]+', text.lower()):
+                vector[int(hashlib.md5(token.encode()).hexdigest(), 16) % self.dimensions] += 1
+            norm = sum(value * value for value in vector) ** 0.5 or 1
+            embeddings.append([value / norm for value in vector])
+        return embeddings
+
+    def embed_query(self, input):
+        return self(input)
+
+    @staticmethod
+    def name():
+        return 'hashing-bag-of-words'
+
+    def get_config(self):
+        return {'dimensions': self.dimensions}
+
+    @staticmethod
+    def build_from_config(config):
+        return HashingEmbedding(config['dimensions'])
+
+    def is_legacy(self):
+        return False
+
+def write_concepts(path, base_concepts, size, rng):
+    vocabulary = sorted({token for concept in base_concepts
+                         for token in tokenize(f"{concept['title']} {concept['content']}")})
+
+    with open(path, 'w') as f:
+        for concept in base_concepts:
+            f.write(f"## {concept['title']}\n{concept['content']}\n- **Labels:** {concept['labels']}\n\n")
+
+        for number in range(size - len(base_concepts)):
+            title = ' '.join(rng.sample(vocabulary, 5)).capitalize()
+            content = ' '.join(rng.sample(vocabulary, 35)).capitalize() + '.'
+            tags = rng.sample(PHASES, rng.randint(1, 2)) + rng.sample(LABELS, rng.randint(1, 3))
+            f.write(f"## {title} {number}\n{content}\n- **Labels:** {', '.join(tags)}\n\n")
+
+def build_queries(base_concepts, count, rng):
+    queries = []
+    for _ in range(count):
+        concept = rng.choice(base_concepts)
+        tags = [tag.strip() for tag in concept['labels'].split(',')]
+        phases = [tag for tag in tags if tag in PHASES] or PHASES
+        labels = [tag for tag in tags if tag not in PHASES] or ['General analysis']
+        words = tokenize(f"{concept['title']} {concept['content']}")
+        keywords = rng.sample(words, min(3, len(words)))
+        queries.append((concept['id'], rng.choice(phases), rng.choice(labels), keywords))
+    return queries
+
+def vector_only(repository, phase, aspect, keywords, k):
+    """
+    The search before the tag filters and BM25: one query over the whole collection.
+    """
+    query_result = repository.concept_collection.query(
+        query_texts=[' '.join(keywords + [phase, aspect])],
+        n_results=k,
+        include=[]
+    )
+    return query_result['ids'][0]
+
+def filtered_vector(repository, phase, aspect, keywords, k):
+    candidates = repository.candidates(phase, aspect)
+    return repository.vector_ranking(' '.join(keywords + [phase, aspect]), candidates)[:k]
+
+def hybrid(repository, phase, aspect, keywords, k):
+    return repository.search_ids(phase, aspect, keywords, k)
+
+def evaluate(method, repository, queries, k):
+    hits = 0
+    latencies = []
+    for target, phase, aspect, keywords in queries:
+        start = time.perf_counter()
+        ids = method(repository, phase, aspect, keywords, k)
+        latencies.append(time.perf_counter() - start)
+        hits += target in ids
+
+    latencies.sort()
+    return (hits / len(queries),
+            statistics.median(latencies) * 1000,
+            latencies[int(0.95 * (len(latencies) - 1))] * 1000)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default='39,1000,5000')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--offline', action='store_true')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    embedding_function = HashingEmbedding() if args.offline else None
+    base_concepts = ConceptsIndex(CONCEPTS_PATH).read_concepts()
+    queries = build_queries(base_concepts, args.queries, rng)
+    methods = [('vector', vector_only), ('filtered', filtered_vector), ('hybrid', hybrid)]
+
+    print(f'{"concepts":>8} {"method":>9} {f"recall@{args.k}":>9} {"p50 ms":>8} {"p95 ms":>8}')
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in [int(size) for size in args.sizes.split(',')]:
+            concepts_path = os.path.join(workdir, f'concepts_{size}.md')
+            write_concepts(concepts_path, base_concepts, max(size, len(base_concepts)), rng)
+            repository = ConceptsRepository(concepts_path, os.path.join(workdir, f'index_{size}'),
+                                            embedding_function)
+
+            for name, method in methods:
+                recall, p50, p95 = evaluate(method, repository, queries, args.k)
+                print(f'{len(repository.documents):>8} {name:>9} {recall:>9.3f} {p50:>8.2f} {p95:>8.2f}')
+
+if __name__ == '__main__':
+    main()
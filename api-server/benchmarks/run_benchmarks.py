@@ -0,0 +1,503 @@
+"""
+Runs the benchmark suite of the analysis pipeline and writes the results to JSON.
+
+    python benchmarks/run_benchmarks.py [--stockfish PATH] [--output results.json]
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<commit>.json
+
+The positions are the fixed corpus in corpus.json, openings, middlegames and
+endgames as compute_game_phase labels them. Without --stockfish the engine is
+replay_engine.py, which answers eval with the saved captures in traces/, so
+the parse, prompt and serving numbers can be compared between commits on any
+machine. Engine numbers only mean something with a StockfishTraces build.
+The run stops before measuring anything if TraceParser differs from the
+golden files or, with --stockfish, from the reference analysis of the traces
+the build gives for the corpus positions.
+
+The suite measures:
+    engine.startup          starting a StockfishEngine until it is ready
+    engine.eval.<phase>     eval of the corpus positions on a warm engine
+    parse.<stage>           each section of TraceParser and each parse_* of the legacy parser
+    board.<stage>           the pawn features and attack maps of board_features.py
+    cache.<stage>           packing analyses for the analysis cache and reading them back,
+                            next to the JSON they were stored as before, and a memory hit
+    prompt.<stage>          the board, phase, keywords and prompt building of every aspect,
+                            with the estimated tokens of the prompt context next to the raw dicts
+    end_to_end.<stage>      /analyze under concurrency, served by uvicorn with the stub
+                            completions server, split by the Server-Timing stages
+
+Results go to benchmarks/results/<commit>.json unless --output is given. With
+--compare, the p50 of every benchmark is printed next to the one of the baseline.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCHMARKS_DIR, '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+# The prompt benchmarks import the app, which must not reach OpenAI or build the concepts index
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ['USE_RAG'] = 'False'
+
+import chess
+from board_features import BoardFeatures
+from position import Position
+from analysis_cache import AnalysisCache
+from engine_pool import StockfishEngine
+from trace_parser import TraceParser
+from legacy_parser import LegacyTraceParser
+from parse_benchmark import load_captures, check_golden, check_engine
+from packed_analysis import pack_analysis, unpack_analysis
+from packed_benchmark import parse_traces, size_stats
+from stub_openai_server import ChatCompletionsHandler
+
+CORPUS_PATH = os.path.join(BENCHMARKS_DIR, 'corpus.json')
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+REPLAY_ENGINE = os.path.join(BENCHMARKS_DIR, 'replay_engine.py')
+
+SECTIONS = ['material', 'pawn_structure', 'king_safety', 'pieces_activity', 'threats', 'space']
+
+def load_corpus():
+    with open(CORPUS_PATH) as f:
+        return json.load(f)
+
+def check_phases(corpus):
+    """
+    Returns the corpus positions whose label no longer matches compute_game_phase.
+    """
+    from position_analyzer import PositionAnalyzer
+    analyzer = PositionAnalyzer(None)
+    return [position['name'] for position in corpus
+            if analyzer.compute_game_phase(chess.Board(position['fen'])) != position['phase']]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(samples):
+    """
+    Returns the statistics of a list of durations in seconds, in milliseconds.
+    """
+    return {
+        'runs': len(samples),
+        'mean_ms': round(statistics.mean(samples) * 1000, 4),
+        'p50_ms': round(statistics.median(samples) * 1000, 4),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 4),
+        'min_ms': round(min(samples) * 1000, 4)
+    }
+
+def measure(function, arguments, repeat):
+    """
+    Calls the function once with each tuple of arguments, repeat times, and returns the durations.
+    """
+    samples = []
+    for _ in range(repeat):
+        for args in arguments:
+            start = time.perf_counter()
+            function(*args)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+def engine_benchmarks(engine_path, corpus, args):
+    results = {}
+
+    samples = []
+    for _ in range(args.engine_starts):
+        engine = StockfishEngine(engine_path, args.timeout)
+        start = time.perf_counter()
+        engine.start()
+        samples.append(time.perf_counter() - start)
+        engine.stop()
+    results['engine.startup'] = summarize(samples)
+
+    engine = StockfishEngine(engine_path, args.timeout)
+    engine.start()
+    try:
+        all_samples = []
+        for phase in ['Opening', 'Middlegame', 'Endgame']:
+            fens = [(position['fen'],) for position in corpus if position['phase'] == phase]
+            samples = measure(engine.evaluate, fens, args.eval_repeat)
+            results[f'engine.eval.{phase.lower()}'] = summarize(samples)
+            all_samples += samples
+        results['engine.eval'] = summarize(all_samples)
+    finally:
+        engine.stop()
+
+    return results
+
+def parse_benchmarks(captures, args):
+    results = {}
+    raw_infos = [(raw_info,) for _, _, raw_info, _ in captures]
+    with_board = [(raw_info, chess.Board(fen)) for _, fen, raw_info, _ in captures]
+
+    results['parse.total'] = summarize(
+        measure(lambda raw_info, board: TraceParser().parse(raw_info, board).to_dict(), with_board, args.repeat))
+    results['parse.tokenize'] = summarize(
+        measure(lambda raw_info, board: TraceParser().parse(raw_info, board), with_board, args.repeat))
+
+    traces = [(TraceParser().parse(raw_info, board),) for raw_info, board in with_board]
+    for section in SECTIONS:
+        results[f'parse.{section}'] = summarize(
+            measure(lambda trace: getattr(trace, f'{section}_dict')(), traces, args.repeat))
+
+    legacy = LegacyTraceParser()
+    with_fen = [(raw_info, fen) for _, fen, raw_info, _ in captures]
+    with_king_safety = [(raw_info, legacy.parse_king_safety(raw_info, fen)) for raw_info, fen in with_fen]
+    legacy_stages = [
+        ('parse_material', legacy.parse_material, raw_infos),
+        ('parse_pawn_structure', legacy.parse_pawn_structure, raw_infos),
+        ('parse_king_safety', legacy.parse_king_safety, with_fen),
+        ('parse_pieces_activity', legacy.parse_pieces_activity, raw_infos),
+        ('parse_threads', legacy.parse_threads, with_king_safety),
+        ('parse_space', legacy.parse_space, raw_infos),
+        ('parse_evaluation', legacy.parse_evaluation, with_fen)
+    ]
+    for name, method, arguments in legacy_stages:
+        results[f'parse.legacy.{name}'] = summarize(measure(method, arguments, args.repeat))
+
+    return results
+
+def board_benchmarks(corpus, args):
+    boards = [(chess.Board(position['fen']),) for position in corpus]
+
+    def pawn_features(board):
+        features = BoardFeatures(board)
+        for color in [chess.WHITE, chess.BLACK]:
+            features.passed_pawns(color)
+            features.isolated_pawns(color)
+            features.doubled_pawns(color)
+            features.backward_pawns(color)
+            features.islands(color)
+            features.phalanxes(color)
+            features.half_open_files(color)
+        features.open_files()
+
+    def attack_maps(board):
+        features = BoardFeatures(board)
+        for color in [chess.WHITE, chess.BLACK]:
+            features.attacks(color)
+            features.pawn_attacks(color)
+
+    return {
+        'board.pawn_features': summarize(measure(pawn_features, boards, args.repeat)),
+        'board.attack_maps': summarize(measure(attack_maps, boards, args.repeat))
+    }
+
+def cache_benchmarks(captures, args):
+    traces = [(trace,) for _, trace, _ in parse_traces(captures)]
+    analyses = [(trace.to_dict(),) for trace, in traces]
+    serialized = [(json.dumps(analysis, separators=(',', ':')),) for analysis, in analyses]
+    packed = [(pack_analysis(trace),) for trace, in traces]
+
+    # Memory hits of analyses hit before, served from their decoded dicts
+    cache = AnalysisCache()
+    positions = [(Position.parse(fen),) for _, fen, _, _ in captures]
+    for (position,), (data,) in zip(positions, packed):
+        cache.put(position, data)
+        cache.get(position)
+
+    return {
+        'cache.pack': summarize(measure(pack_analysis, traces, args.repeat)),
+        'cache.unpack': summarize(measure(unpack_analysis, packed, args.repeat)),
+        'cache.json_dumps': summarize(
+            measure(lambda analysis: json.dumps(analysis, separators=(',', ':')), analyses, args.repeat)),
+        'cache.json_loads': summarize(measure(json.loads, serialized, args.repeat)),
+        'cache.memory_hit': summarize(measure(cache.get, positions, args.repeat))
+    }
+
+def prompt_benchmarks(captures, args):
+    import app
+
+    results = {}
+    # The position is parsed once per request, before these run
+    results['prompt.parse_position'] = summarize(
+        measure(Position.parse, [(fen,) for _, fen, _, _ in captures], args.repeat))
+    boards = [(chess.Board(fen),) for _, fen, _, _ in captures]
+    results['prompt.piece_locations'] = summarize(
+        measure(app.analyzer.get_piece_locations, boards, args.repeat))
+    results['prompt.game_phase'] = summarize(
+        measure(app.analyzer.compute_game_phase, boards, args.repeat))
+
+    inputs = [(aspect, app.analyzer.get_piece_locations(chess.Board(fen)), analysis)
+              for _, fen, _, analysis in captures for aspect in app.aspects]
+    results['prompt.keywords'] = summarize(
+        measure(lambda aspect, _, analysis: app.concept_extractor.extract_keywords(analysis, aspect),
+                inputs, args.repeat))
+    results['prompt.build'] = summarize(
+        measure(lambda aspect, piece_locations, analysis: app.build_prompt(aspect, piece_locations, analysis, None),
+                inputs, args.repeat))
+
+    return results
+
+def prompt_size(captures):
+    """
+    Returns the mean estimated tokens of the prompt context of each aspect, compacted and as raw dicts.
+    """
+    import app
+    from prompt_compiler import estimate_tokens
+
+    sizes = {}
+    for aspect in app.aspects:
+        compacted = []
+        raw = []
+        for _, fen, _, analysis in captures:
+            piece_locations = app.analyzer.get_piece_locations(chess.Board(fen))
+            compacted.append(app.compiler.compile(aspect, piece_locations, app.get_relevant_sections(analysis, aspect))[1])
+            raw.append(estimate_tokens(f'Piece Locations:\n{piece_locations}\n'
+                                       f'Pre-analysis:\n{app.get_relevant_pre_analysis(analysis, aspect)}'))
+        sizes[aspect] = {'tokens': round(statistics.mean(compacted), 1), 'uncompacted_tokens': round(statistics.mean(raw), 1)}
+    return sizes
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_until_up(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with urllib.request.urlopen(f'{url}/metrics', timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def send_request(url, aspect, fen, timeout):
+    query = urllib.parse.urlencode({'aspect': aspect, 'fen': fen})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(f'{url}/analyze?{query}', timeout=timeout) as response:
+            ok = 'answer' in json.loads(response.read())
+            timing = response.headers.get('Server-Timing', '')
+    except Exception:
+        ok, timing = False, ''
+    return ok, time.perf_counter() - start, timing
+
+def parse_server_timing(header):
+    stages = {}
+    for entry in filter(None, (entry.strip() for entry in header.split(','))):
+        stage, _, duration = entry.partition(';dur=')
+        stages[stage] = float(duration) / 1000
+    return stages
+
+def end_to_end_benchmark(engine_path, corpus, args):
+    """
+    Serves the app with uvicorn as the Dockerfile does, with both caches
+    disabled so every request runs the whole pipeline.
+    """
+    ChatCompletionsHandler.latency = args.latency
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), ChatCompletionsHandler)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    env = {
+        **os.environ,
+        'STOCKFISH_PATH': engine_path,
+        'STOCKFISH_POOL_SIZE': str(args.pool_size),
+        'STOCKFISH_TIMEOUT': str(args.timeout),
+        # Every request comes from one address, none of them should be turned away
+        'ENGINE_QUEUE_SIZE': str(args.concurrency),
+        'ENGINE_CLIENT_QUEUE_SIZE': str(args.concurrency),
+        'ENGINE_QUEUE_DEADLINE': '0',
+        'LLM_BASE_URL': f'http://127.0.0.1:{stub.server_address[1]}/v1',
+        'OPENAI_API_KEY': 'benchmark',
+        'CHATGPT_VERSION': 'benchmark',
+        'USE_RAG': 'False',
+        'ANALYSIS_CACHE_MB': '0',
+        'ANALYSIS_CACHE_PATH': '',
+        'RESPONSE_CACHE_MB': '0',
+        'RESPONSE_CACHE_PATH': '',
+        'SERVER_TIMING': 'True',
+        'EXECUTOR_THREADS': str(args.threads)
+    }
+    command = [sys.executable, '-m', 'uvicorn', '--host', '127.0.0.1', '--port', str(port), 'app:app']
+
+    with tempfile.TemporaryFile(mode='w+') as log:
+        server = subprocess.Popen(command, cwd=SRC_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            if not wait_until_up(url, server):
+                log.seek(0)
+                raise RuntimeError(f'The api-server did not start:\n{log.read()[-2000:]}')
+
+            fens = [position['fen'] for position in corpus]
+            # Starts the engines of the pool before the measured requests
+            with ThreadPoolExecutor(args.pool_size) as executor:
+                list(executor.map(lambda fen: send_request(url, args.aspect, fen, args.timeout * 4),
+                                  fens[:args.pool_size]))
+
+            jobs = [fens[i % len(fens)] for i in range(args.requests)]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as executor:
+                responses = list(executor.map(lambda fen: send_request(url, args.aspect, fen, args.timeout * 4),
+                                              jobs))
+            elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+            stub.shutdown()
+
+    latencies = [latency for ok, latency, _ in responses if ok]
+    stages = {}
+    for ok, _, timing in responses:
+        if ok:
+            for stage, seconds in parse_server_timing(timing).items():
+                stages.setdefault(stage, []).append(seconds)
+
+    results = {f'end_to_end.{stage}': summarize(samples) for stage, samples in stages.items()}
+    if latencies:
+        results['end_to_end.request'] = summarize(latencies)
+    summary = {
+        'requests': len(responses),
+        'errors': len(responses) - len(latencies),
+        'concurrency': args.concurrency,
+        'threads': args.threads,
+        'pool_size': args.pool_size,
+        'completion_latency_s': args.latency,
+        'throughput_rps': round(len(latencies) / elapsed, 2)
+    }
+    return results, summary
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--', '..'], cwd=BENCHMARKS_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return f'{commit}-dirty' if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def print_results(results):
+    print(f'{"benchmark":<36} {"runs":>6} {"mean ms":>10} {"p50 ms":>10} {"p95 ms":>10}')
+    for name, stats in results['benchmarks'].items():
+        print(f'{name:<36} {stats["runs"]:>6} {stats["mean_ms"]:>10.4f} {stats["p50_ms"]:>10.4f} '
+              f'{stats["p95_ms"]:>10.4f}')
+    if 'analysis_size' in results:
+        sizes = results['analysis_size']
+        print(f'Cached analysis: {sizes["json_bytes"]} B JSON, {sizes["packed_bytes"]} B packed, '
+              f'{sizes["dict_memory"]} B of memory as a dict, {sizes["packed_memory"]} B packed')
+    if 'prompt_size' in results:
+        for aspect, sizes in results['prompt_size'].items():
+            print(f'Prompt context, {aspect}: {sizes["tokens"]} tokens, {sizes["uncompacted_tokens"]} uncompacted')
+    if 'end_to_end' in results:
+        summary = results['end_to_end']
+        print(f'/analyze: {summary["throughput_rps"]} req/s, {summary["errors"]} errors '
+              f'in {summary["requests"]} requests, concurrency {summary["concurrency"]}')
+
+def print_comparison(baseline, results):
+    print(f'\nCompared with {baseline["commit"]}, p50:')
+    print(f'{"benchmark":<36} {"baseline ms":>12} {"current ms":>12} {"change":>8}')
+    for name, stats in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        before = baseline['benchmarks'][name]['p50_ms']
+        change = f'{(stats["p50_ms"] - before) / before * 100:+.1f}%' if before else 'n/a'
+        print(f'{name:<36} {before:>12.4f} {stats["p50_ms"]:>12.4f} {change:>8}')
+    if 'end_to_end' in results and 'end_to_end' in baseline:
+        print(f'{"throughput req/s":<36} {baseline["end_to_end"]["throughput_rps"]:>12.2f} '
+              f'{results["end_to_end"]["throughput_rps"]:>12.2f}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--stockfish', help='StockfishTraces binary, the replay engine by default')
+    parser.add_argument('--repeat', type=int, default=200, help='passes over the captures of the parse and prompt benchmarks')
+    parser.add_argument('--copies', type=int, default=500, help='copies of each analysis to measure memory on')
+    parser.add_argument('--engine-starts', type=int, default=5)
+    parser.add_argument('--eval-repeat', type=int, default=5, help='passes over the corpus of the eval benchmark')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--aspect', default='General analysis')
+    parser.add_argument('--requests', type=int, default=128)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=32, help='threads of the server for the blocking stages')
+    parser.add_argument('--pool-size', type=int, default=2, help='STOCKFISH_POOL_SIZE of the server')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds the stub takes per completion')
+    parser.add_argument('--skip-end-to-end', action='store_true')
+    parser.add_argument('--output')
+    parser.add_argument('--compare', help='results file to compare with')
+    args = parser.parse_args()
+
+    engine_path = os.path.abspath(args.stockfish) if args.stockfish else REPLAY_ENGINE
+    corpus = load_corpus()
+    captures = load_captures()
+
+    # Numbers of a parser that reads the traces wrong mean nothing, so these checks stop the run
+    golden_failures = check_golden(captures)
+    if golden_failures:
+        print(f'TraceParser output differs from the golden files: {", ".join(golden_failures)}', file=sys.stderr)
+        sys.exit(1)
+    if args.stockfish:
+        engine_failures = check_engine(engine_path, [(position['name'], position['fen']) for position in corpus],
+                                       args.timeout)
+        if engine_failures:
+            print(f'TraceParser output differs on the traces of {engine_path}: {", ".join(engine_failures)}',
+                  file=sys.stderr)
+            sys.exit(1)
+
+    mislabeled = check_phases(corpus)
+    if mislabeled:
+        print(f'compute_game_phase disagrees with the corpus labels of: {", ".join(mislabeled)}', file=sys.stderr)
+
+    phases = {}
+    for position in corpus:
+        phases[position['phase']] = phases.get(position['phase'], 0) + 1
+
+    results = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'engine': 'replay' if not args.stockfish else engine_path,
+        'settings': vars(args),
+        'corpus': {'positions': len(corpus), 'phases': phases, 'mislabeled': mislabeled},
+        'benchmarks': {}
+    }
+
+    print('Engine...', file=sys.stderr)
+    results['benchmarks'].update(engine_benchmarks(engine_path, corpus, args))
+    print('Parser...', file=sys.stderr)
+    results['benchmarks'].update(parse_benchmarks(captures, args))
+    print('Board features...', file=sys.stderr)
+    results['benchmarks'].update(board_benchmarks(corpus, args))
+    print('Analysis cache...', file=sys.stderr)
+    results['benchmarks'].update(cache_benchmarks(captures, args))
+    results['analysis_size'] = size_stats(parse_traces(captures), args.copies)
+    print('Prompt...', file=sys.stderr)
+    results['benchmarks'].update(prompt_benchmarks(captures, args))
+    results['prompt_size'] = prompt_size(captures)
+    if not args.skip_end_to_end:
+        print('End to end...', file=sys.stderr)
+        end_to_end, summary = end_to_end_benchmark(engine_path, corpus, args)
+        results['benchmarks'].update(end_to_end)
+        results['end_to_end'] = summary
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{results["commit"]}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+    print(f'\nResults written to {output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+A stand-in for the OpenAI chat completions API with a configurable response delay.
+
+    python benchmarks/stub_openai_server.py [--port 8020] [--latency 0.8] [--jitter 0.2]
+                                            [--token-delay 0.02] [--error-rate 0.05]
+
+Point the api-server at it with LLM_BASE_URL=http://localhost:8020/v1 to
+load test the serving path without paying for, or waiting on, real completions.
+Streamed answers come a word at a time, token-delay seconds apart, and a share
+of the requests fail with a 503 to exercise the retries of the backend.
+"""
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = ('White has a **space advantage** on the kingside and the more active pieces. '
+          'Black should look for counterplay against the isolated pawn.')
+KEYWORDS = 'space advantage, piece activity, isolated pawn, open file, king safety'
+
+class ChatCompletionsHandler(BaseHTTPRequestHandler):
+    latency = 0.8
+    jitter = 0.0
+    token_delay = 0.0
+    error_rate = 0.0
+
+    def do_POST(self):
+        if not self.path.endswith('/chat/completions'):
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length))
+        prompt = body['messages'][-1]['content']
+        answer = KEYWORDS if 'Extract a set of' in prompt else ANSWER
+
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate:
+            self.send_error(503, 'Overloaded')
+            return
+        if body.get('stream'):
+            self.send_stream(body['model'], answer)
+        else:
+            self.send_completion(body['model'], answer)
+
+    def send_completion(self, model, answer):
+        payload = json.dumps({
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': answer},
+                'finish_reason': 'stop'
+            }]
+        }).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_stream(self, model, answer):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+
+        for word in answer.split(' '):
+            chunk = {
+                'id': 'chatcmpl-stub',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': f'{word} '}, 'finish_reason': None}]
+            }
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            self.wfile.flush()
+            time.sleep(self.token_delay)
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--port', type=int, default=8020)
+    parser.add_argument('--latency', type=float, default=0.8,
+                        help='seconds to wait before answering each completion')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='up to this many seconds more or less per completion, at random')
+    parser.add_argument('--token-delay', type=float, default=0.0,
+                        help='seconds between the words of a streamed answer')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of the completions answered with a 503')
+    args = parser.parse_args()
+
+    ChatCompletionsHandler.latency = args.latency
+    ChatCompletionsHandler.jitter = args.jitter
+    ChatCompletionsHandler.token_delay = args.token_delay
+    ChatCompletionsHandler.error_rate = args.error_rate
+    server = ThreadingHTTPServer(('0.0.0.0', args.port), ChatCompletionsHandler)
+    print(f'Stub chat completions on http://localhost:{args.port}/v1, {args.latency}s per answer')
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
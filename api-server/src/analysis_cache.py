@@ -0,0 +1,170 @@
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from packed_analysis import deserialize_analysis
+
+# Analyses kept decoded, the most recently hit ones, about 16 KB each
+DECODED_SIZE = 256
+
+class AnalysisCache:
+    """
+    Bounded LRU cache of parsed analyses of Positions, kept in memory by
+    their Zobrist key and in the SQLite store by their normalized FEN.
+    Analyses are kept serialized, as returned by serialize_analysis, so
+    entries are evicted by the size they really take. The dicts of the
+    analyses hit last are kept too, a hit on them is served without decoding.
+    The dicts are shared and must not be changed. An optional SQLite file
+    keeps the analyses across restarts and shares them between workers.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, db_path=None, decoded_size=DECODED_SIZE):
+        self.max_bytes = max_bytes
+        self.db_path = db_path
+        self.decoded_size = decoded_size
+        self.entries = OrderedDict()
+        self.decoded = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        if db_path:
+            self.create_table()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def create_table(self):
+        connection = self.connection()
+        with connection:
+            # Locks the file so only one worker migrates it
+            connection.execute('BEGIN IMMEDIATE')
+            columns = {row[1]: row[2] for row in connection.execute('PRAGMA table_info(analyses)')}
+            # Files written before analyses were packed declare the column TEXT, their rows move to the BLOB one
+            migrate = columns.get('analysis') == 'TEXT'
+            if migrate:
+                connection.execute('ALTER TABLE analyses RENAME TO analyses_text')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS analyses ('
+                'fen TEXT PRIMARY KEY, analysis BLOB NOT NULL)'
+            )
+            if migrate:
+                connection.execute('INSERT INTO analyses (fen, analysis) SELECT fen, analysis FROM analyses_text')
+                connection.execute('DROP TABLE analyses_text')
+
+    def get(self, position):
+        key = position.key
+        with self.lock:
+            serialized = None
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                if key in self.decoded:
+                    self.decoded.move_to_end(key)
+                    return self.decoded[key]
+                serialized = self.entries[key][0]
+
+        if serialized is not None:
+            # Decoded outside the lock, the other hits don't wait for it
+            analysis = deserialize_analysis(serialized)
+            with self.lock:
+                if key in self.entries:
+                    self.keep_decoded(key, analysis)
+            return analysis
+
+        serialized = self.load(position.normalized_fen)
+        if serialized is None:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.disk_hits += 1
+            self.store(key, serialized)
+        return deserialize_analysis(serialized)
+
+    def contains(self, position):
+        """
+        Whether the analysis is in memory, the SQLite store is not checked.
+        """
+        with self.lock:
+            return position.key in self.entries
+
+    def put(self, position, serialized):
+        """
+        Stores an analysis serialized with serialize_analysis.
+        """
+        with self.lock:
+            self.store(position.key, serialized)
+        self.save(position.normalized_fen, serialized)
+
+    def store(self, key, serialized):
+        size = sys.getsizeof(serialized)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.current_bytes -= self.entries.pop(key)[1]
+            self.decoded.pop(key, None)
+
+        self.entries[key] = (serialized, size)
+        self.current_bytes += size
+
+        while self.current_bytes > self.max_bytes:
+            evicted, (_, evicted_size) = self.entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.decoded.pop(evicted, None)
+
+    def keep_decoded(self, key, analysis):
+        self.decoded[key] = analysis
+        self.decoded.move_to_end(key)
+        while len(self.decoded) > self.decoded_size:
+            self.decoded.popitem(last=False)
+
+    def load(self, fen):
+        if not self.db_path:
+            return None
+
+        row = self.connection().execute(
+            'SELECT analysis FROM analyses WHERE fen = ?', (fen,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save(self, fen, serialized):
+        if not self.db_path:
+            return
+
+        with self.connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO analyses (fen, analysis) VALUES (?, ?)',
+                (fen, serialized)
+            )
+
+    def stored_keys(self):
+        """
+        Returns the normalized FEN of every analysis in the SQLite store.
+        """
+        if not self.db_path:
+            return set()
+
+        return {row[0] for row in self.connection().execute('SELECT fen FROM analyses')}
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'decoded': len(self.decoded),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes
+            }
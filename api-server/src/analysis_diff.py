@@ -0,0 +1,26 @@
+def analysis_changes(before, after):
+    """
+    Returns what changed between two parsed analyses, None when nothing did.
+    Sections and fields are compared recursively and only the changed ones are
+    kept. Lists of squares give the squares added and removed, any other
+    changed value gives its value before and after.
+    """
+    if isinstance(before, dict) and isinstance(after, dict):
+        changes = {}
+        for key in list(before) + [key for key in after if key not in before]:
+            change = analysis_changes(before.get(key), after.get(key))
+            if change is not None:
+                changes[key] = change
+        return changes or None
+
+    if before == after:
+        return None
+    if is_flat_list(before) and is_flat_list(after):
+        added = [item for item in after if item not in before]
+        removed = [item for item in before if item not in after]
+        # The same squares in another order are no change
+        return {'added': added, 'removed': removed} if added or removed else None
+    return {'before': before, 'after': after}
+
+def is_flat_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
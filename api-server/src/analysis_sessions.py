@@ -0,0 +1,118 @@
+import asyncio
+import contextvars
+from metrics import registry
+
+cancellations_total = registry.counter('chess_assistant_analyses_cancelled_total',
+                                       'Analyses stopped before they finished, by cause.', 'cause')
+
+class Superseded(Exception):
+    """
+    The analysis was cancelled by its session, or replaced by a newer one.
+    """
+
+async def next_event(events):
+    return await events.__anext__()
+
+class SessionRun:
+    def __init__(self):
+        # The task running the analysis, for streams the one running the current step
+        self.task = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+class AnalysisSessions:
+    """
+    The analysis in flight for each client session. Starting another one in
+    the same session, or cancelling the session, cancels it wherever it is:
+    waiting for an engine, or reading the completion, which closes the
+    connection to the model so it stops generating.
+    The coroutines must all run on the same event loop.
+    """
+    def __init__(self):
+        self.runs = {}
+
+    async def run(self, session, coroutine):
+        """
+        Awaits the coroutine as the current analysis of the session.
+        Raises Superseded when it is cancelled before it finishes.
+        """
+        if session is None:
+            return await coroutine
+
+        run = self.start(session)
+        # Its own task, so cancelling the analysis leaves the request awaiting it running
+        run.task = asyncio.ensure_future(coroutine)
+        try:
+            return await run.task
+        except asyncio.CancelledError:
+            if run.cancelled and not asyncio.current_task().cancelling():
+                raise Superseded('The analysis was cancelled by its session') from None
+            raise
+        finally:
+            self.finish(session, run)
+
+    async def stream(self, session, events):
+        """
+        Iterates the async generator as the current analysis of the session.
+        Each step runs in its own task, so the run follows the one of the step
+        being awaited. The steps share a context, so variables set by the
+        generator persist.
+        """
+        if session is None:
+            try:
+                async for event in events:
+                    yield event
+            finally:
+                await events.aclose()
+            return
+
+        run = self.start(session)
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        try:
+            while True:
+                if run.cancelled:
+                    raise Superseded('The analysis was cancelled by its session')
+                run.task = loop.create_task(next_event(events), context=context)
+                try:
+                    event = await run.task
+                except StopAsyncIteration:
+                    return
+                except asyncio.CancelledError:
+                    if run.cancelled and not asyncio.current_task().cancelling():
+                        raise Superseded('The analysis was cancelled by its session') from None
+                    raise
+                finally:
+                    run.task = None
+                yield event
+        finally:
+            self.finish(session, run)
+            await events.aclose()
+
+    async def cancel(self, session):
+        """
+        Cancels the analysis in flight for the session. Returns whether there was one.
+        """
+        return self.stop(session, 'cancelled')
+
+    def start(self, session):
+        self.stop(session, 'superseded')
+        run = SessionRun()
+        self.runs[session] = run
+        return run
+
+    def stop(self, session, cause):
+        run = self.runs.pop(session, None)
+        if run is None:
+            return False
+        run.cancel()
+        cancellations_total.inc(cause)
+        return True
+
+    def finish(self, session, run):
+        if self.runs.get(session) is run:
+            del self.runs[session]
@@ -0,0 +1,99 @@
+import os
+import sqlite3
+import threading
+
+class AnswerTable:
+    """
+    Read-only store of answers precomputed for the most requested positions,
+    one per aspect, written by precompute_answers.py. The answers were made
+    for one model and prompt version, a table made for others is not served.
+    """
+    def __init__(self, db_path, model, prompt_version):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.answers = 0
+        self.enabled = bool(db_path) and os.path.exists(db_path)
+
+        if self.enabled:
+            version = self.version()
+            if version != (model or '', prompt_version):
+                print(f'Answer table {db_path} was made for {version}, not for {(model or "", prompt_version)}. '
+                      f'It will not be used until it is precomputed again.')
+                self.enabled = False
+            else:
+                self.answers = self.connection().execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+            self.local.connection = connection
+        return connection
+
+    def version(self):
+        rows = dict(self.connection().execute('SELECT name, value FROM settings'))
+        return rows.get('model'), rows.get('prompt_version')
+
+    def get(self, position, aspect):
+        """
+        Returns the precomputed answer of the aspect for the Position, or None.
+        """
+        if not self.enabled:
+            return None
+
+        row = self.connection().execute(
+            'SELECT answer FROM answers WHERE position = ? AND aspect = ?', (position.key, aspect)
+        ).fetchone()
+        # Counters are approximate across threads, they are only reported
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'answers': self.answers,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+class AnswerTableWriter:
+    """
+    Writes the store AnswerTable reads. Answers of an older model or prompt
+    version are dropped when the table is opened.
+    """
+    def __init__(self, db_path, model, prompt_version):
+        # Written from the event loop's thread, one answer at a time
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS answers ('
+                'position INTEGER NOT NULL, aspect TEXT NOT NULL, fen TEXT NOT NULL, answer TEXT NOT NULL, '
+                'PRIMARY KEY (position, aspect)) WITHOUT ROWID'
+            )
+            settings = dict(self.connection.execute('SELECT name, value FROM settings'))
+            if (settings.get('model'), settings.get('prompt_version')) != (model or '', prompt_version):
+                self.connection.execute('DELETE FROM answers')
+            self.connection.executemany('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)',
+                                        [('model', model or ''), ('prompt_version', prompt_version)])
+
+    def stored_keys(self):
+        """
+        Returns the (position, aspect) pairs already answered.
+        """
+        return set(self.connection.execute('SELECT position, aspect FROM answers'))
+
+    def put(self, position, aspect, answer):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO answers (position, aspect, fen, answer) VALUES (?, ?, ?, ?)',
+                (position.key, aspect, position.fen, answer)
+            )
+
+    def close(self):
+        self.connection.close()
@@ -1,62 +1,689 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from openai import OpenAI
+from quart import Quart, Response, request, jsonify
+from quart_cors import cors
 import os
+import json
+import asyncio
+import hashlib
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from functools import cache
 from dotenv import load_dotenv
 from position_analyzer import PositionAnalyzer
+from remote_engines import RemoteEnginePool
+from analysis_cache import AnalysisCache
+from response_cache import ResponseCache, response_key
+from answer_table import AnswerTable
 from concepts_repository import ConceptsRepository
+from concept_extractor import ConceptExtractor
+from game_positions import positions_from_pgn, positions_from_fens, group_positions
+from position import Position, InvalidPosition
+from engine_scheduler import EngineScheduler, EngineBusy, client_requests
+from analysis_sessions import AnalysisSessions, Superseded
+from llm_backend import ChatCompletionsBackend
+from prompt_compiler import PromptCompiler, parse_budgets
+import prompt_compiler
+from metrics import registry, timed, request_spans, request_timings, server_timing
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 load_dotenv()
 
 allowed_ip = os.getenv('ALLOWED_IP', '127.0.0.1')
-cors = CORS(app, resources={r"/*": {"origins": f"http://{allowed_ip}"}})
+app = cors(app, allow_origin=f'http://{allowed_ip}')
 
 stockfish_path = os.getenv('STOCKFISH_PATH')
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+stockfish_pool_size = int(os.getenv('STOCKFISH_POOL_SIZE', '1'))
+stockfish_timeout = float(os.getenv('STOCKFISH_TIMEOUT', '10'))
+# Engine workers to send the engine work to, comma separated URLs, instead of local engines.
+# STOCKFISH_POOL_SIZE is then the number of analyses this server runs on them at once
+engine_workers = [url.strip() for url in os.getenv('ENGINE_WORKERS', '').split(',') if url.strip()]
+engine_health_interval = float(os.getenv('ENGINE_HEALTH_INTERVAL', '5'))
+engine_queue_size = int(os.getenv('ENGINE_QUEUE_SIZE', str(os.cpu_count())))
+engine_client_queue_size = int(os.getenv('ENGINE_CLIENT_QUEUE_SIZE', str(max(1, engine_queue_size // 2))))
+# Seconds an analysis may wait for an engine, 0 to wait as long as it takes
+engine_queue_deadline = float(os.getenv('ENGINE_QUEUE_DEADLINE', '10'))
+search_threads = int(os.getenv('SEARCH_THREADS', '1'))
+search_hash_mb = int(os.getenv('SEARCH_HASH_MB', '16'))
+search_depth = int(os.getenv('SEARCH_DEPTH', '18'))
+search_max_depth = int(os.getenv('SEARCH_MAX_DEPTH', '30'))
+# Milliseconds, no search runs longer whatever its depth
+search_max_movetime = int(os.getenv('SEARCH_MAX_MOVETIME', '10000'))
+search_max_multipv = int(os.getenv('SEARCH_MAX_MULTIPV', '5'))
+analysis_cache_mb = int(os.getenv('ANALYSIS_CACHE_MB', '64'))
+analysis_cache_path = os.getenv('ANALYSIS_CACHE_PATH')
+response_cache_mb = int(os.getenv('RESPONSE_CACHE_MB', '16'))
+response_cache_ttl = int(os.getenv('RESPONSE_CACHE_TTL', '86400'))
+response_cache_path = os.getenv('RESPONSE_CACHE_PATH')
+# Answers precomputed by precompute_answers.py for the most requested positions
+answer_table_path = os.getenv('ANSWER_TABLE_PATH')
 chatgpt_version = os.getenv('CHATGPT_VERSION')
+keywords_model = os.getenv('KEYWORDS_MODEL', 'gpt-4o-mini')
+# Any server speaking the OpenAI chat completions API, OpenAI itself when unset
+llm_base_url = os.getenv('LLM_BASE_URL') or None
+llm_timeout = float(os.getenv('LLM_TIMEOUT', '60'))
+llm_connect_timeout = float(os.getenv('LLM_CONNECT_TIMEOUT', '5'))
+llm_max_retries = int(os.getenv('LLM_MAX_RETRIES', '2'))
+llm_max_connections = int(os.getenv('LLM_MAX_CONNECTIONS', '100'))
+llm = ChatCompletionsBackend(os.getenv('OPENAI_API_KEY'), chatgpt_version, llm_base_url, llm_timeout,
+                             llm_connect_timeout, llm_max_retries, llm_max_connections)
 use_rag = os.getenv('USE_RAG', 'False').lower() == 'true'
+# local, llm, or auto to ask the LLM only when the local extractor finds nothing
+keyword_extractor = os.getenv('KEYWORD_EXTRACTOR', 'local').lower()
+batch_max_positions = int(os.getenv('BATCH_MAX_POSITIONS', '300'))
+# Model answers a batch asks for at the same time
+batch_llm_concurrency = int(os.getenv('BATCH_LLM_CONCURRENCY', '8'))
+server_timing_enabled = os.getenv('SERVER_TIMING', 'False').lower() == 'true'
+# Threads of the event loop for the blocking stages, the engine analyses wait for a free engine in them
+executor_threads = int(os.getenv('EXECUTOR_THREADS', '32'))
+# Estimated tokens of the position context in a prompt, for the aspects without their own budget
+prompt_token_budget = int(os.getenv('PROMPT_TOKEN_BUDGET', '500'))
+# Budgets of single aspects, as 'aspect=tokens' pairs separated by commas
+prompt_token_budgets = parse_budgets(os.getenv('PROMPT_TOKEN_BUDGETS', 'General analysis=1000,Plans=1000'))
 
-analyzer = PositionAnalyzer(stockfish_path)
+aspects = ['General analysis', 'Material', 'Pawn structure', 'King\'s safety',
+           'Piece activity', 'Threats', 'Space', 'Plans']
+# The analysis sections each aspect reads, the other aspects need all of them
+aspect_sections = {
+    'Material': ['Material'],
+    'Pawn structure': ['Pawn Structure'],
+    'King\'s safety': ['King Safety'],
+    'Piece activity': ['Pieces Activity'],
+    'Threats': ['Threads'],
+    'Space': ['Space']
+}
+
+analysis_cache = AnalysisCache(analysis_cache_mb * 1024 * 1024, analysis_cache_path)
+response_cache = ResponseCache(response_cache_mb * 1024 * 1024, response_cache_ttl, response_cache_path)
+remote_engines = (RemoteEnginePool(engine_workers, stockfish_timeout, health_interval=engine_health_interval)
+                  if engine_workers else None)
+analyzer = PositionAnalyzer(stockfish_path, stockfish_pool_size, stockfish_timeout, analysis_cache,
+                            search_threads, search_hash_mb, remote_engines)
 repository = ConceptsRepository() if use_rag else None
+concept_extractor = ConceptExtractor()
+engine_scheduler = EngineScheduler(stockfish_pool_size, engine_queue_size, engine_client_queue_size,
+                                   engine_queue_deadline or None)
+analysis_sessions = AnalysisSessions()
+compiler = PromptCompiler(prompt_token_budget, prompt_token_budgets)
+
+def collect_metrics():
+    analysis = analysis_cache.stats()
+    responses = response_cache.stats()
+    answers = precomputed_answers().stats()
+    return [
+        ('chess_assistant_cache_hits_total', 'Cache hits by cache and tier.', 'counter', [
+            ({'cache': 'analysis', 'tier': 'memory'}, analysis['hits']),
+            ({'cache': 'analysis', 'tier': 'disk'}, analysis['disk_hits']),
+            ({'cache': 'responses', 'tier': 'memory'}, responses['hits']),
+            ({'cache': 'responses', 'tier': 'disk'}, responses['disk_hits']),
+            ({'cache': 'responses', 'tier': 'coalesced'}, responses['coalesced']),
+            ({'cache': 'answer_table', 'tier': 'disk'}, answers['hits'])
+        ]),
+        ('chess_assistant_cache_misses_total', 'Cache misses by cache.', 'counter', [
+            ({'cache': 'analysis'}, analysis['misses']),
+            ({'cache': 'responses'}, responses['misses']),
+            ({'cache': 'answer_table'}, answers['misses'])
+        ]),
+        ('chess_assistant_engine_restarts_total', 'Stockfish engines restarted after a crash or hang.', 'counter', [
+            ({}, analyzer.engine_pool.restarts)
+        ]),
+        ('chess_assistant_engine_queue_depth', 'Engine analyses waiting for a free engine.', 'gauge', [
+            ({}, engine_scheduler.depth)
+        ]),
+        ('chess_assistant_engine_running', 'Engine analyses running.', 'gauge', [
+            ({}, engine_scheduler.running)
+        ])
+    ] + (worker_metrics() if remote_engines else [])
+
+def worker_metrics():
+    workers = remote_engines.stats()
+    return [
+        ('chess_assistant_engine_worker_healthy', 'Whether the engine worker answered its last health check.', 'gauge', [
+            ({'worker': worker['url']}, int(worker['healthy'])) for worker in workers
+        ]),
+        ('chess_assistant_engine_worker_load', 'Busy engines of the worker over its engines, by every api-server.', 'gauge', [
+            ({'worker': worker['url']}, worker['load']) for worker in workers
+        ])
+    ]
+
+registry.collect(collect_metrics)
+
+@app.before_serving
+async def start_executor():
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(executor_threads))
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats', methods=['GET'])
+async def cache_stats():
+    return jsonify({
+        'analysis': analysis_cache.stats(),
+        'responses': response_cache.stats(),
+        'answer_table': precomputed_answers().stats()
+    })
+
 @app.route('/analyze', methods=['GET'])
-def analyze():    
+async def analyze():    
+    """
+    Answers the aspect of the position. With moves, the comma separated UCI
+    moves played from fen, the start of the game, the position is the one
+    they reach and the answer also covers what the last move changed.
+    """
     aspect = request.args.get('aspect')
     fen = request.args.get('fen')
+    moves = request_moves()
+    session = session_key(request.args.get('session'))
 
     try:
-        if not aspect or not fen:
-            return jsonify({'error': 'Not enough parameters. question and fen are required'}), 400
-
-        if aspect not in ['General analysis', 'Material', 'Pawn structure', 'King\'s safety',
-                        'Piece activity', 'Threats', 'Space', 'Plans']:
-            return jsonify({'error': 'Wrong value for aspect parameter'}), 400
+        error = validate_parameters(aspect, fen)
+        if error:
+            return error
+        position, error = request_position(fen, moves)
+        if error:
+            return error
         
-        if analyzer.is_initial_position(fen):
+        if position.is_initial():
             return jsonify({'answer': 'Please, set a position on the board'})
         
-        pre_analysis = analyzer.analyze(fen)
-        if(pre_analysis == ''):
-            return jsonify({'answer': default_no_analysis_answer()})
-
-        phase = analyzer.compute_game_phase(fen)
-        keywords = extract_keywords(pre_analysis, aspect)
-        concepts = repository.search(phase, aspect, keywords) if use_rag else None
-        prompt = build_prompt(aspect, fen, pre_analysis, concepts)
-                
-        response = ask_chatgpt(prompt)
+        with request_spans() as timings, client_requests(request.remote_addr):
+            with timed('total'):
+                answer = (precomputed_answer(aspect, position) or
+                          await analysis_sessions.run(session, answer_question(aspect, position)))
+
+        response = jsonify({'answer': answer})
         response.headers.add('Access-Control-Allow-Origin', '*')
+        if server_timing_enabled:
+            response.headers['Server-Timing'] = server_timing(timings)
+            # Lets the web client read the timings from another origin
+            response.headers['Timing-Allow-Origin'] = '*'
         return response
+    except EngineBusy as e:
+        return busy_response(e)
+    except Superseded as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         print(str(e))
         return jsonify({'error': 'An internal server error has occurred. Please try again later.'}), 500
 
-def build_prompt(aspect, fen, pre_analysis, concepts):
-    piece_locations = analyzer.get_piece_locations(fen)
-    prompt = (
-            f"Piece Locations:\n{piece_locations}\n"
-            f"Pre-analysis:\n{get_relevant_pre_analysis(pre_analysis, aspect)}\n\n"
+@app.route('/analyze/stream', methods=['GET'])
+async def analyze_stream():
+    """
+    Same analysis as /analyze, sent as Server-Sent Events. Progress events
+    for each stage come first, then the answer tokens as the model writes them.
+    """
+    aspect = request.args.get('aspect')
+    fen = request.args.get('fen')
+    moves = request_moves()
+    session = session_key(request.args.get('session'))
+
+    error = validate_parameters(aspect, fen)
+    if error:
+        return error
+    position, error = request_position(fen, moves)
+    if error:
+        return error
+    client = request.remote_addr
+
+    async def generate():
+        try:
+            if position.is_initial():
+                yield sse_event('token', {'token': 'Please, set a position on the board'})
+                yield sse_event('done', {})
+                return
+
+            answer = precomputed_answer(aspect, position)
+            if answer is not None:
+                yield sse_event('token', {'token': answer})
+                yield sse_event('done', {})
+                return
+
+            with request_spans(), client_requests(client):
+                with timed('total'):
+                    async with aclosing(analysis_sessions.stream(session, analysis_events(aspect, position))) as events:
+                        async for event in events:
+                            yield event
+        except EngineBusy as e:
+            yield sse_event('error', {'error': str(e), 'retry_after': e.retry_after})
+        except Superseded as e:
+            yield sse_event('cancelled', {'error': str(e)})
+        except Exception as e:
+            print(str(e))
+            yield sse_event('error', {'error': 'An internal server error has occurred. Please try again later.'})
+
+    return event_stream_response(generate())
+
+@app.route('/analyze/cancel', methods=['POST'])
+async def analyze_cancel():
+    """
+    Cancels the analysis in flight for the session, if any. Starting a new
+    analysis in a session already cancels the previous one.
+    """
+    session = session_key(request.args.get('session'))
+    if not session:
+        return jsonify({'error': 'Not enough parameters. session is required'}), 400
+
+    cancelled = await analysis_sessions.cancel(session)
+    response = jsonify({'cancelled': cancelled})
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+@app.route('/search/stream', methods=['GET'])
+async def search_stream():
+    """
+    Searches the position with the engine and sends what it finds as
+    Server-Sent Events: an info event for every principal variation it
+    reports, then the best move. fen is the root of the game and moves the
+    UCI moves played since, comma separated, so consecutive positions of a
+    game reuse the hash table of the engine. depth or movetime, in
+    milliseconds, limit the search and multipv sets the number of lines.
+    """
+    fen = request.args.get('fen')
+    moves = request_moves()
+    depth = request.args.get('depth', type=int)
+    movetime = request.args.get('movetime', type=int)
+    multipv = request.args.get('multipv', 1, type=int)
+
+    position, error = request_position(fen, moves)
+    if error:
+        return error
+    error = validate_search_parameters(depth, movetime, multipv)
+    if error:
+        return error
+    if depth is None and movetime is None:
+        depth = search_depth
+    client = request.remote_addr
+    session = session_key(request.args.get('session'))
+
+    async def generate():
+        try:
+            with client_requests(client):
+                async with aclosing(analysis_sessions.stream(
+                        session, search_events(position, depth, movetime, multipv))) as events:
+                    async for event in events:
+                        yield event
+        except EngineBusy as e:
+            yield sse_event('error', {'error': str(e), 'retry_after': e.retry_after})
+        except Superseded as e:
+            yield sse_event('cancelled', {'error': str(e)})
+        except Exception as e:
+            print(str(e))
+            yield sse_event('error', {'error': 'An internal server error has occurred. Please try again later.'})
+
+    return event_stream_response(generate())
+
+@app.route('/analyze/step', methods=['GET'])
+async def analyze_step():
+    """
+    Analyzes the position reached by the moves, comma separated UCI, played
+    from fen, the start of the game, and returns it with what changed since
+    the position before the last move. aspect limits the analysis to the
+    sections it reads. Meant for stepping through a game one move at a time.
+    """
+    aspect = request.args.get('aspect')
+    fen = request.args.get('fen')
+    moves = request_moves()
+
+    position, error = request_position(fen, moves)
+    if error:
+        return error
+    if not moves:
+        return jsonify({'error': 'Not enough parameters. moves is required'}), 400
+    if aspect is not None and aspect not in aspects:
+        return jsonify({'error': 'Wrong value for aspect parameter'}), 400
+
+    try:
+        with client_requests(request.remote_addr):
+            step = await analyze_game_step(position, aspect_sections.get(aspect))
+
+        response = jsonify(step)
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response
+    except EngineBusy as e:
+        return busy_response(e)
+    except Exception as e:
+        print(str(e))
+        return jsonify({'error': 'An internal server error has occurred. Please try again later.'}), 500
+
+@app.route('/analyze/batch', methods=['POST'])
+async def analyze_batch():
+    """
+    Analyzes every position of a PGN game or of a list of FENs, sent as JSON
+    {"pgn": ...} or {"fens": [...]} with an optional aspect to also get answers.
+    Results are sent as Server-Sent Events, one per position, as they complete.
+    """
+    body = await request.get_json(silent=True) or {}
+    aspect = body.get('aspect')
+
+    try:
+        if body.get('pgn'):
+            positions = positions_from_pgn(body['pgn'])
+        elif isinstance(body.get('fens'), list):
+            positions = positions_from_fens(body['fens'])
+        else:
+            return jsonify({'error': 'Not enough parameters. pgn or fens are required'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if aspect is not None and aspect not in aspects:
+        return jsonify({'error': 'Wrong value for aspect parameter'}), 400
+    if not positions:
+        return jsonify({'error': 'There are no positions to analyze'}), 400
+    if len(positions) > batch_max_positions:
+        return jsonify({'error': f'Too many positions, the limit is {batch_max_positions}'}), 400
+
+    client = request.remote_addr
+
+    async def generate():
+        try:
+            with client_requests(client):
+                async with aclosing(batch_events(positions, aspect)) as events:
+                    async for event in events:
+                        yield event
+        except Exception as e:
+            print(str(e))
+            yield sse_event('error', {'error': 'An internal server error has occurred. Please try again later.'})
+
+    return event_stream_response(generate())
+
+def validate_parameters(aspect, fen):
+    if not aspect or not fen:
+        return jsonify({'error': 'Not enough parameters. question and fen are required'}), 400
+
+    if aspect not in aspects:
+        return jsonify({'error': 'Wrong value for aspect parameter'}), 400
+
+    return None
+
+def request_position(fen, moves):
+    """
+    Parses the position of the request, the one every stage then works on.
+    Returns it and None, or None and the response for a wrong fen or moves.
+    """
+    if not fen:
+        return None, (jsonify({'error': 'Not enough parameters. fen is required'}), 400)
+
+    try:
+        return Position.parse(fen, moves), None
+    except InvalidPosition as e:
+        return None, (jsonify({'error': str(e)}), 400)
+
+def validate_search_parameters(depth, movetime, multipv):
+    if depth is not None and not 1 <= depth <= search_max_depth:
+        return jsonify({'error': f'Wrong value for depth parameter, it must be between 1 and {search_max_depth}'}), 400
+    if movetime is not None and not 1 <= movetime <= search_max_movetime:
+        return jsonify({'error': f'Wrong value for movetime parameter, it must be between 1 and {search_max_movetime}'}), 400
+    if not 1 <= multipv <= search_max_multipv:
+        return jsonify({'error': f'Wrong value for multipv parameter, it must be between 1 and {search_max_multipv}'}), 400
+
+    return None
+
+def request_moves():
+    return [move for move in request.args.get('moves', '').split(',') if move]
+
+def session_key(session):
+    """
+    Session ids are chosen by the clients, so they are scoped by address and
+    a client can only cancel its own analyses.
+    """
+    return f'{request.remote_addr} {session}' if session else None
+
+def busy_response(error):
+    response = jsonify({'error': str(error)})
+    response.status_code = error.status
+    response.headers['Retry-After'] = str(error.retry_after)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+def event_stream_response(events):
+    response = Response(events, mimetype='text/event-stream')
+    # A batch streams for as long as its positions take, past the default response timeout
+    response.timeout = None
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keeps reverse proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+def sse_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+def precomputed_answer(aspect, position):
+    """
+    The answer of the answer table, looked up before the engine or the model
+    are involved. None for game steps, their answers depend on the last move.
+    """
+    if position.moves:
+        return None
+    # A primary key read, on the loop it costs less than the wait for a thread of the pool
+    with timed('answer_table'):
+        return precomputed_answers().get(position, aspect)
+
+@cache
+def precomputed_answers():
+    """
+    Opened on first use, the table is only served for the current prompt version.
+    """
+    return AnswerTable(answer_table_path, chatgpt_version, prompt_version())
+
+async def answer_question(aspect, position):
+    async def create_answer():
+        pre_analysis, piece_locations, phase, last_move = await analyze_board(position, aspect)
+        return await answer_from_analysis(aspect, pre_analysis, piece_locations, phase, last_move)
+
+    return await response_cache.get_or_create(answer_key(aspect, position), create_answer)
+
+async def answer_from_analysis(aspect, pre_analysis, piece_locations, phase, last_move=None):
+    if(pre_analysis == ''):
+        return default_no_analysis_answer()
+
+    concepts = await retrieve_concepts(aspect, phase, pre_analysis)
+    prompt = request_prompt(aspect, piece_locations, pre_analysis, concepts, last_move)
+    return await ask_chatgpt(prompt)
+
+async def analysis_events(aspect, position):
+    key = answer_key(aspect, position)
+    answer = await response_cache.claim(key)
+    if answer is not None:
+        yield sse_event('token', {'token': answer})
+        yield sse_event('done', done_event_data())
+        return
+
+    tokens = []
+    try:
+        async for event, data in answer_events(aspect, position):
+            if event == 'token':
+                tokens.append(data['token'])
+            yield sse_event(event, data)
+    except BaseException:
+        response_cache.fail(key)
+        raise
+
+    await response_cache.finish(key, ''.join(tokens))
+    yield sse_event('done', done_event_data())
+
+async def search_events(position, depth, movetime, multipv):
+    async for event, data in engine_scheduler.stream(analyzer.search, position, depth, movetime, multipv,
+                                                     search_max_movetime):
+        yield sse_event(event, data)
+    yield sse_event('done', {})
+
+def done_event_data():
+    """
+    Headers are gone by the end of a stream, so its timings travel in the done event.
+    """
+    timings = request_timings.get()
+    if not server_timing_enabled or timings is None:
+        return {}
+    return {'server_timing': server_timing(timings)}
+
+async def answer_events(aspect, position):
+    sections = aspect_sections.get(aspect)
+    yield 'progress', {'stage': 'engine' if analyzer.needs_engine(sections) else 'board'}
+    pre_analysis, piece_locations, phase, last_move = await analyze_board(position, aspect)
+    if(pre_analysis == ''):
+        yield 'token', {'token': default_no_analysis_answer()}
+        return
+
+    if use_rag:
+        yield 'progress', {'stage': 'concepts'}
+    concepts = await retrieve_concepts(aspect, phase, pre_analysis)
+    prompt = request_prompt(aspect, piece_locations, pre_analysis, concepts, last_move)
+
+    yield 'progress', {'stage': 'answer'}
+    async for token in stream_chatgpt(prompt):
+        yield 'token', {'token': token}
+
+def answer_key(aspect, position):
+    # The concepts of the prompt depend on the game phase, which reads the move number the FEN key drops
+    phase = analyzer.compute_game_phase(position.board) if use_rag else None
+    if not position.moves:
+        return response_key(position.normalized_fen, aspect, chatgpt_version, prompt_version(), phase=phase)
+
+    previous, move = position.previous()
+    return response_key(position.normalized_fen, aspect, chatgpt_version, prompt_version(),
+                        f'{previous.fen} {move.uci()}', phase)
+
+@cache
+def prompt_version():
+    """
+    Hash of the code that builds the prompt and of the settings that change it,
+    so answers cached for an older prompt are never served.
+    """
+    sources = [inspect.getsource(function) for function in
+               [build_prompt, build_question, get_relevant_sections, get_relevant_changes,
+                default_no_analysis_answer, ask_chatgpt]]
+    sources += [inspect.getsource(prompt_compiler)]
+    sources += [str(use_rag), keyword_extractor, str(aspect_sections), str(prompt_token_budget), str(prompt_token_budgets)]
+    return hashlib.sha256('\n'.join(sources).encode()).hexdigest()[:16]
+
+async def batch_events(positions, aspect):
+    groups = group_positions(positions)
+    yield sse_event('progress', {'positions': len(positions), 'unique_positions': len(groups)})
+
+    # One engine per evaluation, more would only park threads of the loop's pool on the checkout
+    engines = asyncio.Semaphore(stockfish_pool_size)
+    # The answers would otherwise all go to the model at once, past the pool and the rate limits
+    answers = asyncio.Semaphore(batch_llm_concurrency)
+    tasks = [asyncio.create_task(analyze_batch_group(group, aspect, engines, answers))
+             for group in groups.values()]
+    try:
+        for task in asyncio.as_completed(tasks):
+            group, result = await task
+            for entry in group:
+                fields = {key: value for key, value in entry.items() if key != 'position'}
+                yield sse_event('position', {**fields, **result})
+        yield sse_event('done', {})
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def analyze_batch_group(group, aspect, engines, answers):
+    position = group[0]['position']
+    try:
+        async with engines:
+            while True:
+                try:
+                    pre_analysis = await analyze_position(position, None)
+                    break
+                except EngineBusy as e:
+                    # Nobody is waiting on a single position of a batch, it waits for room instead
+                    await asyncio.sleep(e.retry_after)
+
+        result = {'analysis': pre_analysis}
+        if aspect:
+            result['answer'] = precomputed_answer(aspect, position)
+            if result['answer'] is None:
+                async with answers:
+                    result['answer'] = await response_cache.get_or_create(
+                        answer_key(aspect, position),
+                        lambda: answer_from_analysis(aspect, pre_analysis,
+                                                     analyzer.get_piece_locations(position.board),
+                                                     analyzer.compute_game_phase(position.board)))
+    except Exception as e:
+        print(str(e))
+        result = {'error': 'This position could not be analyzed.'}
+
+    return group, result
+
+async def analyze_board(position, aspect):
+    """
+    Runs the analysis the aspect needs, the piece locations and the game phase at the same time.
+    For a position reached by moves the last move comes with what it changed, otherwise it is None.
+    The blocking calls go to the loop's thread pool so other requests keep moving.
+    """
+    sections = aspect_sections.get(aspect)
+    analysis, piece_locations, phase = await asyncio.gather(
+        analyze_game_step(position, sections) if position.moves else analyze_position(position, sections),
+        asyncio.to_thread(timed_call, 'board', analyzer.get_piece_locations, position.board),
+        asyncio.to_thread(analyzer.compute_game_phase, position.board)
+    )
+    if not position.moves:
+        return analysis, piece_locations, phase, None
+    return analysis['analysis'], piece_locations, phase, {'move': analysis['move'], 'changes': analysis['changes']}
+
+async def analyze_position(position, sections):
+    """
+    Engine analyses wait for their turn in the scheduler, board sections and
+    analyses already in memory are returned right away.
+    """
+    if analyzer.needs_engine(sections) and not analyzer.is_cached(position):
+        return await engine_scheduler.run(timed_call, 'analysis', analyzer.analyze, position, sections)
+    return await asyncio.to_thread(timed_call, 'analysis', analyzer.analyze, position, sections)
+
+async def analyze_game_step(position, sections):
+    """
+    Like analyze_position, for the last step of a game.
+    """
+    if analyzer.needs_engine(sections) and not analyzer.is_step_cached(position):
+        return await engine_scheduler.run(timed_call, 'analysis', analyzer.analyze_step, position, sections)
+    return await asyncio.to_thread(timed_call, 'analysis', analyzer.analyze_step, position, sections)
+
+def timed_call(stage, function, *args):
+    with timed(stage):
+        return function(*args)
+
+async def retrieve_concepts(aspect, phase, pre_analysis):
+    if not use_rag:
+        return None
+
+    with timed('keywords'):
+        keywords = await find_keywords(pre_analysis, aspect)
+    return await asyncio.to_thread(timed_call, 'concepts', repository.search, phase, aspect, keywords)
+
+async def find_keywords(pre_analysis, aspect):
+    if keyword_extractor == 'llm':
+        return await extract_keywords(pre_analysis, aspect)
+
+    keywords = concept_extractor.extract_keywords(pre_analysis, aspect)
+    if not keywords and keyword_extractor == 'auto':
+        return await extract_keywords(pre_analysis, aspect)
+    return keywords
+
+def request_prompt(aspect, piece_locations, pre_analysis, concepts, last_move=None):
+    """
+    Builds the prompt of a request and logs the tokens of its context.
+    """
+    prompt, tokens, raw_tokens = build_prompt(aspect, piece_locations, pre_analysis, concepts, last_move)
+    print(f'Prompt context for {aspect}: {tokens} tokens, {raw_tokens} uncompacted')
+    return prompt
+
+def build_prompt(aspect, piece_locations, pre_analysis, concepts, last_move=None):
+    """
+    Returns the prompt, the estimated tokens of its position context and the
+    ones the context would take uncompacted.
+    """
+    changes = get_relevant_changes(last_move['changes'], aspect) if last_move else None
+    context, tokens, raw_tokens = compiler.compile(
+        aspect, piece_locations, get_relevant_sections(pre_analysis, aspect),
+        {'move': last_move['move'], 'changes': changes} if changes else None)
+    prompt = f"{context}\n\n"
+
+    if changes:
+        prompt += 'Explain what the last move changed too.\n\n'
+
+    prompt += (
             f'Use markdown format on response.\n'
             f'Don\'t include any board representation.\n'
             f'Don\'t include references to the raw report.\n'
@@ -70,7 +697,7 @@ def build_prompt(aspect, fen, pre_analysis, concepts):
             f'Theese are a list of relevant concepts '
             f'that you can use as context:\n{concepts}')
         
-    return prompt
+    return prompt, tokens, raw_tokens
 
 def default_no_analysis_answer():
     return (f'The present position has a clear advantage '
@@ -85,19 +712,22 @@ def build_question(aspect):
     else:
         return f'Make an analysis of the {aspect} of the position.'
 
-def ask_chatgpt(prompt):
-    response = client.chat.completions.create(
-        model=chatgpt_version,
-        messages=[
+async def ask_chatgpt(prompt):
+    with timed('completion'):
+        return await llm.complete([
             {"role": "system", "content": "You are a helpful chess assistant."},
             {"role": "user", "content": prompt}
-        ]
-    )
+        ])
 
-    answer = response.choices[0].message.content
-    return jsonify({'answer': answer})
+async def stream_chatgpt(prompt):
+    with timed('completion'):
+        async for text in llm.stream([
+            {"role": "system", "content": "You are a helpful chess assistant."},
+            {"role": "user", "content": prompt}
+        ]):
+            yield text
 
-def extract_keywords(pre_analysis, aspect):
+async def extract_keywords(pre_analysis, aspect):
     pre_analysis = get_relevant_pre_analysis(pre_analysis, aspect)
     if isinstance(pre_analysis, dict):
         text_content = " ".join(str(value) for value in pre_analysis.values())
@@ -109,16 +739,26 @@ def extract_keywords(pre_analysis, aspect):
               f'The keywords should be write in only one line, splits by comas.\n\n'
               f'{text_content}')
     
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "user", "content": prompt}
-        ]
-    )
-
-    answer = response.choices[0].message.content
+    answer = await llm.complete([{"role": "user", "content": prompt}], keywords_model)
     return answer.split(',')
 
+def get_relevant_sections(pre_analysis, aspect):
+    """
+    The analysis sections the aspect reads, by name.
+    """
+    sections = aspect_sections.get(aspect)
+    if sections is None:
+        return pre_analysis
+    return {section: pre_analysis[section] for section in sections}
+
+def get_relevant_changes(changes, aspect):
+    if not changes:
+        return None
+    sections = aspect_sections.get(aspect)
+    if sections is None:
+        return changes
+    return {section: changes[section] for section in sections if section in changes} or None
+
 def get_relevant_pre_analysis(pre_analysis, aspect):
     match aspect:
         case 'Material':
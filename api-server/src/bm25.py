@@ -0,0 +1,57 @@
+import math
+import re
+from collections import Counter
+
+TOKEN = re.compile(r'[a-z0-9]+')
+STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'for', 'from', 'have',
+    'if', 'in', 'into', 'is', 'it', 'its', 'more', 'of', 'on', 'or', 'such', 'that', 'the',
+    'their', 'them', 'there', 'these', 'they', 'this', 'to', 'was', 'when', 'which', 'while',
+    'will', 'with', 'you', 'your'
+}
+
+def tokenize(text):
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOP_WORDS]
+
+class BM25Index:
+    """
+    Okapi BM25 over a fixed set of documents. Only the postings of the query
+    terms are visited, so scoring a small candidate set stays cheap as the
+    number of documents grows.
+    """
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.lengths = {}
+
+        for doc_id, text in documents.items():
+            tokens = tokenize(text)
+            self.lengths[doc_id] = len(tokens)
+            for term, count in Counter(tokens).items():
+                self.postings.setdefault(term, {})[doc_id] = count
+
+        self.average_length = sum(self.lengths.values()) / max(len(self.lengths), 1)
+        total = len(self.lengths)
+        self.idf = {
+            term: math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    def scores(self, query, candidates=None):
+        scores = {}
+        for term in set(tokenize(query)):
+            for doc_id, count in self.postings.get(term, {}).items():
+                if candidates is not None and doc_id not in candidates:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / self.average_length)
+                scores[doc_id] = scores.get(doc_id, 0) + self.idf[term] * count * (self.k1 + 1) / (count + norm)
+        return scores
+
+    def rank(self, query, candidates=None, limit=None):
+        """
+        Returns the ids of the matching documents, best first.
+        """
+        scores = self.scores(query, candidates)
+        ranking = sorted(scores, key=scores.get, reverse=True)
+        return ranking[:limit] if limit else ranking
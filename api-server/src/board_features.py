@@ -0,0 +1,221 @@
+import functools
+import chess
+
+SIDES = {chess.WHITE: 'White', chess.BLACK: 'Black'}
+
+ADJACENT_FILES = [
+    (chess.BB_FILES[file - 1] if file > 0 else 0) | (chess.BB_FILES[file + 1] if file < 7 else 0)
+    for file in range(8)
+]
+
+# Ranks strictly ahead of each rank, from the point of view of each color
+FORWARD_RANKS = {
+    chess.WHITE: [chess.BB_ALL & ~((1 << (8 * (rank + 1))) - 1) for rank in range(8)],
+    chess.BLACK: [(1 << (8 * rank)) - 1 for rank in range(8)]
+}
+
+def pawn_attacks(color, pawns):
+    """
+    Returns the mask of the squares attacked by the pawns in the mask.
+    """
+    if color == chess.WHITE:
+        return ((pawns & ~chess.BB_FILE_A) << 7 | (pawns & ~chess.BB_FILE_H) << 9) & chess.BB_ALL
+    return (pawns & ~chess.BB_FILE_A) >> 9 | (pawns & ~chess.BB_FILE_H) >> 7
+
+def north_fill(mask):
+    mask |= mask << 8
+    mask |= mask << 16
+    mask |= mask << 32
+    return mask & chess.BB_ALL
+
+def south_fill(mask):
+    mask |= mask >> 8
+    mask |= mask >> 16
+    mask |= mask >> 32
+    return mask
+
+def sideways(mask):
+    """
+    Returns the mask shifted one file to each side.
+    """
+    return (mask & ~chess.BB_FILE_A) >> 1 | (mask & ~chess.BB_FILE_H) << 1
+
+def square_names(mask):
+    return [chess.square_name(square) for square in chess.SquareSet(mask)]
+
+def pawn_feature(method):
+    """
+    Keeps the result of a feature that only depends on the pawns, it is shared
+    by the positions after moves that leave the pawns in place.
+    """
+    @functools.wraps(method)
+    def cached(self, *args):
+        key = (method.__name__,) + args
+        if key not in self.pawn_cache:
+            self.pawn_cache[key] = method(self, *args)
+        return self.pawn_cache[key]
+    return cached
+
+class BoardFeatures:
+    """
+    Pawn structure, open files and attack maps of a position, computed from
+    the bitboards of a chess.Board. Nothing here needs the engine.
+    Squares are returned as SquareSets, which iterate from a1 to h8.
+    """
+    def __init__(self, board):
+        self.board = board
+        self.pawns = {color: board.pieces_mask(chess.PAWN, color) for color in SIDES}
+        self.pawn_cache = {}
+
+    def push(self, move):
+        """
+        Returns the features of the position after the move. Pawn features
+        already computed are reused when the move did not change the pawns.
+        """
+        board = self.board.copy(stack=False)
+        board.push(move)
+        features = BoardFeatures(board)
+        if features.pawns == self.pawns:
+            features.pawn_cache = self.pawn_cache
+        return features
+
+    @pawn_feature
+    def passed_pawns(self, color):
+        """
+        Pawns with no enemy pawn ahead of them on their file or the adjacent ones.
+        """
+        # The squares behind the enemy pawns, on their file and the adjacent ones, as seen from each color
+        if color == chess.WHITE:
+            span = south_fill(self.pawns[chess.BLACK]) >> 8
+        else:
+            span = north_fill(self.pawns[chess.WHITE]) << 8 & chess.BB_ALL
+        return chess.SquareSet(self.pawns[color] & ~(span | sideways(span)))
+
+    def passed_pawn_details(self, square):
+        """
+        Returns the squares the pawn is from promotion, the distance of the enemy
+        king to it, None without an enemy king, and whether a piece stands in front of it.
+        """
+        color = self.board.color_at(square)
+        rank = chess.square_rank(square)
+        stop = square + 8 if color == chess.WHITE else square - 8
+        king = self.board.king(not color)
+        return (
+            7 - rank if color == chess.WHITE else rank,
+            chess.square_distance(king, square) if king is not None else None,
+            0 <= stop < 64 and self.board.piece_at(stop) is not None
+        )
+
+    @pawn_feature
+    def isolated_pawns(self, color):
+        our_pawns = self.pawns[color]
+        files = north_fill(south_fill(our_pawns))
+        return chess.SquareSet(our_pawns & ~sideways(files))
+
+    @pawn_feature
+    def doubled_pawns(self, color):
+        """
+        Every pawn that shares its file with another pawn of its color.
+        """
+        our_pawns = self.pawns[color]
+        doubled = 0
+        for file_mask in chess.BB_FILES:
+            if chess.popcount(our_pawns & file_mask) > 1:
+                doubled |= our_pawns & file_mask
+        return chess.SquareSet(doubled)
+
+    @pawn_feature
+    def backward_pawns(self, color):
+        """
+        Pawns that are not isolated, have no pawn of their color beside or behind
+        them on the adjacent files, and can't advance safely: the square in front
+        is held or attacked by an enemy pawn. The Stockfish definition.
+        """
+        our_pawns = self.pawns[color]
+        their_pawns = self.pawns[not color]
+        backward = 0
+        for square in chess.SquareSet(our_pawns):
+            rank = chess.square_rank(square)
+            neighbours = our_pawns & ADJACENT_FILES[chess.square_file(square)]
+            if not neighbours or rank in (0, 7):
+                continue
+
+            stop = square + 8 if color == chess.WHITE else square - 8
+            # Ranks behind the stop square are the pawn's own rank and the ones behind it
+            if neighbours & ~FORWARD_RANKS[color][rank]:
+                continue
+            if their_pawns & (chess.BB_SQUARES[stop] | pawn_attacks(color, chess.BB_SQUARES[stop])):
+                backward |= chess.BB_SQUARES[square]
+        return chess.SquareSet(backward)
+
+    @pawn_feature
+    def islands(self, color):
+        """
+        Groups of pawns on adjacent files, from the a file to the h file.
+        """
+        islands = []
+        current = 0
+        for file_mask in chess.BB_FILES:
+            pawns = self.pawns[color] & file_mask
+            if pawns:
+                current |= pawns
+            elif current:
+                islands.append(chess.SquareSet(current))
+                current = 0
+        if current:
+            islands.append(chess.SquareSet(current))
+        return islands
+
+    @pawn_feature
+    def phalanxes(self, color):
+        """
+        Runs of two or more pawns side by side on the same rank, from the lowest rank up.
+        """
+        phalanxes = []
+        for rank_mask in chess.BB_RANKS:
+            current = 0
+            for square in chess.SquareSet(self.pawns[color] & rank_mask):
+                if current and not current & chess.BB_SQUARES[square - 1]:
+                    if chess.popcount(current) > 1:
+                        phalanxes.append(chess.SquareSet(current))
+                    current = 0
+                current |= chess.BB_SQUARES[square]
+            if chess.popcount(current) > 1:
+                phalanxes.append(chess.SquareSet(current))
+        return phalanxes
+
+    @pawn_feature
+    def open_files(self):
+        all_pawns = self.pawns[chess.WHITE] | self.pawns[chess.BLACK]
+        return [chess.FILE_NAMES[file] for file in range(8) if not all_pawns & chess.BB_FILES[file]]
+
+    @pawn_feature
+    def half_open_files(self, color):
+        """
+        Files without pawns of the color that still hold an enemy pawn.
+        """
+        return [chess.FILE_NAMES[file] for file in range(8)
+                if not self.pawns[color] & chess.BB_FILES[file] and self.pawns[not color] & chess.BB_FILES[file]]
+
+    @pawn_feature
+    def pawn_attacks(self, color):
+        return chess.SquareSet(pawn_attacks(color, self.pawns[color]))
+
+    def attacks(self, color):
+        """
+        Every square attacked by at least one piece of the color.
+        """
+        attacked = 0
+        for square in chess.SquareSet(self.board.occupied_co[color]):
+            attacked |= self.board.attacks_mask(square)
+        return chess.SquareSet(attacked)
+
+    def attack_counts(self, color):
+        """
+        Returns the number of pieces of the color attacking each square, for the attacked squares.
+        """
+        counts = {}
+        for square in chess.SquareSet(self.board.occupied_co[color]):
+            for target in chess.SquareSet(self.board.attacks_mask(square)):
+                counts[target] = counts.get(target, 0) + 1
+        return counts
@@ -0,0 +1,205 @@
+from dataclasses import dataclass
+
+PIECE_VALUES = {'Pawns': 1, 'Knights': 3, 'Bishops': 3, 'Rooks': 5, 'Queens': 9}
+
+# The section of the parsed evaluation each aspect reads, as in get_relevant_pre_analysis
+ASPECT_LABELS = {
+    'Material': 'Material',
+    'Pawn structure': 'Pawn structure',
+    'King\'s safety': 'King\'s safety',
+    'Piece activity': 'Piece activity',
+    'Threats': 'Threats',
+    'Space': 'Space'
+}
+
+SIDES = ['White', 'Black']
+
+@dataclass
+class Concept:
+    keyword: str
+    # One of the aspect tags used in the "- **Labels:**" lines of data/ChessConcepts.md
+    label: str
+    weight: float
+
+class ConceptExtractor:
+    """
+    Maps a parsed evaluation straight to concept keywords for the concepts search,
+    without asking a language model. Every rule reads one section of the
+    analysis and tags its concepts with the Labels vocabulary of ChessConcepts.md.
+    """
+    def __init__(self, max_keywords=5):
+        self.max_keywords = max_keywords
+
+    def extract_keywords(self, pre_analysis, aspect):
+        """
+        Returns the strongest concept keywords found for the aspect followed by their labels.
+        Returns an empty list when the analysis shows nothing worth searching for.
+        """
+        concepts = self.extract_concepts(pre_analysis)
+
+        label = ASPECT_LABELS.get(aspect)
+        if label is not None:
+            concepts = [concept for concept in concepts if concept.label == label]
+
+        concepts.sort(key=lambda concept: concept.weight, reverse=True)
+
+        keywords = []
+        labels = []
+        for concept in concepts:
+            if concept.keyword not in keywords:
+                keywords.append(concept.keyword)
+            if concept.label not in labels:
+                labels.append(concept.label)
+            if len(keywords) == self.max_keywords:
+                break
+
+        return keywords + labels if keywords else []
+
+    def extract_concepts(self, pre_analysis):
+        if not isinstance(pre_analysis, dict):
+            return []
+
+        concepts = []
+        concepts += self.material_concepts(pre_analysis.get('Material') or {})
+        concepts += self.pawn_structure_concepts(pre_analysis.get('Pawn Structure') or {})
+        concepts += self.king_safety_concepts(pre_analysis.get('King Safety') or {})
+        concepts += self.piece_activity_concepts(pre_analysis.get('Pieces Activity') or {})
+        concepts += self.threat_concepts(pre_analysis.get('Threads') or {})
+        concepts += self.space_concepts(pre_analysis.get('Space') or {})
+        return concepts
+
+    def material_concepts(self, material):
+        white = material.get('White material') or {}
+        black = material.get('Black material') or {}
+        if not white or not black:
+            return []
+
+        concepts = []
+        balance = self.material_value(white) - self.material_value(black)
+        if abs(balance) >= 1:
+            concepts.append(Concept('Material advantage', 'Material', 2 + abs(balance)))
+            concepts.append(Concept('Avoid simplifying when down in material', 'Material', 1 + abs(balance)))
+
+        if white.get('Bishops pair') != black.get('Bishops pair'):
+            concepts.append(Concept('Bishop pair', 'Material', 3))
+
+        queens = white.get('Queens', 0) - black.get('Queens', 0)
+        rooks = white.get('Rooks', 0) - black.get('Rooks', 0)
+        if queens * rooks < 0 and abs(rooks) >= 2:
+            concepts.append(Concept('Two rooks vs queen', 'Material', 4))
+
+        if self.material_value(white) - white.get('Pawns', 0) <= 10 and \
+                self.material_value(black) - black.get('Pawns', 0) <= 10:
+            concepts.append(Concept('Endgame technique', 'Material', 1))
+
+        return concepts
+
+    def material_value(self, side_material):
+        return sum(value * (side_material.get(piece) or 0) for piece, value in PIECE_VALUES.items())
+
+    def pawn_structure_concepts(self, pawn_structure):
+        concepts = []
+        for side in SIDES:
+            isolated = pawn_structure.get(f'{side} Isolated Pawns') or []
+            if isolated:
+                concepts.append(Concept('Isolated pawn', 'Pawn structure', 3 + len(isolated)))
+
+            backward = pawn_structure.get(f'{side} Backward Pawns') or []
+            if backward:
+                concepts.append(Concept('Backward pawn', 'Pawn structure', 2 + len(backward) / 2))
+
+            passed = pawn_structure.get(f'{side} Passed Pawns') or {}
+            if passed:
+                concepts.append(Concept('Passed pawn', 'Pawn structure', 4 + len(passed)))
+                concepts.append(Concept('Pawn promotion', 'Pawn structure', 3 + len(passed)))
+
+            islands = pawn_structure.get(f'{side} Pawn Islands') or []
+            if len(islands) >= 3:
+                concepts.append(Concept('Pawn islands', 'Pawn structure', len(islands)))
+
+        return concepts
+
+    def king_safety_concepts(self, king_safety):
+        concepts = []
+        for side in SIDES:
+            safety = king_safety.get(f'{side} King Safety') or {}
+            attacked = safety.get('Attacked Squares') or 0
+            double_attacked = safety.get('Double Attacked Squares') or 0
+            defended = safety.get('Defended Squares') or 0
+
+            if attacked >= 3 or double_attacked > 0 or (attacked and attacked >= defended):
+                concepts.append(Concept('Exposed king', 'King\'s safety', 2 + attacked + 2 * double_attacked))
+
+            checks = [piece for piece in ['Bishop', 'Knight', 'Rook', 'Queen']
+                      if safety.get(f'{piece} Checks', 'None') not in ['None', None]]
+            if checks:
+                concepts.append(Concept('Checks against the king', 'King\'s safety', 2 + len(checks)))
+                concepts.append(Concept('Checkmate patterns', 'King\'s safety', 1 + len(checks)))
+
+        return concepts
+
+    def piece_activity_concepts(self, pieces_activity):
+        concepts = []
+        for side in SIDES:
+            for piece in pieces_activity.get(f'{side} pieces activity') or []:
+                name = piece.get('Piece', '')
+                info = self.piece_info(piece.get('Piece info') or [])
+
+                if 'On (semi-)open column' in info:
+                    concepts.append(Concept('Rooks on open files', 'Piece activity', 4))
+                if 'On long diagonal, sees both center squares' in info:
+                    concepts.append(Concept('Bishop on the long diagonal', 'Piece activity', 3))
+                if 'Pin or discovered attack exists' in info:
+                    concepts.append(Concept('Pins', 'Threats', 4))
+                if 'Bishop' in name and info.get('Pawns on same color squared', 0) >= 4:
+                    concepts.append(Concept('Bad bishop', 'Piece activity', 3))
+                if 'Moveable squares' in info and info['Moveable squares'] <= 1 and \
+                        ('Knight' in name or 'Bishop' in name):
+                    concepts.append(Concept('Trade bad pieces', 'Piece activity', 2))
+                if 'Rook' in name and name.split(' of ')[-1][1:] == ('7' if side == 'White' else '2'):
+                    concepts.append(Concept('Rook on the seventh rank', 'Piece activity', 3))
+
+        return concepts
+
+    def piece_info(self, piece_info):
+        """
+        Turns lines like "Controlled squares: 8" into a dict. Lines without a
+        number, such as "On (semi-)open column", are kept as flags.
+        """
+        info = {}
+        for line in piece_info:
+            name, _, value = line.partition(': ')
+            number = value.split(' ')[0]
+            info[name] = int(number) if number.isdigit() else True
+        return info
+
+    def threat_concepts(self, threats):
+        concepts = []
+        for side in SIDES:
+            side_threats = threats.get(f'{side} threads') or {}
+            knight_targets = side_threats.get('Enemies could be attacked by knights') or []
+            if len(knight_targets) >= 2:
+                concepts.append(Concept('Knight forks', 'Threats', 3 + len(knight_targets)))
+
+            for piece in ['Bishops', 'rooks', 'Queens']:
+                targets = side_threats.get(f'Enemies could be attacked by {piece}') or []
+                if targets:
+                    concepts.append(Concept('Attacks on undefended pieces', 'Threats', 2 + len(targets)))
+                if len(targets) >= 2 and piece != 'Queens':
+                    concepts.append(Concept('Skewers', 'Threats', 1 + len(targets)))
+
+            if any(key.startswith('Possible checks') for key in side_threats):
+                concepts.append(Concept('Tactical opportunities', 'Threats', 3))
+
+        return concepts
+
+    def space_concepts(self, space):
+        white = space.get('White space') or 0
+        black = space.get('Black space') or 0
+        if abs(white - black) < 3:
+            return []
+
+        return [
+            Concept('Space advantage', 'Space', 2 + abs(white - black) / 2),
+            Concept('Control the center', 'Space', 2)
+        ]
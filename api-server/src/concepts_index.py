@@ -0,0 +1,171 @@
+"""
+Builds the on-disk concepts index used by ConceptsRepository.
+
+    python concepts_index.py [--concepts data/ChessConcepts.md] [--index-dir data/concepts_index]
+
+Each version of the index lives in a directory named after the content hash
+of the markdown file. Building is a no-op when the current version exists.
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import chromadb
+from chromadb.config import Settings
+
+CONCEPTS_PATH = 'data/ChessConcepts.md'
+INDEX_DIR = 'data/concepts_index'
+COLLECTION_NAME = 'chess-concepts'
+MANIFEST_NAME = 'concepts.json'
+HASH_LENGTH = 16
+# Bump when the stored documents or metadata change, so existing indexes get rebuilt
+INDEX_FORMAT = 2
+PHASES = ['Opening', 'Middlegame', 'Endgame']
+# Chroma limits how many records a single add call takes
+ADD_BATCH_SIZE = 1000
+
+def source_hash(concepts_path):
+    with open(concepts_path, 'rb') as f:
+        content = f.read()
+    return hashlib.sha256(f'{INDEX_FORMAT}\n'.encode() + content).hexdigest()[:HASH_LENGTH]
+
+def concept_id(title):
+    """
+    Ids come from the concept title, so they stay the same across rebuilds.
+    """
+    return f'concept-{hashlib.sha1(title.strip().encode()).hexdigest()[:HASH_LENGTH]}'
+
+class ConceptsIndex:
+    """
+    A versioned Chroma index of the chess concepts, persisted under index_dir.
+    The manifest is written last and marks a version as complete.
+    """
+    def __init__(self, concepts_path=CONCEPTS_PATH, index_dir=INDEX_DIR, embedding_function=None):
+        self.concepts_path = concepts_path
+        self.index_dir = index_dir
+        self.embedding_function = embedding_function
+        self.version = source_hash(concepts_path)
+        self.path = os.path.join(index_dir, self.version)
+
+    def is_built(self):
+        return os.path.exists(os.path.join(self.path, MANIFEST_NAME))
+
+    def ensure_built(self):
+        if self.is_built():
+            return False
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        # Workers starting together wait for the first one to build instead of embedding twice
+        with open(os.path.join(self.index_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if self.is_built():
+                    return False
+                self.build()
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def build(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        concepts = self.read_concepts()
+
+        client = self.client()
+        collection = client.create_collection(name=COLLECTION_NAME, **self.collection_options())
+        for start in range(0, len(concepts), ADD_BATCH_SIZE):
+            batch = concepts[start:start + ADD_BATCH_SIZE]
+            collection.add(
+                documents=[f"{concept['title']}\n{concept['content']}" for concept in batch],
+                metadatas=[self.build_metadata(concept['labels']) for concept in batch],
+                ids=[concept['id'] for concept in batch]
+            )
+
+        manifest = {
+            'version': self.version,
+            'concepts': concepts,
+            'tags': self.build_tag_index(concepts)
+        }
+        with open(os.path.join(self.path, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+        self.remove_old_versions()
+
+    def remove_old_versions(self):
+        for name in os.listdir(self.index_dir):
+            old_path = os.path.join(self.index_dir, name)
+            if name != self.version and os.path.isdir(old_path):
+                shutil.rmtree(old_path, ignore_errors=True)
+
+    def read_concepts(self):
+        with open(self.concepts_path) as f:
+            content = f.read()
+
+        concepts = []
+        ids = set()
+        for concept in content.split("## ")[1:]:
+            concept = self.parse_concept(concept)
+            if concept['id'] in ids:
+                raise ValueError(f"Duplicated concept title in {self.concepts_path}: {concept['title']}")
+            ids.add(concept['id'])
+            concepts.append(concept)
+        return concepts
+
+    def parse_concept(self, concept):
+        lines = concept.split('\n')
+        title = lines[0]
+        return {
+            'id': concept_id(title),
+            'title': title,
+            'content': lines[1],
+            'labels': lines[2].replace('- **Labels:** ', '')
+        }
+
+    def build_metadata(self, tags):
+        tags = self.split_tags(tags)
+        return {
+            'Phase': ', '.join(tag for tag in tags if tag in PHASES),
+            'Concepts': ', '.join(tag for tag in tags if tag not in PHASES)
+        }
+
+    def build_tag_index(self, concepts):
+        """
+        Returns the ids of the concepts carrying each phase and label tag.
+        """
+        tag_index = {}
+        for concept in concepts:
+            for tag in self.split_tags(concept['labels']):
+                tag_index.setdefault(tag, []).append(concept['id'])
+        return tag_index
+
+    def split_tags(self, tags):
+        return [tag.strip() for tag in tags.split(',') if tag.strip()]
+
+    def client(self):
+        return chromadb.PersistentClient(path=self.path, settings=Settings(anonymized_telemetry=False))
+
+    def collection_options(self):
+        if self.embedding_function is None:
+            return {}
+        return {'embedding_function': self.embedding_function}
+
+    def open_collection(self):
+        return self.client().get_collection(name=COLLECTION_NAME, **self.collection_options())
+
+    def load_manifest(self):
+        with open(os.path.join(self.path, MANIFEST_NAME)) as f:
+            return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--concepts', default=CONCEPTS_PATH)
+    parser.add_argument('--index-dir', default=INDEX_DIR)
+    args = parser.parse_args()
+
+    index = ConceptsIndex(args.concepts, args.index_dir)
+    built = index.ensure_built()
+    print(f"{'Built' if built else 'Up to date'}: {index.path}")
+
+if __name__ == '__main__':
+    main()
@@ -1,66 +1,76 @@
-import chromadb
-from chromadb.config import Settings
-import uuid
+from bm25 import BM25Index
+from concepts_index import ConceptsIndex, CONCEPTS_PATH, INDEX_DIR
 
-class ConceptsRepository:
-    def __init__(self):
-        client = chromadb.Client(Settings())
-        self.concept_collection = client.create_collection(name="chess-concepts")
-        self.save_chess_concepts()
-        
-        
-    def save_chess_concepts(self):
-        with open('data/ChessConcepts.md') as f:
-            content = f.read()
-            concepts = content.split("## ")
-            
-            documents = []
-            metadatas = []
-            ids = []
+# Rank constant of reciprocal rank fusion, damps the weight of the first few positions
+FUSION_K = 60
 
-            for concept in concepts[1:]:
-                self.save_concept(documents, metadatas, ids, concept)
+class ConceptsRepository:
+    """
+    Searches the prebuilt concepts index. Candidates are narrowed by the
+    phase and aspect tags first, then ranked by fusing the vector search
+    with a BM25 score over the same subset.
+    """
+    def __init__(self, concepts_path=CONCEPTS_PATH, index_dir=INDEX_DIR, embedding_function=None,
+                 vector_results=50):
+        self.index = ConceptsIndex(concepts_path, index_dir, embedding_function)
+        self.index.ensure_built()
+        self.concept_collection = self.index.open_collection()
+        self.vector_results = vector_results
 
-        self.concept_collection.add(
-            documents = documents,
-            metadatas = metadatas,
-            ids = ids
-        )
+        manifest = self.index.load_manifest()
+        self.documents = {
+            concept['id']: f"{concept['title']}\n{concept['content']}"
+            for concept in manifest['concepts']
+        }
+        self.tag_index = {tag: set(ids) for tag, ids in manifest['tags'].items()}
+        self.lexical_index = BM25Index(self.documents)
 
-    def save_concept(self, documents, metadatas,
-                     ids, concept):
-        lines = concept.split('\n')
-        title = lines[0]
-        content = lines[1]
-        tags = lines[2].replace('- **Labels:** ', '')
-        metadata = self.build_metadata(tags)
-        
-        metadatas.append(metadata)
-        documents.append(f"{title}\n{content}")
-        ids.append(str(uuid.uuid4()))
+    def search(self, phase, aspect, keywords, n_results=5):
+        ids = self.search_ids(phase, aspect, keywords, n_results)
+        return [[self.documents[concept_id] for concept_id in ids]]
 
-        
+    def search_ids(self, phase, aspect, keywords, n_results=5):
+        query_text = ' '.join(keywords + [phase, aspect])
+        candidates = self.candidates(phase, aspect)
+        if not candidates:
+            return []
 
-    def build_metadata(self, tags):
-        metadata = {
-            'Phase': '',
-            'Concepts': ''
-        }
+        vector_ranking = self.vector_ranking(query_text, candidates)
+        lexical_ranking = self.lexical_index.rank(query_text, candidates, self.vector_results)
+        return self.fuse_rankings([vector_ranking, lexical_ranking])[:n_results]
 
-        for tag in tags.split(', '):
-            if tag in ['Opening', 'Middlegame', 'Endgame']:
-                metadata['Phase'] += f"{tag}, "
-            else:
-                metadata['Concepts'] += tag
-        
-        return metadata
+    def candidates(self, phase, aspect):
+        """
+        Returns the ids of the concepts tagged with both the phase and the aspect.
+        The aspect and then the phase are dropped when no concept carries them,
+        e.g. for General analysis.
+        """
+        for tags in [[phase, aspect], [phase], []]:
+            tags = [tag for tag in tags if tag in self.tag_index]
+            candidates = set(self.documents)
+            for tag in tags:
+                candidates &= self.tag_index[tag]
+            if candidates:
+                return candidates
+        return set()
 
-    def search(self, phase, aspect, keywords):
-        query_text = ' '.join(keywords + [phase, aspect])
-        
+    def vector_ranking(self, query_text, candidates):
+        # Restricting the query to the candidate ids is much faster than a where filter on the metadata
         query_result = self.concept_collection.query(
             query_texts=[query_text],
-            n_results=5
+            ids=list(candidates),
+            n_results=min(self.vector_results, len(candidates)),
+            include=[]
         )
-        
-        return query_result["documents"]
\ No newline at end of file
+        return query_result['ids'][0]
+
+    def fuse_rankings(self, rankings):
+        """
+        Reciprocal rank fusion. It only uses positions, so the cosine distances
+        and the BM25 scores never need to be put on a common scale.
+        """
+        scores = {}
+        for ranking in rankings:
+            for position, concept_id in enumerate(ranking):
+                scores[concept_id] = scores.get(concept_id, 0) + 1 / (FUSION_K + position + 1)
+        return sorted(scores, key=scores.get, reverse=True)
@@ -0,0 +1,309 @@
+import atexit
+import queue
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+STARTING_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+class EngineError(Exception):
+    pass
+
+class EngineTimeout(EngineError):
+    pass
+
+class StockfishEngine:
+    """
+    A long-lived Stockfish process spoken to over persistent UCI pipes.
+    """
+    def __init__(self, stockfish_path, command_timeout=10.0):
+        self.stockfish_path = stockfish_path
+        self.command_timeout = command_timeout
+        self.process = None
+        self.lines = None
+        # UCI options set on the running process
+        self.options = {}
+        # Root position of the game the hash table holds searches of, None after ucinewgame
+        self.game = None
+
+    def start(self):
+        self.options = {}
+        self.game = None
+        self.process = subprocess.Popen(
+            [self.stockfish_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1
+        )
+        self.lines = queue.Queue()
+        reader = threading.Thread(
+            target=self.read_output,
+            args=(self.process.stdout, self.lines),
+            daemon=True
+        )
+        reader.start()
+
+        self.send('uci')
+        self.read_until('uciok')
+        self.wait_ready()
+
+    def read_output(self, stdout, lines):
+        for line in stdout:
+            lines.put(line)
+        # None marks the end of the stream, i.e. the process died
+        lines.put(None)
+
+    def stop(self):
+        if self.process is None:
+            return
+
+        try:
+            if self.process.poll() is None:
+                self.send('quit')
+                self.process.wait(timeout=1)
+        except (EngineError, subprocess.TimeoutExpired):
+            pass
+        finally:
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def is_healthy(self):
+        if not self.is_alive():
+            return False
+        try:
+            self.wait_ready()
+            return True
+        except EngineError:
+            return False
+
+    def send(self, command):
+        try:
+            self.process.stdin.write(f'{command}\n')
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError) as e:
+            raise EngineError(f'Stockfish process is not accepting commands: {e}')
+
+    def read_until(self, token, timeout=None):
+        """
+        Reads engine output until a line starting with token is found.
+        Returns every line read before it.
+        """
+        timeout = timeout or self.command_timeout
+        output = []
+        while True:
+            try:
+                line = self.lines.get(timeout=timeout)
+            except queue.Empty:
+                raise EngineTimeout(f'Stockfish did not answer "{token}" in {timeout}s')
+
+            if line is None:
+                raise EngineError('Stockfish process exited unexpectedly')
+            if line.startswith(token):
+                return ''.join(output)
+            output.append(line)
+
+    def wait_ready(self):
+        self.send('isready')
+        self.read_until('readyok')
+
+    def new_game(self):
+        self.send('ucinewgame')
+        self.wait_ready()
+        self.game = None
+
+    def set_options(self, options):
+        """
+        Sends the UCI options whose value changed since they were last set.
+        """
+        changed = False
+        for name, value in options.items():
+            if self.options.get(name) != value:
+                self.send(f'setoption name {name} value {value}')
+                self.options[name] = value
+                changed = True
+        if changed:
+            # Hash and Threads are applied when the engine gets isready
+            self.wait_ready()
+
+    def set_game(self, fen):
+        """
+        Starts a new game unless the hash table already holds the one starting at fen.
+        """
+        if self.game != fen:
+            self.new_game()
+            self.game = fen
+
+    def set_position(self, fen, moves=()):
+        position = 'startpos' if fen == STARTING_FEN else f'fen {fen}'
+        self.send(f'position {position}' + (f' moves {" ".join(moves)}' if moves else ''))
+
+    def search(self, fen, moves, limits, timeout, stop=None):
+        """
+        Searches the position reached by the moves from fen with 'go limits'.
+        Yields every line of output up to bestmove, which is the last one.
+        Positions of the same game keep the hash table of the previous
+        searches. Setting the stop event, or closing the generator, stops the
+        search. timeout is the longest the engine may stay silent.
+        """
+        self.set_game(fen)
+        self.set_position(fen, moves)
+        self.send(f'go {limits}')
+        stopped = False
+        finished = False
+        last_line = time.monotonic()
+        try:
+            while True:
+                if stop is not None and stop.is_set() and not stopped:
+                    self.send('stop')
+                    stopped = True
+                try:
+                    # Waits in short steps while the stop event may still be set
+                    line = self.lines.get(timeout=0.05 if stop is not None and not stopped else timeout)
+                except queue.Empty:
+                    if time.monotonic() - last_line > timeout:
+                        raise EngineTimeout(f'Stockfish was silent for {timeout}s while searching')
+                    continue
+
+                if line is None:
+                    raise EngineError('Stockfish process exited unexpectedly')
+                last_line = time.monotonic()
+                if line.startswith('bestmove'):
+                    finished = True
+                    yield line
+                    return
+                if not stopped:
+                    yield line
+        finally:
+            if not finished and self.is_alive():
+                # The engine must be idle before it goes back to the pool
+                self.send('stop')
+                self.read_until('bestmove')
+
+    def evaluate(self, fen, moves=()):
+        """
+        Returns the raw output of the traced eval command for the position
+        reached by the moves from fen. Positions of the same game are sent as
+        moves from its start, without clearing the engine between them.
+        """
+        self.set_game(fen)
+        self.set_position(fen, moves)
+        self.send('eval')
+        # The engine handles commands in order, so readyok closes the eval output
+        self.send('isready')
+        return self.read_until('readyok')
+
+class EnginePool:
+    """
+    A fixed size pool of warm Stockfish engines. Engines are started lazily,
+    checked out one per analysis and restarted when they crash or hang.
+    """
+    def __init__(self, stockfish_path, size=1, command_timeout=10.0, checkout_timeout=30.0):
+        self.stockfish_path = stockfish_path
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.restarts = 0
+        self.restarts_lock = threading.Lock()
+        self.idle_engines = queue.LifoQueue()
+
+        for _ in range(size):
+            self.idle_engines.put(StockfishEngine(stockfish_path, command_timeout))
+
+        atexit.register(self.close)
+
+    @contextmanager
+    def engine(self, game=None):
+        """
+        Checks out an engine, the one whose hash table holds the game when it is idle.
+        """
+        engine = self.find_idle(game) if game is not None else None
+        if engine is None:
+            try:
+                engine = self.idle_engines.get(timeout=self.checkout_timeout)
+            except queue.Empty:
+                raise EngineTimeout(f'No Stockfish engine available after {self.checkout_timeout}s')
+
+        try:
+            self.ensure_running(engine)
+            yield engine
+        except EngineError:
+            # A crashed or hung engine is stopped here and started again on its next checkout
+            self.record_restart()
+            engine.stop()
+            raise
+        finally:
+            self.idle_engines.put(engine)
+
+    def find_idle(self, game):
+        idle = []
+        found = None
+        while True:
+            try:
+                engine = self.idle_engines.get_nowait()
+            except queue.Empty:
+                break
+            if found is None and engine.game == game:
+                found = engine
+            else:
+                idle.append(engine)
+
+        # Put back in reverse so the most recently used engine stays on top
+        for engine in reversed(idle):
+            self.idle_engines.put(engine)
+        return found
+
+    def ensure_running(self, engine):
+        if engine.process is None:
+            engine.start()
+        elif not engine.is_healthy():
+            self.record_restart()
+            engine.restart()
+
+    def record_restart(self):
+        with self.restarts_lock:
+            self.restarts += 1
+
+    def health_check(self):
+        """
+        Pings every idle engine and restarts the ones that do not answer.
+        Returns the number of healthy engines.
+        """
+        healthy = 0
+        checked = []
+        while len(checked) < self.size:
+            try:
+                checked.append(self.idle_engines.get_nowait())
+            except queue.Empty:
+                break
+
+        for engine in checked:
+            try:
+                if engine.process is not None and not engine.is_healthy():
+                    self.record_restart()
+                    engine.restart()
+                healthy += 1
+            except EngineError:
+                engine.stop()
+            finally:
+                self.idle_engines.put(engine)
+
+        return healthy
+
+    def close(self):
+        while True:
+            try:
+                engine = self.idle_engines.get_nowait()
+            except queue.Empty:
+                return
+            engine.stop()
@@ -0,0 +1,202 @@
+import asyncio
+import contextvars
+import functools
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from metrics import registry
+
+# The client the current request is queued under, None outside of a request
+request_client = contextvars.ContextVar('request_client', default=None)
+
+# Ends the items of a stream
+STREAM_END = object()
+
+rejections_total = registry.counter('chess_assistant_engine_rejections_total',
+                                    'Engine analyses turned away, by reason.', 'reason')
+
+class EngineBusy(Exception):
+    """
+    The analysis was not run. status is the HTTP status to answer with and
+    retry_after the seconds the client should wait before trying again.
+    """
+    status = 503
+    reason = 'busy'
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class QueueFull(EngineBusy):
+    reason = 'queue_full'
+
+class ClientQueueFull(EngineBusy):
+    status = 429
+    reason = 'client_queue_full'
+
+class DeadlineExceeded(EngineBusy):
+    reason = 'deadline'
+
+@contextmanager
+def client_requests(client):
+    """
+    Queues the engine work started inside the block under the client.
+    """
+    token = request_client.set(client)
+    try:
+        yield
+    finally:
+        request_client.reset(token)
+
+class EngineScheduler:
+    """
+    Admission control in front of the engines. At most `workers` analyses run
+    at once and at most `max_queue` wait for them, the others are turned away
+    at once. Waiting analyses are served round robin by client, so a burst of
+    one client can't starve the rest, and the ones still waiting at their
+    deadline are dropped before they reach an engine.
+    The coroutines must all run on the same event loop.
+    """
+    def __init__(self, workers, max_queue, max_client_queue=None, deadline=10.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_client_queue = max_client_queue or max_queue
+        self.deadline = deadline
+        self.running = 0
+        self.waiting = OrderedDict()
+        self.depth = 0
+        # Moving average of the time an analysis holds its slot, for Retry-After
+        self.service_time = 1.0
+
+    async def run(self, function, *args):
+        """
+        Runs the blocking function in the loop's thread pool once a slot is free.
+        Raises an EngineBusy error when it is turned away or waits past the deadline.
+        """
+        await self.acquire(request_client.get())
+
+        start = time.monotonic()
+        context = contextvars.copy_context()
+        future = asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, function, *args))
+        # The slot is given back when the engine is done, even if the caller stopped waiting
+        future.add_done_callback(lambda _: self.release(time.monotonic() - start))
+        return await asyncio.shield(future)
+
+    async def stream(self, function, *args):
+        """
+        Like run, for a blocking generator function called as function(*args, stop).
+        Its items are yielded as it produces them. When the stream is closed
+        early the stop event is set, the function must then wind down, and the
+        slot is given back once it has.
+        """
+        await self.acquire(request_client.get())
+
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        stop = threading.Event()
+
+        def produce():
+            generator = function(*args, stop)
+            try:
+                for item in generator:
+                    loop.call_soon_threadsafe(items.put_nowait, (item, None))
+                    if stop.is_set():
+                        break
+                generator.close()
+                loop.call_soon_threadsafe(items.put_nowait, (STREAM_END, None))
+            except BaseException as e:
+                loop.call_soon_threadsafe(items.put_nowait, (STREAM_END, e))
+
+        start = time.monotonic()
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(None, functools.partial(context.run, produce))
+        future.add_done_callback(lambda _: self.release(time.monotonic() - start))
+        try:
+            while True:
+                item, error = await items.get()
+                if item is STREAM_END:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            stop.set()
+
+    async def acquire(self, client):
+        if self.running < self.workers and not self.depth:
+            self.running += 1
+            return
+
+        if self.depth >= self.max_queue:
+            self.reject(QueueFull('The analysis queue is full'))
+        if len(self.waiting.get(client, ())) >= self.max_client_queue:
+            self.reject(ClientQueueFull('Too many analyses waiting for this client'))
+
+        queue = self.waiting.setdefault(client, deque())
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        self.depth += 1
+        try:
+            # A deadline of None waits as long as it takes
+            await asyncio.wait_for(future, self.deadline)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over as the wait ended, it goes to the next one
+                self.release()
+            else:
+                self.remove(client, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self.reject(DeadlineExceeded('The analysis waited past its deadline'))
+            raise
+
+    def release(self, service_time=None):
+        if service_time is not None:
+            self.service_time = 0.9 * self.service_time + 0.1 * service_time
+
+        while self.waiting:
+            client, queue = next(iter(self.waiting.items()))
+            future = queue.popleft()
+            self.depth -= 1
+            if queue:
+                self.waiting.move_to_end(client)
+            else:
+                del self.waiting[client]
+
+            if not future.done():
+                # The slot goes straight to the waiter, running stays the same
+                future.set_result(None)
+                return
+
+        self.running -= 1
+
+    def remove(self, client, future):
+        queue = self.waiting.get(client)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        self.depth -= 1
+        if not queue:
+            del self.waiting[client]
+
+    def reject(self, error):
+        error.retry_after = self.retry_after()
+        rejections_total.inc(error.reason)
+        raise error
+
+    def retry_after(self):
+        """
+        Seconds until the queue is expected to have drained, rounded up.
+        """
+        return max(1, math.ceil(self.service_time * (self.depth + 1) / self.workers))
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'running': self.running,
+            'queued': self.depth,
+            'max_queue': self.max_queue,
+            'clients_waiting': len(self.waiting),
+            'service_time': round(self.service_time, 4)
+        }
@@ -0,0 +1,137 @@
+"""
+Serves the Stockfish engines of a host to the api-servers.
+
+    STOCKFISH_PATH=stockfish/stockfish gunicorn -w 1 -k gthread --threads 16 -b 0.0.0.0:5001 engine_worker:app
+
+The api-servers send their engine work here when ENGINE_WORKERS lists the
+workers, and keep the parsing, the caches and the model calls. Evaluations
+answer with the raw output of the engine, searches stream their lines as
+the engine prints them. One process per host, it owns the engine pool.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import Flask, Response, request, jsonify, stream_with_context
+from dotenv import load_dotenv
+from engine_pool import EnginePool, EngineError, EngineTimeout
+
+app = Flask(__name__)
+
+load_dotenv()
+
+stockfish_path = os.getenv('STOCKFISH_PATH')
+stockfish_pool_size = int(os.getenv('STOCKFISH_POOL_SIZE', '1'))
+stockfish_timeout = float(os.getenv('STOCKFISH_TIMEOUT', '10'))
+# Seconds between two checks of the idle engines
+engine_health_interval = float(os.getenv('ENGINE_HEALTH_INTERVAL', '5'))
+
+engine_pool = EnginePool(stockfish_path, stockfish_pool_size, stockfish_timeout)
+busy = 0
+busy_lock = threading.Lock()
+# Stop events of the searches running, by the id the api-server gave them
+searches = {}
+# Healthy engines as of the last check, the polls of the api-servers read it
+healthy_engines = stockfish_pool_size
+
+def check_engines():
+    """
+    Pings the idle engines every engine_health_interval seconds, restarting
+    the ones that do not answer. Polls don't take engines from the searches.
+    """
+    global healthy_engines
+    while True:
+        try:
+            healthy_engines = engine_pool.health_check()
+        except Exception as e:
+            print(str(e))
+        time.sleep(engine_health_interval)
+
+threading.Thread(target=check_engines, daemon=True).start()
+
+@contextmanager
+def checked_out(game):
+    global busy
+    with busy_lock:
+        busy += 1
+    try:
+        with engine_pool.engine(game) as engine:
+            yield engine
+    finally:
+        with busy_lock:
+            busy -= 1
+
+@app.route('/health', methods=['GET'])
+def health():
+    """
+    The engines of the worker, how many are busy and how many answered the last check.
+    """
+    healthy = healthy_engines
+    with busy_lock:
+        current = busy
+    status = 200 if healthy + current > 0 else 503
+    return jsonify({
+        'engines': stockfish_pool_size,
+        'busy': current,
+        'healthy': healthy,
+        'restarts': engine_pool.restarts
+    }), status
+
+@app.route('/evaluate', methods=['POST'])
+def evaluate():
+    body = request.get_json(silent=True) or {}
+    if not body.get('fen'):
+        return jsonify({'error': 'Not enough parameters. fen is required'}), 400
+
+    try:
+        with checked_out(body.get('game')) as engine:
+            output = engine.evaluate(body['fen'], body.get('moves', []))
+        return jsonify({'output': output})
+    except EngineTimeout as e:
+        return jsonify({'error': str(e)}), 503
+    except EngineError as e:
+        print(str(e))
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/search', methods=['POST'])
+def search():
+    """
+    Streams the output lines of the search, bestmove last. Engine failures
+    after the first line arrive as an 'error' line.
+    """
+    body = request.get_json(silent=True) or {}
+    if not body.get('fen') or not body.get('id') or not body.get('limits'):
+        return jsonify({'error': 'Not enough parameters. id, fen and limits are required'}), 400
+
+    stop = threading.Event()
+    searches[body['id']] = stop
+
+    def generate():
+        try:
+            with checked_out(body['fen']) as engine:
+                engine.set_options(body.get('options', {}))
+                lines = engine.search(body['fen'], body.get('moves', []), body['limits'],
+                                      body.get('timeout', stockfish_timeout), stop)
+                try:
+                    yield from lines
+                finally:
+                    # A dropped connection stops the search too
+                    lines.close()
+        except EngineError as e:
+            print(str(e))
+            yield f'error {e}\n'
+        finally:
+            searches.pop(body['id'], None)
+
+    return Response(stream_with_context(generate()), mimetype='text/plain')
+
+@app.route('/search/stop', methods=['POST'])
+def stop_search():
+    body = request.get_json(silent=True) or {}
+    stop = searches.get(body.get('id'))
+    if stop is not None:
+        stop.set()
+    return jsonify({'stopped': stop is not None})
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5001)
@@ -0,0 +1,46 @@
+import io
+import chess
+import chess.pgn
+from position import Position, InvalidPosition
+
+def positions_from_pgn(pgn):
+    """
+    Returns the position after every move of the main line of the first game
+    in the PGN. The Position of each one is kept under 'position'.
+    """
+    game = chess.pgn.read_game(io.StringIO(pgn))
+    if game is None or game.errors:
+        raise ValueError('The PGN could not be read')
+
+    positions = []
+    board = game.board()
+    for ply, move in enumerate(game.mainline_moves(), start=1):
+        san = board.san(move)
+        board.push(move)
+        position = Position(board.copy(stack=False))
+        positions.append({'index': ply - 1, 'ply': ply, 'move': san, 'fen': position.fen, 'position': position})
+
+    return positions
+
+def positions_from_fens(fens):
+    positions = []
+    for index, fen in enumerate(fens):
+        if not isinstance(fen, str):
+            raise ValueError(f'Position {index} is not a FEN string')
+        try:
+            position = Position.parse(fen)
+        except InvalidPosition as e:
+            raise InvalidPosition(f'Position {index}: {e}') from None
+        positions.append({'index': index, 'fen': position.fen, 'position': position})
+
+    return positions
+
+def group_positions(positions):
+    """
+    Groups the positions that share a Zobrist key, so each one is analyzed once.
+    Groups keep the order of their first position.
+    """
+    groups = {}
+    for position in positions:
+        groups.setdefault(position['position'].key, []).append(position)
+    return groups
@@ -0,0 +1,51 @@
+from abc import ABC, abstractmethod
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, Timeout
+
+class LLMBackend(ABC):
+    """
+    Where the answers come from. A backend completes a list of chat messages
+    with the given model, or its default one, whole or as a stream of text.
+    The coroutines must all run on the same event loop.
+    """
+    @abstractmethod
+    async def complete(self, messages, model=None):
+        pass
+
+    @abstractmethod
+    def stream(self, messages, model=None):
+        """
+        Async generator of the text of the completion as the model writes it.
+        """
+
+class ChatCompletionsBackend(LLMBackend):
+    """
+    Any server speaking the OpenAI chat completions API: OpenAI itself, a
+    local model server or the stub server used for load tests. Connections
+    are kept alive in a bounded pool shared by every request. Calls that fail
+    on the connection, a timeout, a rate limit or a server error are retried
+    with backoff, for streams only until the first chunk arrives.
+    """
+    def __init__(self, api_key, model, base_url=None, timeout=60.0, connect_timeout=5.0,
+                 max_retries=2, max_connections=100):
+        self.model = model
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        # The timeout is also the longest wait between two chunks of a stream
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                                  timeout=Timeout(timeout, connect=connect_timeout), max_retries=max_retries)
+
+    async def complete(self, messages, model=None):
+        response = await self.client.chat.completions.create(model=model or self.model, messages=messages)
+        return response.choices[0].message.content
+
+    async def stream(self, messages, model=None):
+        stream = await self.client.chat.completions.create(model=model or self.model, messages=messages, stream=True)
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Closing the response is what stops the model when the stream is abandoned
+            await stream.close()
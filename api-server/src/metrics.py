@@ -0,0 +1,162 @@
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# The (stage, seconds) spans of the current request, None outside of one
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+QUANTILES = [0.5, 0.95, 0.99]
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+class Summary:
+    """
+    Observed durations by label value, rendered as a Prometheus summary.
+    Quantiles come from a window of the latest observations, sums and counts
+    are cumulative.
+    """
+    def __init__(self, name, help, label, window=1024):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.window = window
+        self.observations = {}
+        self.sums = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self.lock:
+            if label_value not in self.observations:
+                self.observations[label_value] = deque(maxlen=self.window)
+                self.sums[label_value] = 0.0
+                self.counts[label_value] = 0
+            self.observations[label_value].append(value)
+            self.sums[label_value] += value
+            self.counts[label_value] += 1
+
+    def quantiles(self, label_value):
+        with self.lock:
+            values = sorted(self.observations.get(label_value, []))
+        if not values:
+            return {}
+        return {quantile: values[min(len(values) - 1, int(quantile * len(values)))] for quantile in QUANTILES}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} summary']
+        with self.lock:
+            label_values = list(self.observations)
+        for label_value in label_values:
+            for quantile, value in self.quantiles(label_value).items():
+                labels = format_labels({self.label: label_value, 'quantile': quantile})
+                lines.append(f'{self.name}{labels} {value:.6f}')
+            labels = format_labels({self.label: label_value})
+            lines.append(f'{self.name}_sum{labels} {self.sums[label_value]:.6f}')
+            lines.append(f'{self.name}_count{labels} {self.counts[label_value]}')
+        return lines
+
+class Counter:
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for label_value, value in self.values.items():
+                lines.append(f'{self.name}{format_labels({self.label: label_value})} {value}')
+        return lines
+
+class Registry:
+    """
+    Holds the metrics of the process and renders them in the Prometheus text format.
+    Collectors are called on every render for values kept elsewhere, e.g. cache stats.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def summary(self, name, help, label):
+        summary = Summary(name, help, label)
+        self.metrics.append(summary)
+        return summary
+
+    def counter(self, name, help, label):
+        counter = Counter(name, help, label)
+        self.metrics.append(counter)
+        return counter
+
+    def collect(self, collector):
+        """
+        Registers a function returning (name, help, type, [(labels, value)]) tuples.
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for collector in self.collectors:
+            for name, help, metric_type, samples in collector():
+                lines += [f'# HELP {name} {help}', f'# TYPE {name} {metric_type}']
+                lines += [f'{name}{format_labels(labels)} {value}' for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+stage_seconds = registry.summary('chess_assistant_stage_duration_seconds',
+                                 'Time spent in each analysis stage.', 'stage')
+errors_total = registry.counter('chess_assistant_errors_total',
+                                'Stages that ended with an exception.', 'stage')
+
+@contextmanager
+def timed(stage):
+    """
+    Records the duration of the block for the stage, in the process metrics
+    and in the spans of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors_total.inc(stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(stage, elapsed)
+        timings = request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+@contextmanager
+def request_spans():
+    """
+    Collects the spans of every stage run inside the block, including the
+    ones running in other tasks or in the threads of the loop.
+    """
+    timings = []
+    token = request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        request_timings.reset(token)
+
+def server_timing(timings):
+    """
+    Returns the Server-Timing header value, adding up repeated stages.
+    """
+    durations = {}
+    for stage, seconds in timings:
+        durations[stage] = durations.get(stage, 0) + seconds
+    return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in durations.items())
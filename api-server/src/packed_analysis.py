@@ -0,0 +1,353 @@
+"""
+Compact binary form of a parsed position analysis.
+
+A PositionTrace is packed into a few hundred bytes with struct: squares are
+one byte indexes, counts are single bytes and piece scores two byte
+hundredths when they have no more decimals. Unpacking returns the
+PositionTrace again, so to_dict() builds the same analysis dict as before
+packing, key order included. Values the format can't hold exactly raise a
+ValueError, serialize_analysis then keeps the analysis as JSON.
+
+A position without analysis, the empty string of PositionAnalyzer, packs to b''.
+"""
+import json
+import math
+import struct
+import chess
+from trace_parser import (PositionTrace, Material, PassedPawn, SidePawnStructure, SideKingSafety,
+                          PieceActivity, CHECK_PIECES, THREAT_KEYS, SIDES)
+
+FORMAT_VERSION = 1
+
+SECTIONS = ['material', 'pawn_structure', 'king_safety', 'pieces_activity', 'threats', 'space']
+
+SQUARE_NAMES = chess.SQUARE_NAMES
+UPPER_SQUARE_NAMES = [name.upper() for name in chess.SQUARE_NAMES]
+SQUARE_INDEXES = {name: index for index, name in enumerate(SQUARE_NAMES)}
+UPPER_SQUARE_INDEXES = {name: index for index, name in enumerate(UPPER_SQUARE_NAMES)}
+
+BLOCKED_STATUSES = ['Is not blocked and free to advance', 'Is blocked and can not advance']
+PIECE_KINDS = ['Pawn', 'Knight', 'Bishop', 'Rook', 'Queen', 'King']
+
+# Optional numbers of a PieceActivity, in the order of its fields, and its flags.
+# Each one takes a bit of the flags of the piece record, in the same order.
+PIECE_NUMBERS = ['moveable_squares', 'king_distance', 'same_color_pawns', 'x_rayed_pawns']
+PIECE_FLAGS = ['long_diagonal', 'open_column', 'queen_pinned']
+LONG_DIAGONAL = 1 << 4
+OPEN_COLUMN = 1 << 5
+QUEEN_PINNED = 1 << 6
+CONTROLLED = 1 << 7
+SCORE_HUNDREDTHS = 1 << 8
+# Scores that don't fit in hundredths follow the record as a double
+SCORE_DOUBLE = 1 << 9
+
+NUMBER_TEXTS = [str(value) for value in range(256)]
+
+MATERIAL = struct.Struct('<BBBBBB')
+# Square, color and kind, flags, controlled squares, the optional numbers and the score in hundredths
+PIECE = struct.Struct('<BBHBBBBBh')
+DOUBLE = struct.Struct('<d')
+
+def pack_analysis(trace):
+    """
+    Returns the PositionTrace packed into bytes, b'' for a position without analysis.
+    """
+    if trace is None or trace == '':
+        return b''
+
+    try:
+        writer = Writer()
+        writer.byte(FORMAT_VERSION)
+        present = [getattr(trace, section) is not None for section in SECTIONS]
+        writer.byte(sum(1 << bit for bit, flag in enumerate(present) if flag))
+
+        if trace.material is not None:
+            write_material(writer, trace.material)
+        if trace.pawn_structure is not None:
+            write_pawn_structure(writer, trace.pawn_structure)
+        if trace.king_safety is not None:
+            write_king_safety(writer, trace.king_safety)
+        if trace.pieces_activity is not None:
+            write_pieces_activity(writer, trace.pieces_activity)
+        if trace.threats is not None:
+            write_threats(writer, trace.threats)
+        if trace.space is not None:
+            for side in SIDES:
+                writer.byte(trace.space[side])
+        return bytes(writer.data)
+    except (KeyError, TypeError, ValueError, struct.error) as e:
+        raise ValueError(f'The analysis can not be packed: {e!r}') from None
+
+def unpack_trace(data):
+    """
+    Returns the PositionTrace of packed bytes, None for a position without analysis.
+    """
+    if not data:
+        return None
+
+    reader = Reader(data)
+    version = reader.byte()
+    if version != FORMAT_VERSION:
+        raise ValueError(f'Unknown packed analysis version {version}')
+    present = reader.byte()
+
+    trace = PositionTrace()
+    if present & 1:
+        trace.material = read_material(reader)
+    if present & 2:
+        trace.pawn_structure = read_pawn_structure(reader)
+    if present & 4:
+        trace.king_safety = read_king_safety(reader)
+    if present & 8:
+        trace.pieces_activity = read_pieces_activity(reader)
+    if present & 16:
+        trace.threats = read_threats(reader)
+    if present & 32:
+        trace.space = {side: reader.byte() for side in SIDES}
+    return trace
+
+def unpack_analysis(data):
+    """
+    Returns the analysis dict of packed bytes, '' for a position without analysis.
+    """
+    trace = unpack_trace(data)
+    return trace.to_dict() if trace is not None else ''
+
+def number(text):
+    """
+    Returns the value of a number the parser kept as text, which must read back the same.
+    """
+    value = int(text)
+    if value >= len(NUMBER_TEXTS) or NUMBER_TEXTS[value] != text:
+        raise TypeError(f'{text!r} is not a number of one byte')
+    return value
+
+class Writer:
+    def __init__(self):
+        self.data = bytearray()
+
+    def byte(self, value):
+        self.data.append(value)
+
+    def number(self, text):
+        self.data.append(number(text))
+
+    def squares(self, names, indexes=SQUARE_INDEXES):
+        self.data.append(len(names))
+        self.data.extend(indexes[name] for name in names)
+
+    def pack(self, layout, *values):
+        self.data.extend(layout.pack(*values))
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def byte(self):
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def squares(self, names=SQUARE_NAMES):
+        count = self.data[self.offset]
+        start = self.offset + 1
+        self.offset = start + count
+        return [names[index] for index in self.data[start:self.offset]]
+
+    def unpack(self, layout):
+        values = layout.unpack_from(self.data, self.offset)
+        self.offset += layout.size
+        return values
+
+def write_material(writer, material):
+    for side in SIDES:
+        side_material = material[side]
+        writer.byte(side_material is not None)
+        if side_material is not None:
+            writer.pack(MATERIAL, side_material.pawns, side_material.bishops, side_material.bishops_pair,
+                        side_material.knights, side_material.rooks, side_material.queens)
+
+def read_material(reader):
+    material = {}
+    for side in SIDES:
+        if not reader.byte():
+            material[side] = None
+            continue
+        pawns, bishops, bishops_pair, knights, rooks, queens = reader.unpack(MATERIAL)
+        material[side] = Material(pawns, bishops, bool(bishops_pair), knights, rooks, queens)
+    return material
+
+def write_pawn_structure(writer, pawn_structure):
+    for side in SIDES:
+        structure = pawn_structure[side]
+        writer.byte(structure.has_passed_section)
+        writer.squares(structure.pawns)
+
+        writer.byte(len(structure.passed_pawns))
+        for square, passed_pawn in structure.passed_pawns.items():
+            writer.byte(SQUARE_INDEXES[square])
+            writer.byte(passed_pawn is not None)
+            if passed_pawn is None:
+                continue
+            for values in [passed_pawn.squares_to_promotion, passed_pawn.enemy_king_distance]:
+                writer.byte(len(values))
+                for value in values:
+                    writer.number(value)
+            writer.byte(len(passed_pawn.blocked_status))
+            for status in passed_pawn.blocked_status:
+                writer.byte(BLOCKED_STATUSES.index(status))
+
+        writer.squares(structure.backward_pawns)
+        writer.squares(structure.isolated_pawns)
+        for groups in [structure.islands, structure.phalanxes]:
+            writer.byte(len(groups))
+            for group in groups:
+                writer.squares(group)
+
+def read_pawn_structure(reader):
+    pawn_structure = {}
+    for side in SIDES:
+        structure = SidePawnStructure(has_passed_section=bool(reader.byte()))
+        structure.pawns = reader.squares()
+
+        for _ in range(reader.byte()):
+            square = SQUARE_NAMES[reader.byte()]
+            if not reader.byte():
+                structure.passed_pawns[square] = None
+                continue
+            passed_pawn = PassedPawn()
+            for values in [passed_pawn.squares_to_promotion, passed_pawn.enemy_king_distance]:
+                values.extend(NUMBER_TEXTS[reader.byte()] for _ in range(reader.byte()))
+            passed_pawn.blocked_status.extend(BLOCKED_STATUSES[reader.byte()] for _ in range(reader.byte()))
+            structure.passed_pawns[square] = passed_pawn
+
+        structure.backward_pawns = reader.squares()
+        structure.isolated_pawns = reader.squares()
+        structure.islands = [reader.squares() for _ in range(reader.byte())]
+        structure.phalanxes = [reader.squares() for _ in range(reader.byte())]
+        pawn_structure[side] = structure
+    return pawn_structure
+
+def write_king_safety(writer, king_safety):
+    for side in SIDES:
+        safety = king_safety[side]
+        writer.byte(safety.attacked)
+        writer.byte(safety.double_attacked)
+        writer.byte(safety.defended)
+        # A piece without checks writes no squares, the list of one with checks is never empty
+        for piece in CHECK_PIECES:
+            squares = safety.checks.get(piece)
+            writer.squares(squares.split(', ') if squares else [], UPPER_SQUARE_INDEXES)
+
+def read_king_safety(reader):
+    king_safety = {}
+    for side in SIDES:
+        safety = SideKingSafety(reader.byte(), reader.byte(), reader.byte())
+        for piece in CHECK_PIECES:
+            squares = reader.squares(UPPER_SQUARE_NAMES)
+            if squares:
+                safety.checks[piece] = ', '.join(squares)
+        king_safety[side] = safety
+    return king_safety
+
+def write_pieces_activity(writer, pieces_activity):
+    for side in SIDES:
+        writer.byte(len(pieces_activity[side]))
+        for piece in pieces_activity[side]:
+            write_piece(writer, piece)
+
+def write_piece(writer, piece):
+    color, kind, of, square = piece.piece.split(' ')
+    if of != 'of':
+        raise TypeError(f'{piece.piece!r} is not a piece name')
+
+    flags = 0
+    numbers = []
+    for bit, name in enumerate(PIECE_NUMBERS):
+        value = getattr(piece, name)
+        if value is not None:
+            flags |= 1 << bit
+            numbers.append(number(value))
+        else:
+            numbers.append(0)
+    for bit, name in enumerate(PIECE_FLAGS, len(PIECE_NUMBERS)):
+        if getattr(piece, name):
+            flags |= 1 << bit
+
+    score = piece.score
+    hundredths = 0
+    if isinstance(score, float):
+        hundredths = round(score * 100) if math.isfinite(score) else None
+        # Scores with two decimals or less read back exactly from their hundredths
+        if hundredths is not None and -32768 <= hundredths < 32768 and repr(hundredths / 100) == repr(score):
+            flags |= SCORE_HUNDREDTHS
+        else:
+            flags |= SCORE_DOUBLE
+            hundredths = 0
+    elif score != 'N/A':
+        raise TypeError(f'{score!r} is not a piece score')
+
+    if piece.controlled_squares is not None:
+        flags |= CONTROLLED
+    writer.pack(PIECE, UPPER_SQUARE_INDEXES[square], SIDES.index(color) << 3 | PIECE_KINDS.index(kind), flags,
+                piece.controlled_squares or 0, *numbers, hundredths)
+    if flags & SCORE_DOUBLE:
+        writer.pack(DOUBLE, score)
+
+def read_pieces_activity(reader):
+    pieces_activity = {}
+    for side in SIDES:
+        pieces_activity[side] = [read_piece(reader) for _ in range(reader.byte())]
+    return pieces_activity
+
+def read_piece(reader):
+    square, kind, flags, controlled, *numbers, hundredths = reader.unpack(PIECE)
+    if flags & SCORE_HUNDREDTHS:
+        score = hundredths / 100
+    elif flags & SCORE_DOUBLE:
+        score = reader.unpack(DOUBLE)[0]
+    else:
+        score = 'N/A'
+
+    return PieceActivity(
+        f'{SIDES[kind >> 3]} {PIECE_KINDS[kind & 7]} of {UPPER_SQUARE_NAMES[square]}',
+        controlled if flags & CONTROLLED else None,
+        *[NUMBER_TEXTS[value] if flags & 1 << bit else None for bit, value in enumerate(numbers)],
+        bool(flags & LONG_DIAGONAL), bool(flags & OPEN_COLUMN), bool(flags & QUEEN_PINNED),
+        score
+    )
+
+def write_threats(writer, threats):
+    for side in SIDES:
+        side_threats = threats[side]
+        writer.byte(sum(1 << bit for bit, key in enumerate(THREAT_KEYS) if key in side_threats))
+        for key in THREAT_KEYS:
+            if key in side_threats:
+                writer.squares(side_threats[key], UPPER_SQUARE_INDEXES)
+
+def read_threats(reader):
+    threats = {}
+    for side in SIDES:
+        present = reader.byte()
+        threats[side] = {key: reader.squares(UPPER_SQUARE_NAMES)
+                         for bit, key in enumerate(THREAT_KEYS) if present & 1 << bit}
+    return threats
+
+def serialize_analysis(trace):
+    """
+    Returns the packed analysis, or its JSON when it can't be packed exactly.
+    """
+    try:
+        return pack_analysis(trace)
+    except ValueError:
+        return json.dumps(trace.to_dict(), separators=(',', ':'))
+
+def deserialize_analysis(serialized):
+    """
+    Returns the analysis dict of a packed analysis or of its JSON. Stores
+    written before analyses were packed hold JSON.
+    """
+    if isinstance(serialized, str):
+        return json.loads(serialized)
+    return unpack_analysis(serialized)
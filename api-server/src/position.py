@@ -0,0 +1,68 @@
+import chess
+import chess.polyglot
+
+def normalize_fen(fen):
+    """
+    Returns the part of the FEN that determines the parsed analysis.
+    The halfmove and fullmove counters are dropped, they do not change
+    any of the traced evaluation sections.
+    """
+    return ' '.join(fen.split()[:4])
+
+def position_key(board):
+    """
+    Returns the polyglot Zobrist hash of the board as a signed 64 bit
+    integer, the range SQLite stores. Move counters are not part of it.
+    """
+    key = chess.polyglot.zobrist_hash(board)
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+class InvalidPosition(ValueError):
+    pass
+
+class Position:
+    """
+    A position parsed once, when the request arrives, and passed to every
+    stage that needs it. key, the Zobrist hash, identifies it in memory and
+    normalized_fen where it is stored. The board keeps the moves played from
+    the root of the game, it is shared and must not be changed.
+    """
+    def __init__(self, board):
+        self.board = board
+        self.fen = board.fen()
+        self.normalized_fen = normalize_fen(self.fen)
+        self.key = position_key(board)
+        self.moves = [move.uci() for move in board.move_stack]
+        self.root_fen = board.root().fen() if self.moves else self.fen
+
+    @classmethod
+    def parse(cls, fen, moves=()):
+        """
+        Returns the position reached by the UCI moves played from fen.
+        Raises InvalidPosition for a wrong FEN, an illegal move or a position
+        that can't happen in a game, which could crash the engine.
+        """
+        try:
+            board = chess.Board(fen)
+        except ValueError:
+            raise InvalidPosition(f'Wrong value for fen parameter: {fen}')
+        if not board.is_valid():
+            raise InvalidPosition(f'Wrong value for fen parameter, it is not a legal position: {fen}')
+
+        for move in moves:
+            try:
+                board.push_uci(move)
+            except ValueError:
+                raise InvalidPosition(f'Wrong value for moves parameter, {move} is not legal in {board.fen()}')
+        return cls(board)
+
+    def previous(self):
+        """
+        Returns the position before the last move and the move.
+        """
+        board = self.board.copy()
+        move = board.pop()
+        return Position(board), move
+
+    def is_initial(self):
+        return self.board.board_fen() == chess.STARTING_BOARD_FEN
@@ -0,0 +1,156 @@
+"""
+Precomputes the answers of every aspect for the most requested positions.
+
+    python precompute_answers.py --log access.log --top 1000
+    python precompute_answers.py --pgn games.pgn --depth 16 --top 5000 --concurrency 4
+
+Ranks the positions by how often they were asked for in the access logs of
+the server, or reached in the games of a PGN database, and answers the top
+ones for all aspects through the same pipeline as /analyze, engine, prompt
+and model included. The answers go to the SQLite file the server reads through
+ANSWER_TABLE_PATH, keyed by the polyglot Zobrist hash of the position, and
+are served from there before anything else runs. Answers already in the
+table are skipped, so an interrupted run continues where it stopped.
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import time
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+from dotenv import load_dotenv
+from answer_table import AnswerTableWriter
+from position import Position, InvalidPosition
+from warm_cache import positions_from_pgn
+
+REQUEST_LINE = re.compile(r'"GET (/analyze(?:/stream)?\?[^ "]*)')
+
+def positions_from_log(path):
+    with open(path, errors='replace') as f:
+        for line in f:
+            match = REQUEST_LINE.search(line)
+            if match is None:
+                continue
+            query = parse_qs(urlsplit(match[1]).query)
+            # Answers of game steps also cover the last move, they are not precomputed
+            if 'fen' in query and 'moves' not in query:
+                yield query['fen'][0]
+
+def rank_positions(fens, top):
+    """
+    Returns the top most frequent positions, the most frequent first.
+    The initial position is left out, the server never asks about it.
+    """
+    counts = Counter()
+    positions = {}
+    for fen in fens:
+        try:
+            position = Position.parse(fen)
+        except InvalidPosition:
+            continue
+        if position.is_initial():
+            continue
+        counts[position.key] += 1
+        positions.setdefault(position.key, position)
+    return [positions[key] for key, _ in counts.most_common(top)]
+
+async def answer_position(server, position, aspects, semaphore):
+    """
+    Answers the aspects of the position. The first one, which reads every
+    section, runs alone so the others find the analysis in the cache.
+    Returns the position and (aspect, answer, error) for each aspect.
+    """
+    async def answer(aspect):
+        while True:
+            try:
+                return aspect, await server.answer_question(aspect, position), None
+            except server.EngineBusy as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                return aspect, None, str(e)
+
+    async with semaphore:
+        first = await answer(aspects[0])
+        return position, [first] + list(await asyncio.gather(*[answer(aspect) for aspect in aspects[1:]]))
+
+async def precompute(server, table, pending, concurrency):
+    """
+    Answers the pending (position, aspects) pairs, writing every answer as it arrives.
+    Returns the number of answers that failed.
+    """
+    await server.start_executor()
+    semaphore = asyncio.Semaphore(concurrency)
+    total = sum(len(aspects) for _, aspects in pending)
+    done = 0
+    failed = 0
+    start = time.perf_counter()
+    for task in asyncio.as_completed([answer_position(server, position, aspects, semaphore)
+                                      for position, aspects in pending]):
+        position, answers = await task
+        for aspect, answer, error in answers:
+            done += 1
+            if error is None:
+                table.put(position, aspect, answer)
+            else:
+                failed += 1
+                print(f'\n{position.fen} {aspect}: {error}', file=sys.stderr)
+        report_progress(done, failed, total, start)
+    return failed
+
+def report_progress(done, failed, total, start):
+    elapsed = time.perf_counter() - start
+    rate = done / elapsed if elapsed else 0
+    remaining = (total - done) / rate if rate else 0
+    print(f'\r{done}/{total} answers, {failed} failed, {rate:.1f} answers/sec, '
+          f'{remaining / 60:.1f} min left', end='', file=sys.stderr, flush=True)
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--log', action='append', default=[], help='access log of the server, can be repeated')
+    parser.add_argument('--pgn', action='append', default=[], help='PGN database, can be repeated')
+    parser.add_argument('--depth', type=int, default=12, help='plies to walk from the start of each game')
+    parser.add_argument('--top', type=int, default=1000, help='positions to answer')
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('STOCKFISH_POOL_SIZE', '1')),
+                        help='positions answered at the same time')
+    parser.add_argument('--db', default=os.getenv('ANSWER_TABLE_PATH', 'data/answer_table.sqlite3'))
+    args = parser.parse_args()
+
+    if not args.log and not args.pgn:
+        parser.error('at least one --log or --pgn is required')
+
+    # The server module brings the pipeline with the settings of the environment
+    import app as server
+
+    fens = [fen for path in args.log for fen in positions_from_log(path)]
+    fens += [fen for path in args.pgn for fen in positions_from_pgn(path, args.depth)]
+    positions = rank_positions(fens, args.top)
+
+    table = AnswerTableWriter(args.db, server.chatgpt_version, server.prompt_version())
+    stored = table.stored_keys()
+    pending = []
+    for position in positions:
+        aspects = [aspect for aspect in server.aspects if (position.key, aspect) not in stored]
+        if aspects:
+            pending.append((position, aspects))
+    print(f'{len(positions)} positions, {len(positions) - len(pending)} already answered, '
+          f'{len(pending)} to answer', file=sys.stderr)
+    if not pending:
+        return
+
+    try:
+        failed = asyncio.run(precompute(server, table, pending, args.concurrency))
+    except KeyboardInterrupt:
+        print('\nInterrupted. Run again to resume.', file=sys.stderr)
+        sys.exit(1)
+    finally:
+        table.close()
+
+    print(file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+import re
+from metrics import registry
+
+prompt_tokens = registry.summary('chess_assistant_prompt_tokens',
+                                 'Estimated tokens of the position context of each prompt, by aspect.', 'aspect')
+uncompacted_tokens = registry.summary('chess_assistant_prompt_uncompacted_tokens',
+                                      'Estimated tokens the same context took as raw dicts, by aspect.', 'aspect')
+
+SIDES = ['White', 'Black']
+PIECE_LETTERS = {'King': 'K', 'Queen': 'Q', 'Rook': 'R', 'Bishop': 'B', 'Knight': 'N'}
+EMPTY_VALUES = [None, '', 'None', 'N/A', [], {}]
+
+# Shorter wording for the most verbose labels and values of the parsed analysis
+LABELS = {
+    'Squares to Promotion': 'to promotion',
+    'Enemy King Distance': 'enemy king at',
+    'Blocked Status': '',
+    'Squares where our pawns could push on the next move': 'Pawn pushes',
+    'Controlled squares': 'controls',
+    'Moveable squares': 'moves',
+    'Distance from king': 'king distance',
+    'Pawns on same color squared': 'own pawns on its color',
+    'Enemy pawns x-rayed': 'x-rays pawns'
+}
+VALUES = {
+    'Is not blocked and free to advance': 'free',
+    'Is blocked and can not advance': 'blocked'
+}
+
+PIECE_NAME = re.compile(r'(White|Black) (\w+) of ([A-H][1-8])')
+PUNCTUATION = ',:;|{}[]\'()-+.'
+# Tokens of the line that tells how many lines of a section were cut
+OMITTED_TOKENS = 5
+
+def estimate_tokens(text):
+    """
+    Approximates the tokens of the text for the model's tokenizer, about four
+    characters each. Punctuation and spaces count for more, as they mostly
+    end up in tokens of their own. Counting is cheap enough for every prompt.
+    """
+    return (len(text) + 2 * sum(text.count(mark) for mark in PUNCTUATION) + text.count(' ')) // 4
+
+def parse_budgets(text):
+    """
+    Reads 'aspect=tokens' pairs separated by commas.
+    """
+    budgets = {}
+    for pair in text.split(','):
+        if '=' in pair:
+            aspect, tokens = pair.split('=', 1)
+            budgets[aspect.strip()] = int(tokens)
+    return budgets
+
+def is_empty(value):
+    return value in EMPTY_VALUES
+
+def format_value(value):
+    if isinstance(value, bool):
+        return 'yes' if value else 'no'
+    if isinstance(value, float):
+        return f'{value:g}'
+    if isinstance(value, dict):
+        # Passed pawns, by square
+        return '; '.join(f'{key} {format_fields(fields)}' if isinstance(fields, dict) else f'{key} {format_value(fields)}'
+                         for key, fields in value.items())
+    if isinstance(value, list):
+        if any(isinstance(item, list) for item in value):
+            return ', '.join(format_value(item) for item in value)
+        return ' '.join(format_value(item) for item in value)
+    return VALUES.get(value, str(value))
+
+def format_fields(fields):
+    parts = []
+    for label, value in fields.items():
+        if is_empty(value):
+            continue
+        label = LABELS.get(label, label)
+        parts.append(f'{label} {format_value(value)}' if label else format_value(value))
+    return ', '.join(parts)
+
+def side_groups(section):
+    """
+    Pairs the 'White ...' and 'Black ...' entries of a section by the rest of their name.
+    """
+    groups = {}
+    for key, value in section.items():
+        side, _, name = key.partition(' ')
+        if side not in SIDES:
+            side, name = None, key
+        groups.setdefault(name[:1].upper() + name[1:], {})[side] = value
+    return groups
+
+def table_rows(rows):
+    """
+    Returns 'label: white | black' lines, leaving out the rows empty for both sides.
+    """
+    lines = []
+    for label, values in rows:
+        if all(is_empty(values.get(side)) for side in SIDES) and is_empty(values.get(None)):
+            continue
+        if None in values:
+            lines.append(f'{label}: {format_value(values[None])}')
+        else:
+            cells = [format_value(values.get(side)) if not is_empty(values.get(side)) else '-' for side in SIDES]
+            lines.append(f'{LABELS.get(label, label)}: {" | ".join(cells)}')
+    return lines
+
+def format_info(item):
+    label, separator, value = item.partition(': ')
+    if not separator:
+        return item
+    return f'{LABELS.get(label, label)} {value.removesuffix(" squares")}'
+
+def piece_lines(side, pieces):
+    lines = []
+    for piece in pieces:
+        match = PIECE_NAME.fullmatch(piece.get('Piece', ''))
+        name = f'{PIECE_LETTERS.get(match[2], "")}{match[3].lower()}' if match else piece.get('Piece', '')
+        info = ', '.join(format_info(item) for item in piece.get('Piece info', []))
+        score = piece.get('Piece score')
+        score = f' score {format_value(score)}' if not is_empty(score) else ''
+        lines.append(f'{side} {name}{score}: {info}' if info else f'{side} {name}{score}')
+    return lines
+
+def compile_section(section):
+    """
+    Returns the lines of an analysis section: per side tables of its fields,
+    or one line per piece for the piece activity.
+    """
+    if not isinstance(section, dict):
+        return [format_value(section)]
+
+    groups = side_groups(section)
+    if len(groups) == 1:
+        values = next(iter(groups.values()))
+        if all(isinstance(value, dict) for value in values.values()):
+            labels = []
+            for value in values.values():
+                labels += [label for label in value if label not in labels]
+            return table_rows([(label, {side: value.get(label) for side, value in values.items()}) for label in labels])
+        if all(isinstance(value, list) and all(isinstance(item, dict) for item in value) for value in values.values()):
+            lines = []
+            for side, pieces in values.items():
+                lines += piece_lines(side, pieces)
+            return lines
+    return table_rows(groups.items())
+
+def compile_pieces(piece_locations):
+    """
+    Returns the pieces of each side as in 'White: Kg1 Qd1 Nf3, pawns a2 b2'.
+    """
+    sides = []
+    for side in SIDES:
+        pieces = {name: [] for name in list(PIECE_LETTERS) + ['Pawn']}
+        for square, piece in piece_locations.items():
+            color, _, name = piece.partition(' ')
+            if color == side and name in pieces:
+                pieces[name].append(square)
+        listed = ' '.join(f'{PIECE_LETTERS[name]}{square}' for name in PIECE_LETTERS for square in pieces[name])
+        if pieces['Pawn']:
+            listed += f'{", " if listed else ""}pawns {" ".join(pieces["Pawn"])}'
+        sides.append(f'{side}: {listed}')
+    return 'Pieces: ' + '; '.join(sides)
+
+def compile_changes(changes, path=()):
+    """
+    Returns a line per changed field, 'section, field: before -> after' or the squares added and removed.
+    """
+    lines = []
+    for key, change in changes.items():
+        if 'before' in change and 'after' in change and len(change) == 2:
+            before = format_value(change['before']) if not is_empty(change['before']) else '-'
+            after = format_value(change['after']) if not is_empty(change['after']) else '-'
+            lines.append(f'{", ".join(path + (key,))}: {before} -> {after}')
+        elif 'added' in change and 'removed' in change and len(change) == 2:
+            squares = [f'+{square}' for square in change['added']] + [f'-{square}' for square in change['removed']]
+            lines.append(f'{", ".join(path + (key,))}: {" ".join(squares)}')
+        else:
+            lines += compile_changes(change, path + (key,))
+    return lines
+
+class PromptCompiler:
+    """
+    Writes the position context of a prompt, pieces, analysis and the changes
+    of the last move, in a dense and deterministic text instead of Python
+    reprs. Empty fields are left out and the analysis is cut down to the
+    token budget of the aspect, the longest sections first.
+    """
+    def __init__(self, default_budget=500, budgets=None):
+        self.default_budget = default_budget
+        self.budgets = budgets or {}
+
+    def budget(self, aspect):
+        return self.budgets.get(aspect, self.default_budget)
+
+    def compile(self, aspect, piece_locations, sections, last_move=None):
+        """
+        Returns the context for the analysis sections, a dict by section name,
+        its estimated tokens and the ones the sections took as raw dicts. Both
+        are recorded in the process metrics.
+        """
+        head = [compile_pieces(piece_locations)]
+        if last_move and last_move['changes']:
+            head += [f"Changes after the last move, {last_move['move']}:"] + compile_changes(last_move['changes'])
+
+        compiled = [(name, compile_section(section)) for name, section in sections.items()]
+        text, tokens = self.fit(head, compiled, self.budget(aspect))
+
+        # What the context took when the dicts went in as they are, to track the savings
+        raw_analysis = next(iter(sections.values())) if len(sections) == 1 else sections
+        raw_tokens = estimate_tokens(f'Piece Locations:\n{piece_locations}\nPre-analysis:\n{raw_analysis}')
+        prompt_tokens.observe(aspect, tokens)
+        uncompacted_tokens.observe(aspect, raw_tokens)
+        return text, tokens, raw_tokens
+
+    def fit(self, head, compiled, budget):
+        """
+        Drops the last lines of the longest section until the text is within
+        the budget. Returns the text and its estimated tokens.
+        """
+        omitted = {name: 0 for name, _ in compiled}
+        tokens = estimate_tokens(self.render(head, compiled, omitted))
+        while tokens > budget:
+            name, lines = max(compiled, key=lambda section: len(section[1]), default=(None, []))
+            if not lines:
+                break
+            tokens -= estimate_tokens(lines.pop())
+            if not omitted[name]:
+                tokens += OMITTED_TOKENS
+            omitted[name] += 1
+
+        text = self.render(head, compiled, omitted)
+        return text, estimate_tokens(text)
+
+    def render(self, head, compiled, omitted):
+        lines = list(head)
+        for name, section_lines in compiled:
+            lines.append(f'{name} (White | Black):' if any(' | ' in line for line in section_lines) else f'{name}:')
+            lines += section_lines
+            if omitted[name]:
+                lines.append(f'({omitted[name]} more omitted)')
+        return '\n'.join(lines)
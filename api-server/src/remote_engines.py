@@ -0,0 +1,256 @@
+import atexit
+import socket
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import httpx
+from engine_pool import EngineError
+
+# Games remembered with the worker holding them, to keep sending them there
+GAMES_SIZE = 1024
+
+def resolve(url):
+    """
+    Returns the URL of every address the host of url resolves to, so the
+    replicas behind one service name are used as separate workers.
+    """
+    parts = urlsplit(url)
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, parts.port or 80, type=socket.SOCK_STREAM)
+    except OSError:
+        return [url]
+
+    # localhost and the like resolve to both families, the same worker is only counted once
+    if any(family == socket.AF_INET for family, *_ in addresses):
+        addresses = [address for address in addresses if address[0] == socket.AF_INET]
+
+    urls = []
+    for family, _, _, _, address in addresses:
+        host = f'[{address[0]}]' if family == socket.AF_INET6 else address[0]
+        node = f'{parts.scheme}://{host}:{address[1]}'
+        if node not in urls:
+            urls.append(node)
+    return urls
+
+class EngineNode:
+    """
+    An engine worker as seen from this api-server: the engines it has, the
+    analyses this server has running on it and the ones the others have,
+    as of its last health check.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.engines = 1
+        self.in_flight = 0
+        self.others = 0
+        self.restarts = 0
+
+    def load(self):
+        return (self.in_flight + self.others) / self.engines
+
+class RemoteEngine:
+    """
+    An engine checked out on a worker, with the interface of StockfishEngine
+    that PositionAnalyzer uses. Every call is one request to the worker.
+    """
+    def __init__(self, pool, node, game):
+        self.pool = pool
+        self.node = node
+        self.game = game
+        self.options = {}
+
+    def set_options(self, options):
+        # Sent along with the next search, the worker only changes the ones that differ
+        self.options.update(options)
+
+    def evaluate(self, fen, moves=()):
+        response = self.pool.request('POST', self.node, '/evaluate',
+                                     json={'fen': fen, 'moves': list(moves), 'game': self.game})
+        return response.json()['output']
+
+    def search(self, fen, moves, limits, timeout, stop=None):
+        """
+        Yields the lines of the search as the worker streams them. Setting the
+        stop event asks the worker to stop it, closing the generator drops the
+        connection, which stops it too.
+        """
+        search_id = uuid.uuid4().hex
+        body = {'id': search_id, 'fen': fen, 'moves': list(moves), 'options': self.options,
+                'limits': limits, 'timeout': timeout}
+        done = threading.Event()
+        if stop is not None:
+            threading.Thread(target=self.forward_stop, args=(search_id, stop, done), daemon=True).start()
+
+        try:
+            with self.pool.stream(self.node, '/search', body, timeout) as lines:
+                for line in lines:
+                    if line.startswith('error '):
+                        raise EngineError(line[len('error '):])
+                    yield line + '\n'
+        finally:
+            done.set()
+
+    def forward_stop(self, search_id, stop, done):
+        while not done.is_set():
+            if stop.wait(0.05):
+                try:
+                    self.pool.request('POST', self.node, '/search/stop', json={'id': search_id})
+                except EngineError:
+                    pass
+                return
+
+class RemoteEnginePool:
+    """
+    The engines of one or more engine workers, with the interface of
+    EnginePool. Each analysis goes to the least loaded healthy worker, games
+    stay on the worker that analyzed their previous positions while it has
+    engines to spare. Workers are checked every health_interval seconds,
+    one that fails a request is skipped until it answers again.
+    """
+    def __init__(self, urls, command_timeout=10.0, checkout_timeout=30.0, health_interval=5.0,
+                 max_connections=100):
+        self.urls = urls
+        self.command_timeout = command_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_interval = health_interval
+        self.nodes = {}
+        self.games = OrderedDict()
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.client = httpx.Client(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            # A request may wait for a free engine on the worker before it runs
+            timeout=httpx.Timeout(checkout_timeout + command_timeout, connect=2.0)
+        )
+
+        self.discover()
+        threading.Thread(target=self.check_health, daemon=True).start()
+        atexit.register(self.close)
+
+    @property
+    def size(self):
+        with self.lock:
+            return sum(node.engines for node in self.nodes.values() if node.healthy)
+
+    @property
+    def restarts(self):
+        with self.lock:
+            return sum(node.restarts for node in self.nodes.values())
+
+    @contextmanager
+    def engine(self, game=None):
+        """
+        Checks out an engine on a worker, the one holding the game when it has a free engine.
+        """
+        node = self.choose(game)
+        try:
+            yield RemoteEngine(self, node, game)
+        finally:
+            with self.lock:
+                node.in_flight -= 1
+
+    def choose(self, game):
+        with self.lock:
+            healthy = [node for node in self.nodes.values() if node.healthy]
+            if not healthy:
+                raise EngineError('No engine worker is available')
+
+            node = self.nodes.get(self.games.get(game)) if game is not None else None
+            if node is None or not node.healthy or node.load() >= 1:
+                node = min(healthy, key=EngineNode.load)
+            if game is not None:
+                self.games[game] = node.url
+                self.games.move_to_end(game)
+                while len(self.games) > GAMES_SIZE:
+                    self.games.popitem(last=False)
+
+            node.in_flight += 1
+            return node
+
+    def request(self, method, node, path, **kwargs):
+        try:
+            response = self.client.request(method, node.url + path, **kwargs)
+        except httpx.TransportError as e:
+            self.mark_unhealthy(node)
+            raise EngineError(f'Engine worker {node.url} did not answer: {e}')
+        if response.status_code != 200:
+            raise EngineError(f'Engine worker {node.url} failed: {response.text}')
+        return response
+
+    @contextmanager
+    def stream(self, node, path, body, timeout):
+        """
+        Yields the lines of a streamed response. timeout is the longest the worker may stay silent.
+        """
+        timeout = httpx.Timeout(timeout + self.checkout_timeout, connect=2.0)
+        try:
+            with self.client.stream('POST', node.url + path, json=body, timeout=timeout) as response:
+                if response.status_code != 200:
+                    raise EngineError(f'Engine worker {node.url} failed: {response.read().decode()}')
+                yield response.iter_lines()
+        except httpx.TransportError as e:
+            self.mark_unhealthy(node)
+            raise EngineError(f'Engine worker {node.url} did not answer: {e}')
+
+    def mark_unhealthy(self, node):
+        with self.lock:
+            node.healthy = False
+
+    def discover(self):
+        """
+        Resolves the worker URLs again, adding the replicas that appeared and dropping the ones that are gone.
+        """
+        urls = [node for url in self.urls for node in resolve(url)]
+        with self.lock:
+            for url in urls:
+                if url not in self.nodes:
+                    self.nodes[url] = EngineNode(url)
+            for url in list(self.nodes):
+                if url not in urls and self.nodes[url].in_flight == 0:
+                    del self.nodes[url]
+
+    def check_health(self):
+        while not self.closed.wait(self.health_interval):
+            try:
+                self.discover()
+                self.health_check()
+            except Exception as e:
+                # The next poll tries again, a dead thread would leave the workers down for good
+                print(str(e))
+
+    def health_check(self):
+        """
+        Asks every worker for its engines and load. Returns the number of healthy engines.
+        """
+        with self.lock:
+            nodes = list(self.nodes.values())
+
+        for node in nodes:
+            try:
+                response = self.client.get(node.url + '/health', timeout=2.0)
+                health = response.json()
+                engines, busy, restarts = int(health['engines']), int(health['busy']), int(health['restarts'])
+            except (httpx.HTTPError, ValueError, KeyError, TypeError):
+                # A worker answering something else than its health is skipped like one that is down
+                self.mark_unhealthy(node)
+                continue
+
+            with self.lock:
+                node.healthy = response.status_code == 200
+                node.engines = max(1, engines)
+                node.restarts = restarts
+                # The busy engines of the worker include the analyses sent from here
+                node.others = max(0, busy - node.in_flight)
+        return self.size
+
+    def stats(self):
+        with self.lock:
+            return [{'url': node.url, 'healthy': node.healthy, 'engines': node.engines, 'load': node.load()}
+                    for node in self.nodes.values()]
+
+    def close(self):
+        self.closed.set()
+        self.client.close()
@@ -0,0 +1,223 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from position import normalize_fen
+
+def response_key(fen, aspect, model, prompt_version, previous=None, phase=None):
+    """
+    previous is the position before the last move and the move, for the
+    answers that also talk about what the move changed. phase is the game
+    phase, for the answers whose prompt depends on it.
+    """
+    parts = [normalize_fen(fen), aspect, model or '', prompt_version]
+    if previous is not None:
+        parts.append(previous)
+    if phase is not None:
+        parts.append(phase)
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+class ResponseCache:
+    """
+    Bounded LRU cache of model answers with a time to live. Concurrent
+    requests for the same key share one in-flight completion. An optional
+    SQLite file keeps the answers across restarts.
+    The coroutines must all run on the same event loop.
+    """
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=24 * 60 * 60, db_path=None, max_rows=100000):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.in_flight = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        if db_path:
+            self.create_table()
+            self.prune()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def create_table(self):
+        with self.connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, answer TEXT NOT NULL, created REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS responses_created ON responses (created)')
+
+    async def get_or_create(self, key, create):
+        """
+        Returns the cached answer for the key, or awaits create() to make it.
+        Requests arriving while it runs wait for the same answer.
+        """
+        answer = await self.claim(key)
+        if answer is not None:
+            return answer
+
+        try:
+            answer = await create()
+        except BaseException:
+            self.fail(key)
+            raise
+
+        await self.finish(key, answer)
+        return answer
+
+    async def claim(self, key):
+        """
+        Returns the cached or shared answer for the key. Returns None once the
+        caller owns the key, it must then call finish() or fail().
+        """
+        # A failed shared completion leaves its waiters on a miss, one of them then makes its own
+        while True:
+            answer = await self.lookup(key)
+            if answer is not None:
+                return answer
+            if self.begin(key) is not None:
+                return None
+
+    async def lookup(self, key):
+        """
+        Returns the cached answer, waiting for an in-flight completion of the
+        same key if there is one. Returns None on a miss.
+        """
+        answer = self.get(key)
+        if answer is not None:
+            return answer
+
+        if key in self.in_flight:
+            with self.lock:
+                self.coalesced += 1
+            try:
+                return await asyncio.shield(self.in_flight[key])
+            except Exception:
+                return None
+
+        row = await asyncio.to_thread(self.load, key)
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.store(key, *row)
+        return row[0]
+
+    def begin(self, key):
+        """
+        Marks the key as being answered. Returns None when another request already is.
+        """
+        if key in self.in_flight:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        return future
+
+    async def finish(self, key, answer):
+        future = self.in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(answer)
+
+        with self.lock:
+            self.store(key, answer, time.time())
+        await asyncio.to_thread(self.save, key, answer)
+
+    def fail(self, key):
+        future = self.in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_exception(RuntimeError('The shared completion failed'))
+            # Nobody may be waiting, the exception is consumed here to keep asyncio quiet
+            future.exception()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+
+            answer, _, created = self.entries[key]
+            if time.time() - created > self.ttl:
+                self.current_bytes -= self.entries.pop(key)[1]
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return answer
+
+    def store(self, key, answer, created):
+        size = len(answer.encode())
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.current_bytes -= self.entries.pop(key)[1]
+
+        self.entries[key] = (answer, size, created)
+        self.current_bytes += size
+
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+
+    def load(self, key):
+        if not self.db_path:
+            return None
+
+        return self.connection().execute(
+            'SELECT answer, created FROM responses WHERE key = ? AND created > ?', (key, time.time() - self.ttl)
+        ).fetchone()
+
+    def save(self, key, answer):
+        if not self.db_path:
+            return
+
+        with self.connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO responses (key, answer, created) VALUES (?, ?, ?)',
+                (key, answer, time.time())
+            )
+
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            self.prune()
+
+    def prune(self):
+        """
+        Deletes expired answers from the SQLite store and the oldest ones beyond max_rows.
+        """
+        with self.connection() as connection:
+            connection.execute('DELETE FROM responses WHERE created <= ?', (time.time() - self.ttl,))
+            connection.execute(
+                'DELETE FROM responses WHERE key IN ('
+                'SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)',
+                (self.max_rows,)
+            )
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'coalesced': self.coalesced,
+                'misses': self.misses,
+                'in_flight': len(self.in_flight),
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes
+            }
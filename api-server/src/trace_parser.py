@@ -0,0 +1,639 @@
+import re
+from dataclasses import dataclass, field
+import chess
+from board_features import BoardFeatures, square_names
+
+SQUARE_LIST = r'[A-H][1-8](?:, [A-H][1-8])*'
+
+PIECE_LINE = (
+    rf'Squares controlled by the \w+: (?P<controlled>{SQUARE_LIST})'
+    r'|The \w+ can move to: (?P<moveable_squares>\d+) squares'
+    r'|The \w+ is (?P<king_distance>\d+) squares far from our king'
+    r'|Pawns on the same bishop color squared: (?P<same_color_pawns>\d+)'
+    r'|Number of enemy pawns x-rayed: (?P<x_rayed_pawns>\d+)'
+    r'|(?P<long_diagonal>The bishop is on a long diagonal and can see both center squares\.)'
+    r'|(?P<open_column>The rook is on \(semi-\)open column\.)'
+    r'|(?P<queen_pinned>Exists pin in or discover attack over de queen\.)'
+)
+PIECE_FIELDS = [
+    'controlled', 'moveable_squares', 'king_distance', 'same_color_pawns',
+    'x_rayed_pawns', 'long_diagonal', 'open_column', 'queen_pinned'
+]
+
+# Every line the parser cares about starts with one of these tokens. Tokens
+# include the newline before them, which lets the regex engine jump from line
+# to line and skip the uninteresting ones without reaching Python.
+TOKEN = re.compile(
+    r'\n(?:'
+    r'(?P<piece_header>\w++ \w++ of square(?: \w\d)?)'
+    r'|[ \t]*+(?:'
+    r'(?P<blank>$)'
+    r'|(?P<piece_score>\w++ \w++ of \w\d: [\d.]+)'
+    r'|(?P<material_header>(?:White|Black) matetial:)'
+    r'|(?P<material_field>(?:Pawns|Bishops|Bishops pair|Knight|Rooks|Queens):[^\n]*)'
+    r'|(?P<pawn_structure_header>Pawn structure of (?:White|Black))'
+    r'|(?P<passed_section>Passed pawns of [^\n]*)'
+    r'|(?P<passed_header>Passed pawn of \w\d+ square:)'
+    r'|(?P<passed_info>Is at \d+ squares of promotion'
+    r'|The king enemy is at \d+ squares of distance of it'
+    r'|Is blocked and can not advance|Is not blocked and free to advance)'
+    rf'|(?P<piece_line>{PIECE_LINE})'
+    r'|(?P<king_header>(?:White|Black) King safety)'
+    r'|(?P<king_label>(?:Squares attacked at King flank|Squares attacked twice at King flank'
+    r'|Squares defended at King flank|(?:Bishop|Knight|Rook|Queen) checks availables):[^\n]*)'
+    rf'|(?P<square_list>{SQUARE_LIST})'
+    r'|(?P<threats_title>Trheats)'
+    r'|(?P<threat_header>Threads of (?:White|Black)[^\n]*)'
+    r'|(?P<threat_label>(?:Enemies atacked by \w+|Squares where our pawns can push on the next move):[^\n]*)'
+    r'|(?P<space_header>Space of (?:White|Black):)'
+    r'|(?P<space_label>Squares behind or at our pawns:[^\n]*)'
+    r'))',
+    re.MULTILINE
+)
+
+LIST_AFTER_SPACE = re.compile(rf' ({SQUARE_LIST})')
+LIST_AFTER_WHITESPACE = re.compile(rf'\s*({SQUARE_LIST})')
+LIST_AT_START = re.compile(rf'({SQUARE_LIST})')
+PASSED_PAWN_HEADER = re.compile(r'Passed pawn of (\w\d+) square:')
+PIECE_HEADER = re.compile(r'(\w+ \w+) of square (\w\d)')
+PIECE_SCORE = re.compile(r'(\w+ \w+) of (\w\d): ([\d.]+)')
+NUMBER = re.compile(r'\d+')
+MATERIAL_FIELDS = [
+    ('pawns', re.compile(r'Pawns: (\d+)')),
+    ('bishops', re.compile(r'Bishops: (\d+)')),
+    ('bishops_pair', re.compile(r'Bishops pair:(true|false)')),
+    ('knights', re.compile(r'Knight: (\d+)')),
+    ('rooks', re.compile(r'Rooks: (\d+)')),
+    ('queens', re.compile(r'Queens: (\d+)'))
+]
+
+KING_SAFETY_LABELS = {
+    'Squares attacked at King flank': 'attacked',
+    'Squares attacked twice at King flank': 'double_attacked',
+    'Squares defended at King flank': 'defended',
+    'Bishop checks availables': 'Bishop',
+    'Knight checks availables': 'Knight',
+    'Rook checks availables': 'Rook',
+    'Queen checks availables': 'Queen'
+}
+CHECK_PIECES = ['Bishop', 'Knight', 'Rook', 'Queen']
+
+THREAT_LABELS = {
+    'Enemies atacked by knights': ('Enemies could be attacked by knights', LIST_AFTER_SPACE),
+    'Enemies atacked by Bishops': ('Enemies could be attacked by Bishops', LIST_AFTER_SPACE),
+    'Enemies atacked by rooks': ('Enemies could be attacked by rooks', LIST_AFTER_SPACE),
+    'Enemies atacked by Queens': ('Enemies could be attacked by Queens', LIST_AFTER_SPACE),
+    'Enemies atacked by king': ('Enemies could be attacked by king', LIST_AFTER_SPACE),
+    'Squares where our pawns can push on the next move':
+        ('Squares where our pawns could push on the next move', LIST_AT_START)
+}
+THREAT_KEYS = [key for key, _ in THREAT_LABELS.values()]
+
+SIDES = ['White', 'Black']
+
+@dataclass(slots=True)
+class Material:
+    pawns: int
+    bishops: int
+    bishops_pair: bool
+    knights: int
+    rooks: int
+    queens: int
+
+    def to_dict(self):
+        return {
+            'Pawns': self.pawns,
+            'Bishops': self.bishops,
+            'Bishops pair': self.bishops_pair,
+            'Knights': self.knights,
+            'Rooks': self.rooks,
+            'Queens': self.queens
+        }
+
+@dataclass(slots=True)
+class PassedPawn:
+    squares_to_promotion: list = field(default_factory=list)
+    enemy_king_distance: list = field(default_factory=list)
+    blocked_status: list = field(default_factory=list)
+
+    def to_dict(self):
+        return {
+            'Squares to Promotion': self.squares_to_promotion,
+            'Enemy King Distance': self.enemy_king_distance,
+            'Blocked Status': self.blocked_status
+        }
+
+@dataclass(slots=True)
+class SidePawnStructure:
+    pawns: list = field(default_factory=list)
+    # Square -> PassedPawn, or None when the trace has no block for it.
+    # Stays empty when the trace has no passed pawns section at all.
+    passed_pawns: dict = field(default_factory=dict)
+    backward_pawns: list = field(default_factory=list)
+    isolated_pawns: list = field(default_factory=list)
+    islands: list = field(default_factory=list)
+    phalanxes: list = field(default_factory=list)
+    has_passed_section: bool = False
+
+    @classmethod
+    def from_board(cls, features, color, passed_pawns, has_passed_section):
+        """
+        Takes the pawns, backward and isolated pawns, islands and phalanxes from
+        the board features. The passed pawn details are given by the caller.
+        """
+        return cls(
+            pawns=square_names(features.pawns[color]),
+            passed_pawns=passed_pawns,
+            backward_pawns=square_names(features.backward_pawns(color)),
+            isolated_pawns=square_names(features.isolated_pawns(color)),
+            # Islands list their pawns file by file, as the trace based parser did
+            islands=[[chess.square_name(square) for square in sorted(island, key=chess.square_file)]
+                     for island in features.islands(color)],
+            phalanxes=[square_names(phalanx) for phalanx in features.phalanxes(color)],
+            has_passed_section=has_passed_section
+        )
+
+    def passed_pawns_dict(self):
+        return {
+            pawn: (info.to_dict() if info is not None else None) if self.has_passed_section else {}
+            for pawn, info in self.passed_pawns.items()
+        }
+
+@dataclass(slots=True)
+class SideKingSafety:
+    attacked: int = 0
+    double_attacked: int = 0
+    defended: int = 0
+    checks: dict = field(default_factory=dict)
+
+    def to_dict(self):
+        return {
+            'Attacked Squares': self.attacked,
+            'Double Attacked Squares': self.double_attacked,
+            'Defended Squares': self.defended,
+            'Bishop Checks': self.checks.get('Bishop', 'None'),
+            'Knight Checks': self.checks.get('Knight', 'None'),
+            'Rook Checks': self.checks.get('Rook', 'None'),
+            'Queen Checks': self.checks.get('Queen', 'None')
+        }
+
+    def check_squares(self):
+        squares = []
+        for piece in CHECK_PIECES:
+            if piece in self.checks:
+                squares.extend(self.checks[piece].split(', '))
+        return squares
+
+@dataclass(slots=True)
+class PieceActivity:
+    piece: str
+    controlled_squares: int = None
+    moveable_squares: str = None
+    king_distance: str = None
+    same_color_pawns: str = None
+    x_rayed_pawns: str = None
+    long_diagonal: bool = False
+    open_column: bool = False
+    queen_pinned: bool = False
+    score: object = 'N/A'
+
+    def piece_info(self):
+        info = []
+        if self.controlled_squares is not None:
+            info.append(f'Controlled squares: {self.controlled_squares}')
+        if self.moveable_squares is not None:
+            info.append(f'Moveable squares: {self.moveable_squares}')
+
+        if 'Bishop' in self.piece or 'Knight' in self.piece:
+            if self.king_distance is not None:
+                info.append(f'Distance from king: {self.king_distance} squares')
+
+        if 'Bishop' in self.piece:
+            if self.same_color_pawns is not None:
+                info.append(f'Pawns on same color squared: {self.same_color_pawns}')
+            if self.x_rayed_pawns is not None:
+                info.append(f'Enemy pawns x-rayed: {self.x_rayed_pawns}')
+            if self.long_diagonal:
+                info.append('On long diagonal, sees both center squares')
+
+        if 'Rook' in self.piece and self.open_column:
+            info.append('On (semi-)open column')
+
+        if 'Queen' in self.piece and self.queen_pinned:
+            info.append('Pin or discovered attack exists')
+
+        return info
+
+    def to_dict(self):
+        return {
+            'Piece': self.piece,
+            'Piece info': self.piece_info(),
+            'Piece score': self.score
+        }
+
+@dataclass(slots=True)
+class PositionTrace:
+    """
+    Typed view of a StockfishTraces eval output. Sections that could not be
+    parsed are None and are rendered as empty dicts, as the old parser did.
+    """
+    material: dict = None
+    pawn_structure: dict = None
+    king_safety: dict = None
+    pieces_activity: dict = None
+    threats: dict = None
+    space: dict = None
+
+    def material_dict(self):
+        if self.material is None:
+            return {}
+        return {
+            f'{side} material': self.material[side].to_dict() if self.material[side] else None
+            for side in SIDES
+        }
+
+    def pawn_structure_dict(self):
+        if self.pawn_structure is None:
+            return {}
+        white, black = self.pawn_structure['White'], self.pawn_structure['Black']
+        return {
+            'White Passed Pawns': white.passed_pawns_dict(),
+            'Black Passed Pawns': black.passed_pawns_dict(),
+            'White Backward Pawns': white.backward_pawns,
+            'Black Backward Pawns': black.backward_pawns,
+            'White Isolated Pawns': white.isolated_pawns,
+            'Black Isolated Pawns': black.isolated_pawns,
+            'White Pawn Islands': white.islands,
+            'Black Pawn Islands': black.islands,
+            'White Phalanx Pawns': white.phalanxes,
+            'Black Phalanx Pawns': black.phalanxes
+        }
+
+    def king_safety_dict(self):
+        return {
+            f'{side} King Safety': self.king_safety[side].to_dict() for side in SIDES
+        }
+
+    def pieces_activity_dict(self):
+        if self.pieces_activity is None:
+            return {}
+        return {
+            f'{side} pieces activity': [piece.to_dict() for piece in self.pieces_activity[side]]
+            for side in SIDES
+        }
+
+    def threats_dict(self):
+        if self.threats is None:
+            return {}
+        threats = {
+            f'{side} threads': dict(self.threats[side]) for side in SIDES
+        }
+
+        white_checks = self.king_safety['White'].check_squares()
+        if white_checks:
+            threats['Black threads']['Possible checks on White King'] = white_checks
+        black_checks = self.king_safety['Black'].check_squares()
+        if black_checks:
+            threats['White threads']['Possible checks on Black King'] = black_checks
+
+        return threats
+
+    def space_dict(self):
+        if self.space is None:
+            return {}
+        return {
+            'White space': self.space['White'],
+            'Black space': self.space['Black']
+        }
+
+    def to_dict(self):
+        return {
+            'Material': self.material_dict(),
+            'Pawn Structure': self.pawn_structure_dict(),
+            'King Safety': self.king_safety_dict(),
+            'Pieces Activity': self.pieces_activity_dict(),
+            'Threads': self.threats_dict(),
+            'Space': self.space_dict()
+        }
+
+class TraceParser:
+    """
+    Single pass parser for the StockfishTraces eval output.
+
+    The trace is tokenized once with a single precompiled pattern. Every token
+    is dispatched to the handler of its kind, which updates the state of the
+    section it belongs to, and the values are stored in a PositionTrace.
+    It reproduces the output of the former regex based parser, including
+    the way it picked the first non empty value after each header.
+    The pawn features that follow from the board alone are computed from the
+    chess.Board of the position instead of the squares listed in the trace.
+    """
+    def parse(self, raw_info, board):
+        self.reset()
+        self.features = BoardFeatures(board)
+        handlers = {
+            'piece_header': self.read_piece_header,
+            'blank': self.read_blank,
+            'piece_score': self.read_piece_score,
+            'material_header': self.read_material_header,
+            'material_field': self.read_material_field,
+            'pawn_structure_header': self.read_pawn_structure_header,
+            'passed_section': self.read_passed_section,
+            'passed_header': self.read_passed_header,
+            'passed_info': self.read_passed_info,
+            'piece_line': self.read_piece_line,
+            'king_header': self.read_king_header,
+            'king_label': self.read_king_label,
+            'square_list': self.read_square_list,
+            'threats_title': self.read_threats_title,
+            'threat_header': self.read_threat_header,
+            'threat_label': self.read_threat_label,
+            'space_header': self.read_space_header,
+            'space_label': self.read_space_label
+        }
+
+        # Line numbers are counted on the text with a leading newline, so the
+        # first line can be tokenized as well
+        self.text = '\n' + raw_info
+        for token in TOKEN.finditer(self.text):
+            line_start = token.start() + 1
+            self.line += self.text.count('\n', self.position, line_start)
+            self.position = line_start
+
+            kind = token.lastgroup
+            handlers[kind](token.group(kind), token)
+
+        return self.build_trace()
+
+    def reset(self):
+        self.line = 0
+        self.position = 0
+
+        self.material_fields = {side: {} for side in SIDES}
+        self.material_started = {side: False for side in SIDES}
+
+        self.pawn_headers = {side: None for side in SIDES}
+
+        self.passed_section_seen = {side: False for side in SIDES}
+        self.passed_section_open = {side: False for side in SIDES}
+        self.passed_blocks = {side: {} for side in SIDES}
+        self.open_passed_blocks = {side: [] for side in SIDES}
+
+        self.piece_blocks = []
+        self.current_piece = None
+        self.piece_scores = {}
+        self.invalid_piece_score = False
+
+        self.king_headers = {side: None for side in SIDES}
+        self.space_headers = {side: None for side in SIDES}
+        self.labelled_lists = {}
+        self.pending_label = None
+        self.pending_label_end = 0
+
+        self.threat_section = {side: False for side in SIDES}
+        self.threat_seen = {side: False for side in SIDES}
+        self.threats = {side: {} for side in SIDES}
+
+    def read_blank(self, text, token):
+        if token.end() - token.start() > 1:
+            return
+
+        # An empty line closes the passed pawn and piece blocks
+        for side in SIDES:
+            self.open_passed_blocks[side] = []
+        self.current_piece = None
+
+    def read_material_header(self, text, token):
+        self.material_started[text.split()[0]] = True
+
+    def read_material_field(self, text, token):
+        for side in SIDES:
+            fields = self.material_fields[side]
+            if not self.material_started[side] or len(fields) == len(MATERIAL_FIELDS):
+                continue
+
+            name, pattern = MATERIAL_FIELDS[len(fields)]
+            match = pattern.match(text)
+            if match:
+                fields[name] = match.group(1)
+
+    def read_pawn_structure_header(self, text, token):
+        side = text.split()[-1]
+        if self.pawn_headers[side] is None:
+            self.pawn_headers[side] = self.line
+
+    def read_passed_section(self, text, token):
+        for side in SIDES:
+            if self.passed_section_open[side]:
+                self.passed_section_open[side] = False
+                self.open_passed_blocks[side] = []
+
+        for side in SIDES:
+            if not self.passed_section_seen[side] and text.startswith(f'Passed pawns of {side}:'):
+                self.passed_section_seen[side] = True
+                self.passed_section_open[side] = True
+
+    def read_passed_header(self, text, token):
+        square = PASSED_PAWN_HEADER.match(text).group(1)
+        for side in SIDES:
+            if self.passed_section_open[side] and square not in self.passed_blocks[side]:
+                passed_pawn = PassedPawn()
+                self.passed_blocks[side][square] = passed_pawn
+                self.open_passed_blocks[side].append(passed_pawn)
+
+    def read_passed_info(self, text, token):
+        for side in SIDES:
+            for passed_pawn in self.open_passed_blocks[side]:
+                if text.startswith('Is at'):
+                    passed_pawn.squares_to_promotion.append(NUMBER.search(text).group())
+                elif text.startswith('The king'):
+                    passed_pawn.enemy_king_distance.append(NUMBER.search(text).group())
+                else:
+                    passed_pawn.blocked_status.append(text)
+
+    def read_piece_header(self, text, token):
+        header = PIECE_HEADER.match(text)
+        if header:
+            self.current_piece = PieceActivity(f'{header.group(1)} of {header.group(2)}')
+            self.piece_blocks.append(self.current_piece)
+        else:
+            self.current_piece = None
+
+    def read_piece_line(self, text, token):
+        piece = self.current_piece
+        if piece is None:
+            return
+
+        for value_name in PIECE_FIELDS:
+            value = token.group(value_name)
+            if value is None:
+                continue
+
+            if value_name == 'controlled':
+                if piece.controlled_squares is None:
+                    piece.controlled_squares = len(value.split(', '))
+            elif value_name in ['long_diagonal', 'open_column', 'queen_pinned']:
+                setattr(piece, value_name, True)
+            elif getattr(piece, value_name) is None:
+                setattr(piece, value_name, value)
+            return
+
+    def read_piece_score(self, text, token):
+        name, square, score = PIECE_SCORE.match(text).groups()
+        try:
+            self.piece_scores[f'{name} of {square}'] = float(score)
+        except ValueError:
+            self.invalid_piece_score = True
+
+    def read_king_header(self, text, token):
+        side = text.split()[0]
+        if self.king_headers[side] is None:
+            self.king_headers[side] = self.line
+
+    def read_king_label(self, text, token):
+        label, _, value = text.partition(':')
+        key = KING_SAFETY_LABELS[label]
+        match = LIST_AFTER_WHITESPACE.match(value)
+        if match:
+            self.record_list(key, match.group(1))
+            self.pending_label = None
+        elif not value.strip():
+            # The old patterns allowed the list to start on a following line
+            self.pending_label = key
+            self.pending_label_end = token.end()
+
+    def read_square_list(self, text, token):
+        if self.pending_label is None:
+            return
+        if not self.text[self.pending_label_end:token.start()].strip():
+            self.record_list(self.pending_label, text)
+        self.pending_label = None
+
+    def record_list(self, key, squares):
+        self.labelled_lists.setdefault(key, []).append((self.line, squares))
+
+    def read_threats_title(self, text, token):
+        for side in SIDES:
+            self.threat_section[side] = False
+
+    def read_threat_header(self, text, token):
+        side = text.split()[2].rstrip(':')
+        other = 'Black' if side == 'White' else 'White'
+        self.threat_section[other] = False
+
+        if not self.threat_seen[side] and text.startswith(f'Threads of {side}:'):
+            self.threat_seen[side] = True
+            self.threat_section[side] = True
+
+    def read_threat_label(self, text, token):
+        label, _, value = text.partition(':')
+        if label not in THREAT_LABELS:
+            return
+
+        key, pattern = THREAT_LABELS[label]
+        match = pattern.match(value)
+        if not match:
+            return
+
+        for side in SIDES:
+            if self.threat_section[side] and key not in self.threats[side]:
+                self.threats[side][key] = match.group(1).split(', ')
+
+    def read_space_header(self, text, token):
+        side = text.split()[-1].rstrip(':')
+        if self.space_headers[side] is None:
+            self.space_headers[side] = self.line
+
+    def read_space_label(self, text, token):
+        match = LIST_AFTER_SPACE.match(text.partition(':')[2])
+        if match:
+            self.record_list('space', match.group(1))
+
+    def first_list_after(self, key, header):
+        if header is None:
+            return None
+        for index, squares in self.labelled_lists.get(key, []):
+            if index > header:
+                return squares
+        return None
+
+    def build_trace(self):
+        trace = PositionTrace()
+        trace.material = self.build_material()
+        trace.pawn_structure = self.build_pawn_structure()
+        trace.king_safety = {side: self.build_king_safety(side) for side in SIDES}
+        trace.pieces_activity = self.build_pieces_activity()
+        trace.threats = self.build_threats()
+        trace.space = {side: self.build_space(side) for side in SIDES}
+        return trace
+
+    def build_material(self):
+        material = {}
+        for side in SIDES:
+            fields = self.material_fields[side]
+            if len(fields) < len(MATERIAL_FIELDS):
+                material[side] = None
+                continue
+            material[side] = Material(
+                pawns=int(fields['pawns']),
+                bishops=int(fields['bishops']),
+                bishops_pair=fields['bishops_pair'] == 'true',
+                knights=int(fields['knights']),
+                rooks=int(fields['rooks']),
+                queens=int(fields['queens'])
+            )
+        return material
+
+    def build_pawn_structure(self):
+        if self.pawn_headers['White'] is None or self.pawn_headers['Black'] is None:
+            return None
+
+        structure = {}
+        for side in SIDES:
+            color = chess.WHITE if side == 'White' else chess.BLACK
+            passed_blocks = self.passed_blocks[side]
+            structure[side] = SidePawnStructure.from_board(
+                self.features,
+                color,
+                {pawn: passed_blocks.get(pawn) for pawn in square_names(self.features.passed_pawns(color))},
+                self.passed_section_seen[side]
+            )
+        return structure
+
+    def build_king_safety(self, side):
+        header = self.king_headers[side]
+        king_safety = SideKingSafety()
+
+        for name in ['attacked', 'double_attacked', 'defended']:
+            squares = self.first_list_after(name, header)
+            setattr(king_safety, name, len(squares.split(', ')) if squares else 0)
+
+        for piece in CHECK_PIECES:
+            squares = self.first_list_after(piece, header)
+            if squares:
+                king_safety.checks[piece] = squares
+
+        return king_safety
+
+    def build_pieces_activity(self):
+        if self.invalid_piece_score:
+            return None
+
+        pieces_activity = {side: [] for side in SIDES}
+        for piece in self.piece_blocks:
+            piece.score = self.piece_scores.get(piece.piece, 'N/A')
+            if 'White' in piece.piece:
+                pieces_activity['White'].append(piece)
+            elif 'Black' in piece.piece:
+                pieces_activity['Black'].append(piece)
+        return pieces_activity
+
+    def build_threats(self):
+        return {
+            side: {key: self.threats[side][key] for key in THREAT_KEYS if key in self.threats[side]}
+            for side in SIDES
+        }
+
+    def build_space(self, side):
+        squares = self.first_list_after('space', self.space_headers[side])
+        return len(squares.split(', ')) if squares else 0
@@ -0,0 +1,149 @@
+"""
+Pre-analyzes well known positions into the analysis cache store.
+
+    python warm_cache.py --pgn games.pgn --depth 16
+    python warm_cache.py --book book.bin --depth 10 --workers 8
+
+Walks every game of a PGN database, variations included, or the moves of a
+polyglot opening book down to the given ply depth. The unique positions are
+analyzed with one warm Stockfish per worker process and written to the
+SQLite file the server reads through ANALYSIS_CACHE_PATH. Positions already
+in the store are skipped, so an interrupted run continues where it stopped.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import chess
+import chess.pgn
+import chess.polyglot
+from dotenv import load_dotenv
+from analysis_cache import AnalysisCache
+from position import Position, normalize_fen
+from position_analyzer import PositionAnalyzer
+from packed_analysis import serialize_analysis
+
+analyzer = None
+
+def start_worker(stockfish_path, command_timeout):
+    global analyzer
+    analyzer = PositionAnalyzer(stockfish_path, 1, command_timeout)
+
+def analyze_position(fen):
+    try:
+        return fen, serialize_analysis(analyzer.run_analysis(Position.parse(fen))), None
+    except Exception as e:
+        return fen, None, str(e)
+
+def positions_from_pgn(path, depth):
+    with open(path) as f:
+        while True:
+            game = chess.pgn.read_game(f)
+            if game is None:
+                return
+
+            stack = [(game, game.board(), 0)]
+            while stack:
+                node, board, ply = stack.pop()
+                if ply > 0:
+                    yield board.fen()
+                if ply == depth:
+                    continue
+
+                for variation in node.variations:
+                    child = board.copy(stack=False)
+                    child.push(variation.move)
+                    stack.append((variation, child, ply + 1))
+
+def positions_from_book(path, depth):
+    visited = set()
+    with chess.polyglot.open_reader(path) as reader:
+        level = [chess.Board()]
+        for _ in range(depth):
+            next_level = []
+            for board in level:
+                for entry in reader.find_all(board):
+                    child = board.copy(stack=False)
+                    child.push(entry.move)
+                    key = normalize_fen(child.fen())
+                    # Transpositions are only expanded once
+                    if key not in visited:
+                        visited.add(key)
+                        next_level.append(child)
+                        yield child.fen()
+            level = next_level
+
+def collect_positions(sources, depth, max_positions):
+    """
+    Returns one FEN per normalized position, in the order they are first reached.
+    """
+    positions = {}
+    for source in sources:
+        for fen in source(depth):
+            positions.setdefault(normalize_fen(fen), fen)
+            if max_positions and len(positions) >= max_positions:
+                return positions
+    return positions
+
+def report_progress(done, failed, total, start):
+    elapsed = time.perf_counter() - start
+    rate = done / elapsed if elapsed else 0
+    remaining = (total - done) / rate if rate else 0
+    print(f'\r{done}/{total} positions, {failed} failed, {rate:.1f} positions/sec, '
+          f'{remaining / 60:.1f} min left', end='', file=sys.stderr, flush=True)
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--pgn', action='append', default=[], help='PGN database, can be repeated')
+    parser.add_argument('--book', action='append', default=[], help='polyglot opening book, can be repeated')
+    parser.add_argument('--depth', type=int, default=12, help='plies to walk from the start of each game')
+    parser.add_argument('--max-positions', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--db', default=os.getenv('ANALYSIS_CACHE_PATH', 'data/analysis_cache.sqlite3'))
+    parser.add_argument('--stockfish', default=os.getenv('STOCKFISH_PATH'))
+    parser.add_argument('--timeout', type=float, default=float(os.getenv('STOCKFISH_TIMEOUT', '10')))
+    args = parser.parse_args()
+
+    if not args.pgn and not args.book:
+        parser.error('at least one --pgn or --book is required')
+    if not args.stockfish:
+        parser.error('--stockfish or STOCKFISH_PATH is required')
+
+    sources = [lambda depth, path=path: positions_from_pgn(path, depth) for path in args.pgn]
+    sources += [lambda depth, path=path: positions_from_book(path, depth) for path in args.book]
+    positions = collect_positions(sources, args.depth, args.max_positions)
+
+    # Only the SQLite store is written, there is no point in keeping analyses in memory here
+    store = AnalysisCache(0, args.db)
+    stored = store.stored_keys()
+    pending = [fen for key, fen in positions.items() if key not in stored]
+    print(f'{len(positions)} unique positions, {len(positions) - len(pending)} already stored, '
+          f'{len(pending)} to analyze with {args.workers} workers', file=sys.stderr)
+    if not pending:
+        return
+
+    done = 0
+    failed = 0
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.workers, start_worker, (args.stockfish, args.timeout)) as pool:
+        try:
+            for fen, analysis, error in pool.imap_unordered(analyze_position, pending, chunksize=4):
+                done += 1
+                if error is None:
+                    store.put(Position.parse(fen), analysis)
+                else:
+                    failed += 1
+                    print(f'\n{fen}: {error}', file=sys.stderr)
+                if done % 10 == 0 or done == len(pending):
+                    report_progress(done, failed, len(pending), start)
+        except KeyboardInterrupt:
+            pool.terminate()
+            print(f'\nInterrupted, {done - failed} positions stored. Run again to resume.', file=sys.stderr)
+            sys.exit(1)
+
+    print(file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
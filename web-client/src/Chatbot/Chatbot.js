@@ -9,6 +9,9 @@ const Chatbot = ({ fen }) => {
   const [error, setError] = useState(null);
   const [loading, setLoading] = useState(false);
   const messagesEndRef = useRef(null);
+  // Identifies this tab to the server, a new analysis cancels the previous one of the session
+  const sessionRef = useRef(`${Date.now()}-${Math.random().toString(36).slice(2)}`);
+  const controllerRef = useRef(null);
 
   const aspects = [
     'General analysis',
@@ -29,6 +32,18 @@ const Chatbot = ({ fen }) => {
     scrollToBottom();
   }, [messages, loading]);
 
+  useEffect(() => {
+    // The analysis in flight is about the previous position, nobody will read it
+    if (controllerRef.current) {
+      controllerRef.current.abort();
+      controllerRef.current = null;
+      setLoading(false);
+      fetch(`http://localhost:8010/proxy/analyze/cancel?session=${encodeURIComponent(sessionRef.current)}`, {
+        method: 'POST',
+      }).catch(() => {});
+    }
+  }, [fen]);
+
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   };
@@ -38,36 +53,95 @@ const Chatbot = ({ fen }) => {
     const userMessage = { sender: 'user', text: message };
     setMessages((prevMessages) => [...prevMessages, userMessage]);
     setLoading(true);
+    const controller = new AbortController();
+    controllerRef.current = controller;
   
     try {
       console.log(JSON.stringify({
         aspect: aspect,
         fen: fen,
       }));
-      const response = await fetch(`http://localhost:8010/proxy/analyze?aspect=${encodeURIComponent(aspect)}` +
-          `&fen=${encodeURIComponent(fen)}`, {
+      const response = await fetch(`http://localhost:8010/proxy/analyze/stream?aspect=${encodeURIComponent(aspect)}` +
+          `&fen=${encodeURIComponent(fen)}&session=${encodeURIComponent(sessionRef.current)}`, {
         method: 'GET',
         headers: {
-          'Content-Type': 'application/json',
+          'Accept': 'text/event-stream',
         },
+        signal: controller.signal,
       });
-      
-  
-      const data = await response.json();
-      setLoading(false);
-      if (response.ok) {
-        const formattedAnswer = data.answer.replace(/\n/g, '  \n');
-        const botMessage = { sender: 'bot', text: formattedAnswer };
-        setMessages((prevMessages) => [...prevMessages, botMessage]);
-      } else {
+
+      if (!response.ok) {
+        const data = await response.json();
+        setLoading(false);
         handleError(data.error);
+        return;
       }
+
+      await readAnswerStream(response);
     } catch (error) {
+      if (error.name === 'AbortError')
+        return;
       setLoading(false);
       handleError('Error de conexión con el servidor.');
+    } finally {
+      if (controllerRef.current === controller)
+        controllerRef.current = null;
     }
   }; 
 
+  const readAnswerStream = async (response) => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let answer = '';
+    let answerStarted = false;
+    const messageId = Date.now();
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done)
+        break;
+
+      buffer += decoder.decode(value, { stream: true });
+      const events = buffer.split('\n\n');
+      buffer = events.pop();
+
+      for (const rawEvent of events) {
+        const { event, data } = parseEvent(rawEvent);
+
+        if (event === 'token') {
+          answer += data.token;
+          const formattedAnswer = answer.replace(/\n/g, '  \n');
+          if (!answerStarted) {
+            answerStarted = true;
+            setLoading(false);
+            setMessages((prevMessages) => [...prevMessages, { id: messageId, sender: 'bot', text: formattedAnswer }]);
+          } else {
+            setMessages((prevMessages) => prevMessages.map((prevMessage) =>
+              prevMessage.id === messageId ? { ...prevMessage, text: formattedAnswer } : prevMessage));
+          }
+        } else if (event === 'error') {
+          setLoading(false);
+          handleError(data.error);
+        }
+      }
+    }
+
+    setLoading(false);
+  };
+
+  const parseEvent = (rawEvent) => {
+    let event = 'message';
+    let data = '';
+    for (const line of rawEvent.split('\n')) {
+      if (line.startsWith('event: '))
+        event = line.slice(7);
+      else if (line.startsWith('data: '))
+        data += line.slice(6);
+    }
+    return { event, data: data ? JSON.parse(data) : {} };
+  };
+
   const handleError = (errorMessage) => {
     setError(errorMessage);
     setTimeout(() => {
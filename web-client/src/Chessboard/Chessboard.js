@@ -16,8 +16,12 @@ import { FaArrowLeft, FaArrowRight, FaSyncAlt, FaUndo } from 'react-icons/fa';
   const [bestLines, setBestLines] = useState(['', '', '']);
   const [score, setScore] = useState('');
   const stockfishDepth = process.env.REACT_APP_STOCKFISH_DEPTH || 18;
+  // Searches on the server engines instead of the Stockfish running in the browser
+  const stockfishServer = process.env.REACT_APP_STOCKFISH_SERVER === 'true';
 
   const stockfishRef = useRef(null);
+  const searchControllerRef = useRef(null);
+  const searchSessionRef = useRef(`${Date.now()}-${Math.random().toString(36).slice(2)}`);
 
   const pieceSymbols = {
     K: '♔',
@@ -186,6 +190,9 @@ import { FaArrowLeft, FaArrowRight, FaSyncAlt, FaUndo } from 'react-icons/fa';
   }, {});
 
   useEffect(() => {
+    if (stockfishServer)
+      return () => searchControllerRef.current?.abort();
+
     stockfishRef.current = new Worker('/stockfish.js');
   
     stockfishRef.current.onmessage = (event) => {
@@ -246,6 +253,7 @@ import { FaArrowLeft, FaArrowRight, FaSyncAlt, FaUndo } from 'react-icons/fa';
       analyzePosition(game.fen());
     }
     else {
+          searchControllerRef.current?.abort();
           setBestMove(null);
           setBestLines(['', '', '']);
           setScore('');
@@ -293,12 +301,74 @@ import { FaArrowLeft, FaArrowRight, FaSyncAlt, FaUndo } from 'react-icons/fa';
   };
 
   const analyzePosition = (fen) => {
-    if (isStockfishEnabled && stockfishRef.current) {
+    if (isStockfishEnabled && stockfishServer) {
+      searchOnServer();
+    } else if (isStockfishEnabled && stockfishRef.current) {
       stockfishRef.current.postMessage(`position fen ${fen}`);
       stockfishRef.current.postMessage(`go depth ${stockfishDepth}`);
     }
   };
 
+  const searchOnServer = async () => {
+    searchControllerRef.current?.abort();
+    const controller = new AbortController();
+    searchControllerRef.current = controller;
+
+    // The start of the game and the moves played since, so the server engine keeps its hash table between moves
+    const playedMoves = game.history({ verbose: true });
+    const rootFen = playedMoves.length ? playedMoves[0].before : game.fen();
+    const moves = playedMoves.map((move) => move.from + move.to + (move.promotion || '')).join(',');
+
+    try {
+      const response = await fetch(`http://localhost:8010/proxy/search/stream?fen=${encodeURIComponent(rootFen)}` +
+          `&moves=${moves}&depth=${stockfishDepth}&multipv=3&session=${encodeURIComponent(searchSessionRef.current)}`, {
+        method: 'GET',
+        headers: {
+          'Accept': 'text/event-stream',
+        },
+        signal: controller.signal,
+      });
+      if (!response.ok)
+        return;
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done)
+          break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+
+        for (const rawEvent of events) {
+          const { event, data } = parseEvent(rawEvent);
+          if (event === 'info')
+            handleInfoDepth(data.line);
+          else if (event === 'bestmove')
+            handleBestMove(data.line);
+        }
+      }
+    } catch (error) {
+      if (error.name !== 'AbortError')
+        console.log(error);
+    }
+  };
+
+  const parseEvent = (rawEvent) => {
+    let event = 'message';
+    let data = '';
+    for (const line of rawEvent.split('\n')) {
+      if (line.startsWith('event: '))
+        event = line.slice(7);
+      else if (line.startsWith('data: '))
+        data += line.slice(6);
+    }
+    return { event, data: data ? JSON.parse(data) : {} };
+  };
+
   const toggleStockfish = () => {
     setIsStockfishEnabled((prev) => !prev);
   };